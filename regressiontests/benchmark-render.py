@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+Benchmark rendering the head of resolved metadata
+
+A synthetic Metadata definition is built with the given number of fields,
+and the head of an already resolved set of metadata is rendered many times,
+without touching the database. Two ways of rendering are measured:
+
+    getattr     binding each field through attribute access, one at a time,
+                as the head used to be rendered
+    head        the renderer prepared when the definition was built, as
+                used by unicode(metadata)
+
+Results are written as JSON, so that they can be compared between versions:
+
+    ./benchmark-render.py --output before.json
+    ./benchmark-render.py --output after.json --compare before.json
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+PROJECT_ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+TESTS_ROOT = os.path.realpath(os.path.dirname(__file__))
+sys.path = [PROJECT_ROOT, TESTS_ROOT] + sys.path
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+
+def build_definition(fields, number):
+    """ A Metadata definition with the given number of head fields. """
+    from rollyourown import seo
+    attrs = {'__module__': __name__}
+    for i in range(fields):
+        if i % 3 == 0:
+            attrs['field%d' % i] = seo.Tag(head=True, name='tag%d' % i)
+        elif i % 3 == 1:
+            attrs['field%d' % i] = seo.MetaTag(name='meta%d' % i)
+        else:
+            attrs['field%d' % i] = seo.KeywordTag(name='keywords%d' % i)
+    attrs['Meta'] = type('Meta', (), {'backends': ('path',), 'verbose_name': 'Render benchmark %d' % number})
+    return type('RenderBenchmark%d' % number, (seo.Metadata,), attrs)
+
+
+def render_getattr(metadata):
+    """ Renders the head one bound field at a time. """
+    return u'\n'.join(unicode(getattr(metadata, f)) for f, e in metadata._FormattedMetadata__metadata._meta.elements.items() if e.head)
+
+
+def render_head(metadata):
+    return unicode(metadata)
+
+
+def measure(fields, renders, number):
+    from rollyourown.seo.base import FormattedMetadata
+    Metadata = build_definition(fields, number)
+    PathMetadata = Metadata._meta.get_model('path')
+    values = dict(('field%d' % i, u'Value <b>%d</b> & "more"' % i) for i in range(fields))
+    instance = PathMetadata(_path='/', **values)
+
+    results = {'fields': fields, 'renders': renders}
+    expected = None
+    for name, render in (('getattr', render_getattr), ('head', render_head)):
+        output = render(FormattedMetadata(Metadata(), [instance], '/'))
+        if expected is not None and output != expected:
+            raise SystemExit("The renderers don't agree")
+        expected = output
+        best = None
+        for repeat in range(3):
+            start = time.time()
+            for i in range(renders):
+                render(FormattedMetadata(Metadata(), [instance], '/'))
+            elapsed = time.time() - start
+            best = best is None and elapsed or min(best, elapsed)
+        # Microseconds per render
+        results[name] = best / renders * 1000000
+    return results
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--fields', default='5,25,100',
+                      help='Comma separated numbers of head fields in the definition.')
+    parser.add_option('--renders', type='int', default=2000,
+                      help='Number of times to render each head.')
+    parser.add_option('--output', default=None,
+                      help='Write the results to this file, as JSON.')
+    parser.add_option('--compare', default=None,
+                      help='Compare with results saved earlier using --output.')
+    options, args = parser.parse_args()
+
+    results = []
+    for number, fields in enumerate([int(n) for n in options.fields.split(',')]):
+        result = measure(fields, options.renders, number)
+        results.append(result)
+        print >>sys.stderr, "%(fields)4d fields: %(getattr)8.1fus getattr, %(head)8.1fus head" % result
+
+    import django
+    output = {
+        'python': sys.version.split()[0],
+        'django': django.get_version(),
+        'created': time.time(),
+        'results': results,
+    }
+    if options.output:
+        stream = open(options.output, 'w')
+        try:
+            json.dump(output, stream, indent=2)
+        finally:
+            stream.close()
+    else:
+        print json.dumps(output, indent=2)
+
+    if options.compare:
+        stream = open(options.compare)
+        try:
+            previous = dict((r['fields'], r) for r in json.load(stream)['results'])
+        finally:
+            stream.close()
+        for result in results:
+            before = previous.get(result['fields'])
+            if before and before['head']:
+                print "%4d fields: %+6.1f%%" % (result['fields'], (result['head'] / before['head'] - 1) * 100)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the construction of Metadata definitions
+
+For each size, synthetic Metadata definitions are written to a module,
+which is then imported in a fresh python process, after the test project's
+own definitions have been loaded. The time taken to import the module,
+the time spent in MetadataBase.__new__, Options._register_elements and
+Options._add_backend, the memory used and the number of models created are
+measured.
+
+Results are written as JSON, so that they can be compared between versions:
+
+    ./benchmark-startup.py --output before.json
+    ./benchmark-startup.py --output after.json --compare before.json
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+PROJECT_ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+TESTS_ROOT = os.path.realpath(os.path.dirname(__file__))
+
+
+def generate_module(classes, fields, backends):
+    """ Source code for a module with the given number of Metadata
+        definitions, each with the given number of fields.
+    """
+    lines = ["from rollyourown import seo", ""]
+    for i in range(classes):
+        lines.append("class Benchmark%d(seo.Metadata):" % i)
+        for j in range(fields):
+            if j % 3 == 0:
+                lines.append("    field%d = seo.Tag(head=True, max_length=68)" % j)
+            elif j % 3 == 1:
+                lines.append("    field%d = seo.MetaTag()" % j)
+            else:
+                lines.append("    field%d = seo.KeywordTag()" % j)
+        lines.append("    class Meta:")
+        lines.append("        backends = %r" % (tuple(backends),))
+        lines.append("        verbose_name = 'Benchmark %d'" % i)
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def memory_used():
+    """ Resident memory of this process, in kilobytes. """
+    try:
+        stream = open('/proc/self/statm')
+        try:
+            return int(stream.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        finally:
+            stream.close()
+    except (IOError, OSError, ValueError):
+        import resource
+        # Peak memory use, which is the best that is available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def timed(owner, name, totals):
+    """ Wraps the given method, adding the time spent in it to totals. """
+    original = getattr(owner, name)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            totals[name] = totals.get(name, 0) + time.time() - start
+    setattr(owner, name, wrapper)
+
+
+def measure(module_name):
+    """ Imports the given module of synthetic definitions, in this process,
+        and returns the measurements.
+    """
+    sys.path = [PROJECT_ROOT, TESTS_ROOT] + sys.path
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+    # Load the project's own definitions first, they aren't being measured
+    from django.db.models import get_app, get_models
+    import rollyourown.seo.models
+    from rollyourown.seo.base import registry
+    from rollyourown.seo.options import Options
+    from rollyourown.seo.utils import startup_timings
+
+    totals = {}
+    timed(Options, '_register_elements', totals)
+    timed(Options, '_add_backend', totals)
+    timings = len(startup_timings.timings)
+
+    definitions = len(registry)
+    models = len(get_models(get_app('seo')))
+    memory = memory_used()
+
+    start = time.time()
+    __import__(module_name)
+    import_time = time.time() - start
+
+    return {
+        'import': import_time,
+        # MetadataBase.__new__ records the time taken for each definition
+        'metadata_new': sum(seconds for name, seconds in startup_timings.timings[timings:]
+                                                if name.startswith('Metadata ')),
+        'register_elements': totals.get('_register_elements', 0),
+        'add_backend': totals.get('_add_backend', 0),
+        'memory_kb': memory_used() - memory,
+        'definitions': len(registry) - definitions,
+        'models': len(get_models(get_app('seo'))) - models,
+    }
+
+
+def run(classes, fields, backends, repeat):
+    """ Measures the given size in fresh processes, returning the
+        measurements of the fastest run.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        module_name = 'benchmark_metadata_%d_%d' % (classes, fields)
+        stream = open(os.path.join(directory, module_name + '.py'), 'w')
+        try:
+            stream.write(generate_module(classes, fields, backends))
+        finally:
+            stream.close()
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [directory, env.get('PYTHONPATH')]))
+        runs = []
+        for i in range(repeat):
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--measure', module_name],
+                                       stdout=subprocess.PIPE, env=env, cwd=TESTS_ROOT)
+            output = process.communicate()[0]
+            if process.returncode != 0:
+                raise SystemExit("Measuring %d classes with %d fields failed" % (classes, fields))
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+    finally:
+        shutil.rmtree(directory)
+
+    result = min(runs, key=lambda r: r['import'])
+    result.update({'classes': classes, 'fields': fields, 'backends': list(backends)})
+    return result
+
+
+def compare(results, previous):
+    """ Prints the change in import time for each size measured both times. """
+    previous = dict(((r['classes'], r['fields']), r) for r in previous['results'])
+    for result in results:
+        before = previous.get((result['classes'], result['fields']))
+        if before and before['import']:
+            print "%4d classes x %3d fields: %+6.1f%%" % (result['classes'], result['fields'],
+                                    (result['import'] / before['import'] - 1) * 100)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--classes', default='1,10,50',
+                      help='Comma separated numbers of Metadata classes to define.')
+    parser.add_option('--fields', default='5,25,100',
+                      help='Comma separated numbers of fields in each class.')
+    parser.add_option('--backends', default='path,modelinstance,model,view',
+                      help='Backends used by each class.')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='Number of processes to measure for each size, the fastest is kept.')
+    parser.add_option('--output', default=None,
+                      help='Write the results to this file, as JSON.')
+    parser.add_option('--compare', default=None,
+                      help='Compare with results saved earlier using --output.')
+    parser.add_option('--measure', default=None, help="Used internally.")
+    options, args = parser.parse_args()
+
+    if options.measure:
+        print json.dumps(measure(options.measure))
+        return
+
+    backends = options.backends.split(',')
+    results = []
+    for classes in [int(n) for n in options.classes.split(',')]:
+        for fields in [int(n) for n in options.fields.split(',')]:
+            result = run(classes, fields, backends, options.repeat)
+            results.append(result)
+            print >>sys.stderr, ("%(classes)4d classes x %(fields)3d fields: %(import)7.3fs import, "
+                                 "%(add_backend)7.3fs building models, %(models)5d models, "
+                                 "%(memory_kb)7d KB" % result)
+
+    import django
+    output = {
+        'python': sys.version.split()[0],
+        'django': django.get_version(),
+        'created': time.time(),
+        'results': results,
+    }
+    if options.output:
+        stream = open(options.output, 'w')
+        try:
+            json.dump(output, stream, indent=2)
+        finally:
+            stream.close()
+    else:
+        print json.dumps(output, indent=2)
+
+    if options.compare:
+        stream = open(options.compare)
+        try:
+            compare(results, json.load(stream))
+        finally:
+            stream.close()
+
+
+if __name__ == "__main__":
+    main()
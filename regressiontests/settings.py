@@ -24,7 +24,14 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
-    }
+    },
+    # Stands in for a replica, see Meta.read_database. Its test database is
+    # a file, so that other threads can read it (see Meta.concurrent_lookups)
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'replica.db',
+        'TEST_NAME': 'test_replica.db',
+    },
 }
 
 # Old-school fallback (Django <= 1.1)
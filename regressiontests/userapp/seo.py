@@ -1,3 +1,5 @@
+import os
+
 from rollyourown import seo
 from django.db import models
 from django.contrib.sites.models import Site
@@ -78,6 +80,7 @@ class WithRedirect(seo.Metadata):
 
     class Meta:
         use_redirect = True
+        seo_models = ('userapp.page', )
 
 class WithRedirectSites(seo.Metadata):
     title        = seo.Tag()
@@ -120,3 +123,38 @@ class WithSEOModels(seo.Metadata):
 
     class Meta:
         seo_models = ('userapp', )
+
+class WithSparse(seo.Metadata):
+    title = seo.Tag()
+
+    class Meta:
+        seo_models = ('userapp', )
+        sparse_instances = True
+
+class WithPrefix(seo.Metadata):
+    title       = seo.Tag()
+    description = seo.MetaTag()
+
+    class Meta:
+        backends = ('path', 'prefix')
+
+class WithStatic(seo.Metadata):
+    title       = seo.Tag()
+    description = seo.MetaTag()
+
+    class Meta:
+        backends = ('path', 'static')
+        static_file = os.path.join(os.path.dirname(__file__), 'static_metadata.json')
+
+def get_generated_heading(metadata, **kwargs):
+    return "Generated heading"
+
+class WithPrerender(seo.Metadata):
+    title       = seo.Tag(head=True)
+    description = seo.MetaTag(populate_from=seo.Literal("A <b>description</b>"))
+    heading     = seo.Tag(name="h1", populate_from=get_generated_heading)
+    raw         = seo.Raw(head=False, valid_tags="b")
+
+    class Meta:
+        backends = ('path', 'view')
+        prerender = True
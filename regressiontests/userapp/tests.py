@@ -35,6 +35,7 @@
 
 """
 import StringIO
+import logging
 
 from django.core.urlresolvers import reverse
 from django.test import TestCase
@@ -50,16 +51,16 @@ from django.contrib.auth.models import User
 from django.conf import settings
 from django.db import IntegrityError, transaction
 from django.core.handlers.wsgi import WSGIRequest
-from django.template import Template, RequestContext, TemplateSyntaxError
+from django.template import Template, Context, RequestContext, TemplateSyntaxError
 from django.core.cache import cache
 from django.utils.hashcompat import md5_constructor
 from django.utils.encoding import iri_to_uri
 from django.core.management import call_command
 
-from rollyourown.seo import get_metadata as seo_get_metadata
+from rollyourown.seo import get_metadata as seo_get_metadata, get_linked_metadata, get_bulk_metadata
 from rollyourown.seo.base import registry
 from userapp.models import Page, Product, Category, NoPath, Tag
-from userapp.seo import Coverage, WithSites, WithI18n, WithRedirect, WithRedirectSites, WithCache, WithCacheSites, WithCacheI18n, WithBackends
+from userapp.seo import Coverage, WithSites, WithI18n, WithRedirect, WithRedirectSites, WithCache, WithCacheSites, WithCacheI18n, WithBackends, WithSparse, WithStatic, WithPrefix, WithPrerender
 
 
 def get_metadata(path):
@@ -171,50 +172,109 @@ class DataSelection(TestCase):
         path_metadata.save()
         self.assertEqual(seo_get_metadata(path, name="WithI18n", language="de").title.value, None)
 
-#    # FUTURE feature
-#
-#    def test_redirect(self):
-#        """ Tests django.contrib.redirect support, automatically adding redirects for new paths.
-#        """
-#        old_path = "/abc/"
-#        new_path = "/new-path/"
-#
-#        # Check that the redirect doesn't already exist
-#        self.assertEqual(Redirect.objects.filter(old_path=old_path, new_path=new_path).count(), 0)
-#
-#        path_metadata = WithRedirect._meta.get_model('path').objects.create(title="A Path title", _path=old_path)
-#        self.assertEqual(seo_get_metadata(old_path, name="WithRedirect").title.value, 'A Path title')
-#
-#        # Rename the path
-#        path_metadata._path = new_path
-#        path_metadata.save()
-#        self.assertEqual(seo_get_metadata(old_path, name="WithRedirect").title.value, None)
-#        self.assertEqual(seo_get_metadata(new_path, name="WithRedirect").title.value, 'A Path title')
-#
-#        # Check that a redirect was created
-#        self.assertEqual(Redirect.objects.filter(old_path=old_path, new_path=new_path).count(), 1)
-#
-#    def test_redirect_with_sites(self):
-#        """ Tests django.contrib.redirect support, automatically adding redirects for new paths.
-#        """
-#        old_path = "/abc/"
-#        new_path = "/new-path/"
-#        site = Site.objects.get_current()
-#
-#        # Check that the redirect doesn't already exist
-#        self.assertEqual(Redirect.objects.filter(old_path=old_path, new_path=new_path, site=site).count(), 0)
-#
-#        path_metadata = WithRedirectSites._meta.get_model('path').objects.create(title="A Path title", _path=old_path, _site=site)
-#        self.assertEqual(seo_get_metadata(old_path, name="WithRedirectSites").title.value, 'A Path title')
-#
-#        # Rename the path
-#        path_metadata._path = new_path
-#        path_metadata.save()
-#        self.assertEqual(seo_get_metadata(old_path, name="WithRedirectSites").title.value, None)
-#        self.assertEqual(seo_get_metadata(new_path, name="WithRedirectSites").title.value, 'A Path title')
-#
-#        # Check that a redirect was created
-#        self.assertEqual(Redirect.objects.filter(old_path=old_path, new_path=new_path, site=site).count(), 1)
+    def test_redirect(self):
+        """ Tests django.contrib.redirect support, automatically adding redirects for new paths.
+        """
+        old_path = "/abc/"
+        new_path = "/new-path/"
+
+        # Check that the redirect doesn't already exist
+        self.assertEqual(Redirect.objects.filter(old_path=old_path, new_path=new_path).count(), 0)
+
+        path_metadata = WithRedirect._meta.get_model('path').objects.create(title="A Path title", _path=old_path)
+        self.assertEqual(seo_get_metadata(old_path, name="WithRedirect").title.value, 'A Path title')
+
+        # Rename the path
+        path_metadata._path = new_path
+        path_metadata.save()
+        self.assertEqual(seo_get_metadata(old_path, name="WithRedirect").title.value, None)
+        self.assertEqual(seo_get_metadata(new_path, name="WithRedirect").title.value, 'A Path title')
+
+        # Check that a redirect was created
+        self.assertEqual(Redirect.objects.filter(old_path=old_path, new_path=new_path).count(), 1)
+
+    def test_redirect_with_sites(self):
+        """ Tests django.contrib.redirect support, automatically adding redirects for new paths.
+        """
+        old_path = "/abc/"
+        new_path = "/new-path/"
+        site = Site.objects.get_current()
+
+        # Check that the redirect doesn't already exist
+        self.assertEqual(Redirect.objects.filter(old_path=old_path, new_path=new_path, site=site).count(), 0)
+
+        path_metadata = WithRedirectSites._meta.get_model('path').objects.create(title="A Path title", _path=old_path, _site=site)
+        self.assertEqual(seo_get_metadata(old_path, name="WithRedirectSites").title.value, 'A Path title')
+
+        # Rename the path
+        path_metadata._path = new_path
+        path_metadata.save()
+        self.assertEqual(seo_get_metadata(old_path, name="WithRedirectSites").title.value, None)
+        self.assertEqual(seo_get_metadata(new_path, name="WithRedirectSites").title.value, 'A Path title')
+
+        # Check that a redirect was created
+        self.assertEqual(Redirect.objects.filter(old_path=old_path, new_path=new_path, site=site).count(), 1)
+
+    def test_redirect_model_instance(self):
+        """ Tests that a redirect is added when the URL of an object changes.
+        """
+        page = Page.objects.create(type="redirect-old")
+        page.type = "redirect-new"
+        page.save()
+        self.assertEqual(Redirect.objects.filter(old_path="/pages/redirect-old/", new_path="/pages/redirect-new/").count(), 1)
+
+        # Changing back removes the first redirect, and adds one the other way
+        page.type = "redirect-old"
+        page.save()
+        self.assertEqual(Redirect.objects.filter(old_path="/pages/redirect-old/").count(), 0)
+        self.assertEqual(Redirect.objects.filter(old_path="/pages/redirect-new/", new_path="/pages/redirect-old/").count(), 1)
+
+    def test_redirect_unsaved(self):
+        " Checks that a path given before metadata was first saved isn't redirected. "
+        PathMetadata = WithRedirect._meta.get_model('path')
+        path_metadata = PathMetadata(_path="/never-existed/", title="A Path title")
+        path_metadata._path = "/new/"
+        path_metadata.save()
+        self.assertEqual(Redirect.objects.filter(old_path="/never-existed/").count(), 0)
+
+        # But once it is saved, it is
+        path_metadata._path = "/newer/"
+        path_metadata.save()
+        self.assertEqual(Redirect.objects.filter(old_path="/new/", new_path="/newer/").count(), 1)
+
+    def test_redirect_middleware(self):
+        """ Tests that missing pages are redirected, from an index held in memory.
+        """
+        from rollyourown.seo.redirects import RedirectFallbackMiddleware
+        from django.http import HttpResponseNotFound
+        path_metadata = WithRedirect._meta.get_model('path').objects.create(title="A Path title", _path="/old-path/")
+        path_metadata._path = "/new-path/"
+        path_metadata.save()
+
+        middleware = RedirectFallbackMiddleware()
+        request = WSGIRequest({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/old-path/', 'QUERY_STRING': 'a=1', 'wsgi.input': StringIO.StringIO()})
+        middleware.process_response(request, HttpResponseNotFound())
+        def check():
+            response = middleware.process_response(request, HttpResponseNotFound())
+            self.assertEqual(response.status_code, 301)
+            self.assertEqual(response['Location'], "/new-path/")
+        self.assertNumQueries(0, check)
+
+        Redirect.objects.create(site=Site.objects.get_current(), old_path="/gone/", new_path="")
+        request = WSGIRequest({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/gone/', 'wsgi.input': StringIO.StringIO()})
+        self.assertEqual(middleware.process_response(request, HttpResponseNotFound()).status_code, 410)
+
+        # As with django.contrib.redirects, the trailing slash is optional
+        Redirect.objects.create(site=Site.objects.get_current(), old_path="/no-slash", new_path="/slash/")
+        request = WSGIRequest({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/no-slash/', 'wsgi.input': StringIO.StringIO()})
+        self.assertEqual(middleware.process_response(request, HttpResponseNotFound())['Location'], "/slash/")
+
+        # The index is rebuilt if the generation leaves the cache
+        if 'dummy' not in settings.CACHE_BACKEND:
+            from rollyourown.seo.redirects import GENERATION_KEY
+            Redirect.objects.filter(old_path="/no-slash").update(new_path="/other/")
+            cache.delete(GENERATION_KEY)
+            self.assertEqual(middleware.process_response(request, HttpResponseNotFound())['Location'], "/other/")
 
     def test_missing_value(self):
         """ Checks that nothing breaks when no value could be found. 
@@ -283,6 +343,441 @@ class DataSelection(TestCase):
 
         self.assertEqual(get_metadata(path=self.page.get_absolute_url()).title.value, 'Page title')
 
+    def test_sync_single_query(self):
+        """ Checks that syncing metadata for an existing object is a single
+            atomic statement, which only counts as a write if the path changed.
+        """
+        from django.db import connection
+        from rollyourown.seo.base import create_metadata_instance
+        from rollyourown.seo.db import _supports_upsert
+        if _supports_upsert(connection):
+            InstanceMetadata = Coverage._meta.get_model('modelinstance')
+            self.page.type = "upserted-type"
+            self.assertNumQueries(1, create_metadata_instance, InstanceMetadata, self.page)
+            metadata = InstanceMetadata.objects.get(_content_type=self.page_content_type, _object_id=self.page.id)
+            self.assertEqual(metadata._path, self.page.get_absolute_url())
+            self.assertEqual(metadata.title, 'Page title')
+
+            # Saving without changing the path writes nothing, cached metadata stays valid
+            from rollyourown.seo import db
+            db._last_write.time = 0
+            self.assertNumQueries(2, create_metadata_instance, InstanceMetadata, self.page)
+            self.assertEqual(db._last_write.time, 0)
+
+    def test_sync_retry(self):
+        """ Checks that a sync which loses a race with another process is
+            tried again, rather than raising an exception.
+        """
+        from rollyourown.seo import base
+        InstanceMetadata = WithRedirect._meta.get_model('modelinstance')
+        original = base._sync_instance_metadata
+        calls = []
+        def racing_sync(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise IntegrityError("column _path is not unique")
+            return original(*args)
+        # Change the path without sending any signals
+        Page.objects.filter(pk=self.page.pk).update(type="retried-type")
+        self.page = Page.objects.get(pk=self.page.pk)
+        base._sync_instance_metadata = racing_sync
+        try:
+            base.create_metadata_instance(InstanceMetadata, self.page)
+        finally:
+            base._sync_instance_metadata = original
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(InstanceMetadata.objects.get(_content_type=self.page_content_type, _object_id=self.page.id)._path,
+                         self.page.get_absolute_url())
+
+        # Retries are limited, the object's save() still succeeds
+        class Logging(object):
+            warnings = []
+            def warning(self, msg):
+                self.warnings.append(msg)
+        def losing_sync(*args):
+            calls.append(args)
+            raise IntegrityError("column _path is not unique")
+        calls = []
+        base._sync_instance_metadata, base.logging = losing_sync, Logging()
+        try:
+            base.create_metadata_instance(InstanceMetadata, self.page)
+        finally:
+            base._sync_instance_metadata, base.logging = original, logging
+        self.assertEqual(len(calls), base.SYNC_ATTEMPTS)
+        self.assertEqual(len(Logging.warnings), 1)
+
+    def test_sync_prerender(self):
+        " Checks that metadata rendered when saved isn't synced behind save()'s back. "
+        from rollyourown.seo.db import upsert_instance_metadata
+        InstanceMetadata = Coverage._meta.get_model('modelinstance')
+        Coverage._meta.prerender = True
+        try:
+            self.assertFalse(upsert_instance_metadata(InstanceMetadata, self.page_content_type, self.page.pk, "/prerendered/"))
+        finally:
+            Coverage._meta.prerender = False
+
+    def test_sparse_instances(self):
+        """ Checks that sparse metadata is only created by editors, but then follows the path. """
+        SparseMetadata = WithSparse._meta.get_model('modelinstance')
+        self.assertEqual(SparseMetadata.objects.count(), 0)
+        page = Page.objects.create(type="sparse")
+        self.assertEqual(SparseMetadata.objects.count(), 0)
+        call_command('populate_metadata')
+        self.assertEqual(SparseMetadata.objects.count(), 0)
+
+        # Model metadata is used for objects without their own metadata,
+        # which are given an empty row to find it from their path
+        WithSparse._meta.get_model('model').objects.create(_content_type=self.page_content_type, title="Sparse model title")
+        self.assertEqual(SparseMetadata.objects.count(), Page.objects.count())
+        self.assertEqual(seo_get_metadata(page.get_absolute_url(), name="WithSparse").title.value, 'Sparse model title')
+        self.assertEqual(get_linked_metadata(page, name="WithSparse").title.value, 'Sparse model title')
+        new_page = Page.objects.create(type="new-page")
+        self.assertEqual(seo_get_metadata(new_page.get_absolute_url(), name="WithSparse").title.value, 'Sparse model title')
+        # Other models still have no rows
+        Product.objects.create()
+        self.assertEqual(SparseMetadata.objects.count(), Page.objects.count())
+
+        SparseMetadata.objects.filter(_object_id=page.pk, _content_type=self.page_content_type).update(title="Sparse title")
+        page.type = "new-sparse"
+        page.save()
+        self.assertEqual(SparseMetadata.objects.count(), Page.objects.count())
+        self.assertEqual(seo_get_metadata(page.get_absolute_url(), name="WithSparse").title.value, 'Sparse title')
+
+    def test_prerender(self):
+        " Checks that values are cleaned and rendered when saved, if they never change. "
+        from django.utils import simplejson
+        from django.utils.safestring import SafeData
+        PathMetadata = WithPrerender._meta.get_model('path')
+        ViewMetadata = WithPrerender._meta.get_model('view')
+        path_metadata = PathMetadata.objects.create(_path="/prerender/", title="The <strong>Title</strong>", raw="<b>Raw</b>")
+        ViewMetadata.objects.create(_view="", title="{{ title }}", raw="Raw view")
+
+        stored = simplejson.loads(PathMetadata.objects.get(pk=path_metadata.pk)._rendered)
+        self.assertEqual(sorted(stored['fields']), ['description', 'raw', 'title'])
+        self.assertEqual(stored['fields']['title'][2], u'<title>The <strong>Title</strong></title>')
+        self.assertEqual(stored['head'], u'<title>The <strong>Title</strong></title>\n'
+                                         u'<meta name="description" content="A &lt;b&gt;description&lt;/b&gt;" />')
+        # Template substitutions are left for when they are needed
+        self.assertEqual(sorted(simplejson.loads(ViewMetadata.objects.get()._rendered)['fields']), ['description', 'raw'])
+
+        # Stored values are used without cleaning them again
+        def forbidden(value):
+            raise AssertionError("Value was cleaned")
+        for name in ('title', 'description', 'raw'):
+            WithPrerender._meta.elements[name].clean = forbidden
+        try:
+            metadata = seo_get_metadata(path="/prerender/", name="WithPrerender")
+            output = unicode(metadata), metadata.title.value, metadata.raw.value, unicode(metadata.heading)
+        finally:
+            for name in ('title', 'description', 'raw'):
+                del WithPrerender._meta.elements[name].clean
+        self.assert_(isinstance(output[2], SafeData))
+
+        # The results are the same without prerendering
+        WithPrerender._meta.prerender = False
+        try:
+            metadata = seo_get_metadata(path="/prerender/", name="WithPrerender")
+            self.assertEqual(output, (unicode(metadata), metadata.title.value, metadata.raw.value, unicode(metadata.heading)))
+        finally:
+            WithPrerender._meta.prerender = True
+
+        # Values rendered for another version of the definition are ignored
+        PathMetadata.objects.filter(pk=path_metadata.pk).update(_rendered=path_metadata._rendered.replace(
+                                                    WithPrerender._meta.prerender_version, 'old'))
+        metadata = seo_get_metadata(path="/prerender/", name="WithPrerender")
+        self.assertEqual(output[0], unicode(metadata))
+        self.assertEqual(PathMetadata.objects.get(pk=path_metadata.pk)._get_prerendered(), None)
+
+        # Until they are rendered again
+        call_command('prerender_metadata', verbosity=0)
+        self.assertEqual(PathMetadata.objects.get(pk=path_metadata.pk)._get_prerendered()['head'], stored['head'])
+
+        # Values changed without calling save() are noticed
+        PathMetadata.objects.filter(pk=path_metadata.pk).update(title="New")
+        metadata = seo_get_metadata(path="/prerender/", name="WithPrerender")
+        self.assertEqual(metadata.title.value, "New")
+        self.assert_(u'<title>New</title>' in unicode(metadata))
+        self.assertEqual(PathMetadata.objects.get(pk=path_metadata.pk)._get_prerendered(), None)
+
+    def test_static_backend(self):
+        """ Checks that metadata is read from a static file, without querying 
+            for it, and that database backends listed first take precedence.
+        """
+        StaticMetadata = WithStatic._meta.get_model('static')
+        self.assertFalse(StaticMetadata._meta.managed)
+        rows = StaticMetadata.objects.for_site_and_language()
+        self.assertTrue(StaticMetadata.objects.for_site_and_language() is rows)
+        self.assertEqual(rows["/legal/"][0].title, "Legal notice")
+        self.assertNumQueries(1, lambda: seo_get_metadata("/legal/", name="WithStatic").description.value)
+        metadata = seo_get_metadata("/legal/", name="WithStatic")
+        self.assertEqual(metadata.title.value, "Legal notice")
+        self.assertEqual(metadata.description.value, "The small print")
+
+        WithStatic._meta.get_model('path').objects.create(_path="/campaign/", title="Database title")
+        metadata = seo_get_metadata("/campaign/", name="WithStatic")
+        self.assertEqual(metadata.title.value, "Database title")
+
+    def test_static_file_errors(self):
+        " Checks that mistakes in a static file are reported when it is loaded. "
+        import os
+        import tempfile
+        from rollyourown.seo.backends import load_static_rows
+        fields = ['_path', 'title', 'description']
+        for content in ('{"/legal/": {"title": "Legal", "titel": "Typo"}}', '{"/legal/": ', '["/legal/"]'):
+            handle, filename = tempfile.mkstemp(suffix='.json')
+            try:
+                os.write(handle, content)
+                os.close(handle)
+                self.assertRaises(Exception, load_static_rows, filename, fields)
+            finally:
+                os.remove(filename)
+        try:
+            load_static_rows(os.path.join(os.path.dirname(__file__), 'static_metadata.json'), ['_path', 'title'])
+        except Exception, e:
+            self.assertEqual(unicode(e).split(': ')[-1], 'description')
+        else:
+            self.fail("Unknown field not reported")
+
+    def test_prefix_backend(self):
+        """ Checks that prefix metadata applies to every path under the prefix,
+            the longest prefix first, and that changes are seen straight away.
+        """
+        PrefixMetadata = WithPrefix._meta.get_model('prefix')
+        PrefixMetadata.objects.create(_prefix="/blog/", title="Blog", description="Blog description")
+        news = PrefixMetadata.objects.create(_prefix="/blog/news/", title="News")
+
+        metadata = seo_get_metadata("/blog/news/1/", name="WithPrefix")
+        self.assertEqual(metadata.title.value, "News")
+        self.assertEqual(metadata.description.value, "Blog description")
+        self.assertEqual(seo_get_metadata("/blog/", name="WithPrefix").title.value, "Blog")
+        self.assertEqual(seo_get_metadata("/blogs/", name="WithPrefix").title.value, None)
+
+        # Only the path backend is queried
+        self.assertNumQueries(1, lambda: seo_get_metadata("/blog/2/", name="WithPrefix").title.value)
+
+        WithPrefix._meta.get_model('path').objects.create(_path="/blog/news/1/", title="Specific")
+        self.assertEqual(seo_get_metadata("/blog/news/1/", name="WithPrefix").title.value, "Specific")
+
+        news.title = "Latest news"
+        news.save()
+        self.assertEqual(seo_get_metadata("/blog/news/2/", name="WithPrefix").title.value, "Latest news")
+        news.delete()
+        self.assertEqual(seo_get_metadata("/blog/news/2/", name="WithPrefix").title.value, "Blog")
+
+    def test_prefix_backend_bulk_writes(self):
+        """ Checks that the prefix trie is rebuilt after bulk writes, which
+            send no signals, and when the generation has left the cache.
+        """
+        from rollyourown.seo import db
+        if 'dummy' not in settings.CACHE_BACKEND:
+            PrefixMetadata = WithPrefix._meta.get_model('prefix')
+            news = PrefixMetadata.objects.create(_prefix="/blog/news/", title="News")
+            self.assertEqual(seo_get_metadata("/blog/news/2/", name="WithPrefix").title.value, "News")
+
+            news.title = "Latest news"
+            db.bulk_update(PrefixMetadata, [news], [PrefixMetadata._meta.get_field('title')])
+            self.assertEqual(seo_get_metadata("/blog/news/2/", name="WithPrefix").title.value, "Latest news")
+
+            PrefixMetadata.objects.filter(pk=news.pk).update(title="Old news")
+            cache.delete(db._generation_key(WithPrefix))
+            self.assertEqual(seo_get_metadata("/blog/news/2/", name="WithPrefix").title.value, "Old news")
+
+            db.delete_metadata(PrefixMetadata, [news.pk])
+            self.assertEqual(seo_get_metadata("/blog/news/2/", name="WithPrefix").title.value, None)
+
+    def test_read_database(self):
+        """ Checks that lookups read from Meta.read_database, unless metadata
+            has just been written by the same thread.
+        """
+        from rollyourown.seo import db, base
+        PathMetadata = Coverage._meta.get_model('path')
+        Coverage._meta.read_database = 'replica'
+        try:
+            db._last_write.time = 0
+            self.assertEqual(base._read_manager(PathMetadata).get_instances("/path/").db, 'replica')
+            self.path_metadata.save()
+            self.assertEqual(base._read_manager(PathMetadata).get_instances("/path/").db, 'default')
+            db._last_write.time = 0
+            self.assertEqual(base._read_manager(PathMetadata).get_instances("/path/").db, 'replica')
+            # Writes stay on the primary database
+            self.assertEqual(PathMetadata.objects.get_instances("/path/").db, 'default')
+            self.assertEqual(PathMetadata.objects.filter(_path="/path/").db, 'default')
+        finally:
+            Coverage._meta.read_database = None
+
+    def test_read_database_sync(self):
+        """ Checks that syncing model instance metadata ignores a replica
+            which hasn't caught up, and only writes to the primary database.
+        """
+        from rollyourown.seo import db, base
+        InstanceMetadata = Coverage._meta.get_model('modelinstance')
+        old_path = self.page.get_absolute_url()
+        Page.objects.filter(pk=self.page.pk).update(type="moved")
+        page = Page.objects.get(pk=self.page.pk)
+        new_path = page.get_absolute_url()
+        # The replica still has the metadata at the new path, the primary doesn't
+        InstanceMetadata.objects.filter(_object_id=page.pk, _content_type=self.page_content_type).update(_path=old_path)
+        stale = InstanceMetadata.objects.get(_object_id=page.pk, _content_type=self.page_content_type)
+        stale._path = new_path
+        db.bulk_insert(InstanceMetadata, [stale], using='replica')
+        Coverage._meta.read_database = 'replica'
+        try:
+            db._last_write.time = 0
+            base._sync_instance_metadata(InstanceMetadata, self.page_content_type, page, new_path, None, None, False)
+            self.assertEqual(InstanceMetadata.objects.get(pk=stale.pk)._path, new_path)
+        finally:
+            Coverage._meta.read_database = None
+            InstanceMetadata.objects.using('replica').all().delete()
+
+    def test_concurrent_lookups(self):
+        """ Checks that concurrent backend lookups find the same metadata.
+            The in-memory test database can't be shared between threads,
+            so the lookups read from a copy in the replica's file.
+        """
+        from django.db import connections, transaction
+        from rollyourown.seo import db, base
+        paths = ["/path/", self.page.get_absolute_url(), self.product.get_absolute_url(), "/my/view/text/"]
+        expected = [unicode(seo_get_metadata(path, name="Coverage")) for path in paths]
+        copied = [ContentType, Page, Product, Category] + Coverage._meta.models.values()
+        for model in copied:
+            for obj in model._default_manager.all():
+                obj.save_base(using='replica', force_insert=True)
+        transaction.commit_unless_managed(using='replica')
+
+        jobs = []
+        def submit(*args, **kwargs):
+            jobs.append(original(*args, **kwargs))
+            return jobs[-1]
+        original = base.lookup_pool.submit
+        base.lookup_pool.submit = submit
+        Coverage._meta.read_database = 'replica'
+        Coverage._meta.concurrent_lookups = True
+        try:
+            db._last_write.time = 0
+            self.assertEqual([unicode(seo_get_metadata(path, name="Coverage")) for path in paths], expected)
+        finally:
+            Coverage._meta.concurrent_lookups = False
+            Coverage._meta.read_database = None
+            base.lookup_pool.submit = original
+            cursor = connections['replica'].cursor()
+            for model in copied:
+                cursor.execute("DELETE FROM %s" % model._meta.db_table)
+            transaction.commit_unless_managed(using='replica')
+        # The lookups were made by the pool, not again in this thread
+        self.assertTrue(jobs)
+        self.assertEqual([job.error for job in jobs if job.error], [])
+
+    def test_concurrent_lookups_after_write(self):
+        " Checks that lookups made by the pool read what this thread has just written. "
+        from rollyourown.seo import db, base
+        aliases = []
+        def submit(func, model, using, *args):
+            aliases.append(using)
+            return original(func, model, using, *args)
+        original, can_query_from_threads = base.lookup_pool.submit, base.can_query_from_threads
+        base.lookup_pool.submit, base.can_query_from_threads = submit, lambda model: True
+        Coverage._meta.read_database = 'replica'
+        Coverage._meta.concurrent_lookups = True
+        try:
+            self.path_metadata.title = "Just written"
+            self.path_metadata.save()
+            self.assertEqual(seo_get_metadata("/path/", name="Coverage").title.value, "Just written")
+            self.assertEqual(set(aliases), set([None]))
+            del aliases[:]
+            db._last_write.time = 0
+            list(Coverage._get_instances("/path/"))
+            self.assertEqual(set(aliases), set(['replica']))
+        finally:
+            Coverage._meta.concurrent_lookups = False
+            Coverage._meta.read_database = None
+            base.lookup_pool.submit, base.can_query_from_threads = original, can_query_from_threads
+
+    def test_worker_pool(self):
+        " Checks that a worker pool runs jobs in the background, passing on results and errors. "
+        from rollyourown.seo.utils import WorkerPool, PoolTimeout
+        import threading
+        pool = WorkerPool(2)
+        self.assertEqual(pool.submit(lambda a, b: a + b, 1, b=2).get(1), 3)
+        self.assertRaises(ZeroDivisionError, pool.submit(lambda: 1 / 0).get, 1)
+        self.assertNotEqual(pool.submit(threading.currentThread).get(1), threading.currentThread())
+        event = threading.Event()
+        job = pool.submit(event.wait)
+        self.assertRaises(PoolTimeout, job.get, 0.01)
+        event.set()
+        job.get(1)
+
+        # A worker carries on after failing to end a transaction
+        from django.db.backends import BaseDatabaseWrapper
+        def broken_rollback(self):
+            raise Exception("Connection lost")
+        pool = WorkerPool(1)
+        original = BaseDatabaseWrapper.rollback_unless_managed
+        BaseDatabaseWrapper.rollback_unless_managed = broken_rollback
+        try:
+            pool.submit(lambda: None).get(1)
+        finally:
+            BaseDatabaseWrapper.rollback_unless_managed = original
+        self.assertEqual(pool.submit(lambda: 1).get(1), 1)
+
+    def test_concurrent_lookup_fallback(self):
+        " Checks that lookups which fail or take too long in the background are done straight away. "
+        from rollyourown.seo import base
+        from rollyourown.seo.utils import Job
+        import threading
+        expected = unicode(seo_get_metadata("/path/", name="Coverage"))
+        def failing_job(func, *args, **kwargs):
+            job = Job(lambda: 1 / 0, (), {})
+            job.run()
+            return job
+        def slow_job(func, *args, **kwargs):
+            return Job(threading.Event().wait, (), {})
+        original = base.lookup_pool.submit, base.can_query_from_threads, base.LOOKUP_TIMEOUT
+        Coverage._meta.concurrent_lookups = True
+        base.can_query_from_threads = lambda model: True
+        base.LOOKUP_TIMEOUT = 0.01
+        try:
+            for submit in (failing_job, slow_job):
+                base.lookup_pool.submit = submit
+                self.assertEqual(unicode(seo_get_metadata("/path/", name="Coverage")), expected)
+        finally:
+            Coverage._meta.concurrent_lookups = False
+            base.lookup_pool.submit, base.can_query_from_threads, base.LOOKUP_TIMEOUT = original
+
+    def test_lazy_seo_models(self):
+        " Checks that seo_models are only looked up when needed, and setup is timed. "
+        from rollyourown.seo.options import Options
+        from rollyourown.seo.utils import startup_timings
+        options = Options({'seo_models': ('userapp.page', 'userapp.missing')})
+        self.assertEqual(options._seo_models, None)
+
+        # Nothing is kept while apps are still loading
+        from rollyourown.seo import options as options_module
+        original = options_module.app_cache_ready
+        options_module.app_cache_ready = lambda: False
+        try:
+            self.assertEqual(options.seo_models, [Page])
+            self.assertEqual(options._seo_models, None)
+        finally:
+            options_module.app_cache_ready = original
+
+        self.assertEqual(options.seo_models, [Page])
+        self.assertEqual(options._seo_models, [Page])
+        self.assert_(options.is_seo_model(Page))
+        self.assert_(not options.is_seo_model(Product))
+
+        report = startup_timings.report()
+        self.assert_('Metadata Coverage' in report)
+        self.assert_('import userapp.seo' in report)
+
+    def test_signals_per_sender(self):
+        " Checks that signals are only connected for the models in seo_models. "
+        from django.db.models import signals
+        keys = [key for key, receiver in signals.post_save.receivers]
+        self.assert_((('Coverage', 'userapp', 'Page'), id(Page)) in keys)
+        self.assert_((('WithRedirect', 'userapp', 'Page'), id(Page)) in keys)
+        self.assert_((('WithRedirect', 'userapp', 'Product'), id(Product)) not in keys)
+        self.assert_(not [key for key in keys if key[1] == id(Site)])
+
     def test_delete_object(self):
         """ Tests that an object can be deleted, and the metadata is deleted with it. """
         num_metadata = Coverage._meta.get_model('modelinstance').objects.all().count()
@@ -489,6 +984,16 @@ class Formatting(TestCase):
 <meta name="author" content="seo" />"""
         assert unicode(self.metadata).strip() == exp.strip(), "Incorrect html:\n" + unicode(self.metadata) + "\n\n" + unicode(exp)
 
+    def test_head_renderer(self):
+        """ Checks that the head, rendered from the fields worked out in advance,
+            matches the fields rendered one at a time.
+        """
+        self.assertEqual([f for f, e in Coverage._meta.head_elements], 
+                         [f for f, e in Coverage._meta.elements.items() if e.head])
+        self.assertEqual(unicode(self.metadata), u'\n'.join(unicode(getattr(self.metadata, f)) 
+                                            for f, e in Coverage._meta.elements.items() if e.head))
+        self.assertEqual(self.metadata.advanced, u'\n'.join([unicode(self.metadata.raw1), unicode(self.metadata.raw2)]))
+
     def test_description(self):
         """ Tests the tag2 is cleaned correctly. """
         exp = "A   description with &quot; interesting&#39; chars."
@@ -589,6 +1094,19 @@ class Formatting(TestCase):
         self.assertEqual(unicode(metadata.raw2), exp)
 
 
+    def test_sanitizer(self):
+        """ Checks the precompiled sanitizers of each field, and some corner cases. """
+        from rollyourown.seo.utils import get_sanitizer
+        from rollyourown.seo.fields import VALID_INLINE_TAGS
+        from django.utils.safestring import mark_safe
+        self.assert_(Coverage._meta.elements['title'].sanitize is get_sanitizer(VALID_INLINE_TAGS))
+        sanitize = get_sanitizer(['b', 'a'])
+        self.assertEqual(sanitize(u'<b title="&\'">x</b> & <i>'), u'<b title="&&#39;">x</b> &amp; &lt;i&gt;')
+        self.assertEqual(sanitize(u'<!--> <!---> -->'), u'<!--> <!---> -->')
+        self.assertEqual(sanitize(u'<a <!-- >'), u'<a <!-- >')
+        self.assertEqual(sanitize(mark_safe(u'&lt;b&gt;safe &amp; sound&lt;/b&gt;')), u'<b>safe &amp; sound</b>')
+        self.assertEqual(get_sanitizer(None)(u'<b>'), u'&lt;b&gt;')
+
 class Definition(TransactionTestCase):
     """ Definition (System tests)
         + if "head" is True, tag is automatically included in the head
@@ -675,6 +1193,33 @@ class MetaOptions(TestCase):
             self.assertEqual(cache.get('rollyourown.seo.WithCache.%s.title' % hexpath), "1234")
             self.assertEqual(cache.get('rollyourown.seo.WithCache.%s.subtitle' % hexpath), "")
 
+    def test_use_cache_context(self):
+        """ Checks that values depending on the view's context are cached as
+            templates, and rendered again for each context.
+        """
+        from django.template import Context
+        WithCache._meta.get_model('view').objects.create(_view="", subtitle="{{ product }} page")
+        path = '/context/'
+        metadata = seo_get_metadata(path, name="WithCache", context=Context({'product': 'Mug'}))
+        self.assertEqual(metadata.subtitle.value, "Mug page")
+        self.assertTrue("<title>1234</title>" in unicode(metadata))
+
+        if 'dummy' not in settings.CACHE_BACKEND:
+            hexpath = md5_constructor(iri_to_uri(path)).hexdigest()
+            self.assertEqual(cache.get('rollyourown.seo.WithCache.%s.title' % hexpath), "1234")
+            self.assertEqual(cache.get('rollyourown.seo.WithCache.%s.subtitle' % hexpath), ('view', "{{ product }} page"))
+            # The head depends on the context, so isn't cached as a whole
+            self.assertEqual(cache.get('rollyourown.seo.WithCache.%s' % hexpath), None)
+
+        metadata = seo_get_metadata(path, name="WithCache", context=Context({'product': 'Cup'}))
+        self.assertEqual(metadata.subtitle.value, "Cup page")
+        self.assertTrue("<subtitle>Cup page</subtitle>" in unicode(metadata))
+
+        # Nor is the output of {% get_metadata cached %}
+        template = Template('{% load seo %}{% get_metadata WithCache for "/context/" cached 600 %}')
+        self.assertTrue("<subtitle>Mug page</subtitle>" in template.render(Context({'product': 'Mug'})))
+        self.assertTrue("<subtitle>Cup page</subtitle>" in template.render(Context({'product': 'Cup'})))
+
     def test_use_cache_site(self):
         """ Checks that the cache plays nicely with sites.
         """
@@ -865,6 +1410,106 @@ class Templates(TestCase):
         self.compilesTo('{% get_metadata WithI18n on "new-example.com" %}', unicode(metadata))
         self.compilesTo('{% get_metadata WithI18n in "example.com" %}', "")
 
+    def test_prefetched(self):
+        """ Checks that metadata looked up when the request arrived is used, 
+            unless it isn't ready in time, failed or metadata has changed since.
+        """
+        import time
+        from rollyourown.seo.utils import Job
+        from rollyourown.seo.middleware import get_request_metadata, MetadataPrefetchMiddleware
+        request = WSGIRequest({'PATH_INFO': self.path, 'REQUEST_METHOD': 'GET', 'wsgi.input': FakePayload('')})
+        # The in-memory test database can't be used from other threads
+        MetadataPrefetchMiddleware().process_request(request)
+        self.assertFalse(hasattr(request, '_seo_prefetched'))
+
+        job = Job(Coverage._prefetch_instances, (self.path,), {})
+        job.run()
+        job.started = time.time()
+        request._seo_prefetched = {(Coverage, self.path, None, None): job}
+        self.assertNumQueries(0, lambda: get_request_metadata(request, Coverage, self.path).title.value)
+        self.assertEqual(unicode(get_request_metadata(request, Coverage, self.path)), unicode(self.metadata))
+
+        # A job that doesn't finish in time is ignored
+        settings.SEO_PREFETCH_TIMEOUT = 0.01
+        try:
+            request._seo_prefetched = {(Coverage, self.path, None, None): Job(list, (), {})}
+            request._seo_prefetched.values()[0].started = time.time()
+            self.assertEqual(unicode(get_request_metadata(request, Coverage, self.path)), unicode(self.metadata))
+        finally:
+            del settings.SEO_PREFETCH_TIMEOUT
+
+        # As is one started before metadata was changed
+        job = Job(list, (), {})
+        job.run()
+        job.started = time.time() - 60
+        request._seo_prefetched = {(Coverage, self.path, None, None): job}
+        self.assertEqual(unicode(get_request_metadata(request, Coverage, self.path)), unicode(self.metadata))
+
+        # And one that failed
+        request = WSGIRequest({'PATH_INFO': self.path, 'REQUEST_METHOD': 'GET', 'wsgi.input': FakePayload('')})
+        job = Job(lambda: 1 / 0, (), {})
+        job.run()
+        job.started = time.time()
+        request._seo_prefetched = {(Coverage, self.path, None, None): job}
+        self.assertEqual(unicode(get_request_metadata(request, Coverage, self.path)), unicode(self.metadata))
+
+    def test_bound_when_parsed(self):
+        """ Checks that the metadata definition is found when the template is
+            parsed, and that unknown names are only reported when rendering.
+        """
+        from rollyourown.seo.templatetags.seo import MetadataNode
+        node = Template("{% load seo %}{% get_metadata Coverage %}").nodelist.get_nodes_by_type(MetadataNode)[0]
+        self.assertEqual(node.metadata, Coverage)
+        self.assertEqual(node.target, None)
+
+        template = Template("{% load seo %}{% get_metadata Missing %}")
+        self.assertEqual(template.nodelist.get_nodes_by_type(MetadataNode)[0].metadata, None)
+        self.assertRaises(TemplateSyntaxError, template.render, Context({'request': WSGIRequest({'PATH_INFO': self.path,
+                                'REQUEST_METHOD': 'GET', 'wsgi.input': FakePayload('')})}))
+
+        # Other problems are not hidden
+        self.assertRaises(TemplateSyntaxError, Template, "{% load seo %}{% get_metadata %}")
+
+    def test_context_processor(self):
+        """ Checks that the context processor doesn't look anything up until
+            the metadata is used, and shares the lookup with the template tag.
+        """
+        from rollyourown.seo.context_processors import metadata
+        self.deregister_alternatives()
+        request = WSGIRequest({'PATH_INFO': self.path, 'REQUEST_METHOD': 'GET', 'wsgi.input': FakePayload('')})
+        self.assertNumQueries(0, lambda: metadata(request))
+        context = metadata(request)
+        self.assertEqual(context['metadata'].title.value, "A Title")
+        self.assertEqual(unicode(context['metadata']), unicode(self.metadata))
+
+        # The template tag uses the metadata already looked up
+        template = Template("{% load seo %}{% get_metadata %}")
+        self.assertNumQueries(0, lambda: template.render(Context({'request': request})))
+        self.assertEqual(template.render(Context({'request': request})), unicode(self.metadata))
+
+        # Unless it has changed since
+        Coverage._meta.get_model('path').objects.filter(_path=self.path).update(title="Another Title")
+        Coverage._meta.get_model('path').objects.get(_path=self.path).save()
+        self.assertEqual(metadata(request)['metadata'].title.value, "Another Title")
+
+    def test_cached(self):
+        """ Checks that the output can be cached, until metadata is written.
+            Will only work if cache backend is not dummy.
+        """
+        self.deregister_alternatives()
+        self.assertRaises(TemplateSyntaxError, Template, "{% load seo %}{% get_metadata cached 600 as var %}")
+        self.compilesTo("{% get_metadata cached 600 %}", unicode(self.metadata))
+
+        if 'dummy' not in settings.CACHE_BACKEND:
+            self.assertNumQueries(0, lambda: self.compilesTo("{% get_metadata cached 600 %}", unicode(self.metadata)))
+
+            # Writing metadata starts a new generation
+            instance = Coverage._meta.get_model('path').objects.get(_path=self.path)
+            instance.title = "Another Title"
+            instance.save()
+            self.assertTrue("Another Title" in unicode(get_metadata(path=self.path)))
+            self.compilesTo("{% get_metadata cached 600 %}", unicode(get_metadata(path=self.path)))
+
     def compilesTo(self, input, expected_output):
         """ Asserts that the given template string compiles to the given output. 
         """
@@ -945,6 +1590,22 @@ class Random(TestCase):
         if not Metadata.objects.all():
             self.fail("No metadata objects created.")
 
+    def test_syncdb_deferred_populate(self):
+        " Checks that population can be left to the populate_metadata command. "
+        from rollyourown.seo.management import _syncdb_handler
+        Metadata = Coverage._meta.get_model('modelinstance')
+        Metadata.objects.all().delete()
+
+        settings.SEO_DEFER_POPULATE = True
+        try:
+            _syncdb_handler(None, [Metadata], verbosity=0)
+        finally:
+            del settings.SEO_DEFER_POPULATE
+        self.assertEqual(Metadata.objects.count(), 0)
+
+        _syncdb_handler(None, [Metadata], verbosity=0)
+        self.assertEqual(Metadata.objects.get(_content_type=self.content_type, _object_id=self.page.id)._path, self.page.get_absolute_url())
+
     def remove_seo_tables(self):
         from django.core.management.sql import sql_delete
         from django.db import connection
@@ -982,6 +1643,269 @@ class Random(TestCase):
         if full_metadata < existing_metadata:
             self.fail("No metadata objects created.")
 
+    def test_bulk_delete(self):
+        " Checks that deleting a queryset removes the metadata for every object. "
+        for page_type in ("bulk-1", "bulk-2", "bulk-3"):
+            Page.objects.create(type=page_type)
+        num_metadata = self.Metadata.objects.count()
+        Page.objects.filter(type__startswith="bulk-").delete()
+        self.assertEqual(self.Metadata.objects.count(), num_metadata - 3)
+        self.assertEqual(self.Metadata.objects.filter(_path__startswith="/pages/bulk-").count(), 0)
+
+    def test_failed_delete(self):
+        " Checks that a delete which fails after its pre_delete signals doesn't remove metadata later. "
+        from django.db.models import signals
+        page = Page.objects.create(type="failed-delete")
+        # The object is marked for removal, but never deleted
+        signals.pre_delete.send(sender=Page, instance=page, using='default')
+        Page.objects.create(type="deleted").delete()
+        self.assertEqual(self.Metadata.objects.filter(_content_type=self.content_type, _object_id=page.id).count(), 1)
+
+    def test_management_sweep(self):
+        " Checks that sweep_metadata removes metadata for objects deleted without signals. "
+        from django.db import connection
+        num_metadata = self.Metadata.objects.count()
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s WHERE id = %%s" % Page._meta.db_table, [self.page.id])
+
+        call_command('sweep_metadata', dry_run=True, verbosity=0)
+        self.assertEqual(self.Metadata.objects.count(), num_metadata)
+
+        call_command('sweep_metadata', verbosity=0)
+        self.assertEqual(self.Metadata.objects.count(), num_metadata - 1)
+        self.assertEqual(self.Metadata.objects.filter(_content_type=self.content_type, _object_id=self.page.id).count(), 0)
+
+    def test_management_populate_conflict(self):
+        " Checks that populate_metadata leaves paths used by other objects to their current owner. "
+        Page.objects.create(type="populate-1")
+        Page.objects.create(type="populate-2")
+        self.Metadata.objects.all().delete()
+        # A stale entry for another object, holding a path of one of the pages
+        self.Metadata.objects.create(_content_object=self.page, _path="/pages/populate-1/", title="Stale")
+        self.Metadata.objects.filter(_content_type=self.content_type, _object_id=self.page.id).update(_path="/pages/populate-1/")
+
+        call_command('populate_metadata')
+
+        for page in Page.objects.all():
+            metadata = self.Metadata.objects.get(_content_type=self.content_type, _object_id=page.id)
+            self.assertEqual(metadata._path, page.get_absolute_url())
+        self.assertEqual(self.Metadata.objects.get(_content_type=self.content_type, _object_id=self.page.id).title, "Stale")
+
+    def test_management_export_import(self):
+        " Checks that metadata survives a round trip through export_metadata and import_metadata. "
+        import os, tempfile
+        PathMetadata = Coverage._meta.get_model('path')
+        PathMetadata.objects.create(_path="/export/1/", title="Export 1", keywords="one, two")
+        PathMetadata.objects.create(_path="/export/2/", title=u"Export \u00fc")
+        self.model_metadata.title = "Instance title"
+        self.model_metadata.save()
+
+        for format in ('jsonl', 'csv'):
+            handle, path_file = tempfile.mkstemp(suffix='.' + format)
+            handle, instance_file = tempfile.mkstemp(suffix='.' + format)
+            try:
+                call_command('export_metadata', 'Coverage', 'path', output=path_file, format=format)
+                call_command('export_metadata', 'Coverage', 'modelinstance', output=instance_file, format=format)
+
+                PathMetadata.objects.filter(_path="/export/1/").delete()
+                PathMetadata.objects.filter(_path="/export/2/").update(title="Changed")
+                self.Metadata.objects.filter(pk=self.model_metadata.pk).update(title="Changed")
+
+                call_command('import_metadata', 'Coverage', 'path', path_file, verbosity=0)
+                call_command('import_metadata', 'Coverage', 'modelinstance', instance_file, verbosity=0)
+            finally:
+                os.remove(path_file)
+                os.remove(instance_file)
+
+            self.assertEqual(PathMetadata.objects.get(_path="/export/1/").keywords, "one, two")
+            self.assertEqual(PathMetadata.objects.get(_path="/export/2/").title, u"Export \u00fc")
+            self.assertEqual(PathMetadata.objects.filter(_path__startswith="/export/").count(), 2)
+            self.assertEqual(self.Metadata.objects.get(pk=self.model_metadata.pk).title, "Instance title")
+
+    def test_import_partial_rows(self):
+        " Checks that importing some of the columns leaves the others alone, and that sites move by domain. "
+        from rollyourown.seo.transfer import import_rows, export_rows
+        PathMetadata = Coverage._meta.get_model('path')
+        PathMetadata.objects.create(_path="/partial/", title="Partial", keywords="one, two")
+        self.assertEqual(import_rows(PathMetadata, [{'_path': "/partial/", 'title': "Imported"}]), (0, 1, 0))
+        metadata = PathMetadata.objects.get(_path="/partial/")
+        self.assertEqual(metadata.title, "Imported")
+        self.assertEqual(metadata.keywords, "one, two")
+
+        SitesMetadata = WithSites._meta.get_model('path')
+        site = Site.objects.create(domain="transfer.example.com", name="Transfer")
+        SitesMetadata.objects.create(_path="/partial/", _site=site, title="Site title")
+        rows = list(export_rows(SitesMetadata))
+        self.assertEqual(rows[0]['_site'], "transfer.example.com")
+        SitesMetadata.objects.all().delete()
+        self.assertEqual(import_rows(SitesMetadata, rows), (1, 0, 0))
+        self.assertEqual(SitesMetadata.objects.get(_path="/partial/")._site, site)
+
+    def test_management_diff(self):
+        " Checks that diff_metadata only exports the rows that changed since the checksums were saved. "
+        import os, shutil, tempfile
+        PathMetadata = Coverage._meta.get_model('path')
+        for i in range(20):
+            PathMetadata.objects.create(_path="/diff/%d/" % i, title="Diff %d" % i)
+
+        directory = tempfile.mkdtemp()
+        try:
+            checksums = os.path.join(directory, 'checksums.json')
+            call_command('diff_metadata', 'Coverage', save_checksums=checksums)
+            PathMetadata.objects.filter(_path="/diff/3/").update(title="Changed")
+            call_command('diff_metadata', 'Coverage', checksums=checksums, output_dir=directory, verbosity=0)
+
+            self.assertEqual(sorted(os.listdir(directory)), ['Coverage.path.jsonl', 'checksums.json'])
+            from rollyourown.seo.transfer import read_rows
+            rows = list(read_rows(open(os.path.join(directory, 'Coverage.path.jsonl')), 'jsonl'))
+            self.assertTrue(0 < len(rows) < 20)
+            self.assertTrue("Changed" in [row['title'] for row in rows])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_checksum_ranges(self):
+        " Checks that rows in ranges of natural keys can be compared, without reading the rest of the table. "
+        from rollyourown.seo.transfer import table_checksums, mismatched_buckets, bucket_rows
+        PathMetadata = Coverage._meta.get_model('path')
+        for i in range(20):
+            PathMetadata.objects.create(_path="/range/%02d/" % i, title="Range %d" % i)
+        total = PathMetadata.objects.count()
+
+        checksums = table_checksums(PathMetadata, buckets=5)
+        self.assertEqual(len(checksums['buckets']), len(checksums['boundaries']) + 1)
+        PathMetadata.objects.filter(_path="/range/07/").update(title="Changed")
+        selected = mismatched_buckets(checksums, table_checksums(PathMetadata, boundaries=checksums['boundaries']))
+        self.assertEqual(len(selected), 1)
+        rows = list(bucket_rows(PathMetadata, checksums['boundaries'], selected))
+        self.assertTrue(0 < len(rows) < total)
+        self.assertTrue("Changed" in [row['title'] for row in rows])
+        self.assertEqual(len(list(bucket_rows(PathMetadata, checksums['boundaries'], range(len(checksums['buckets']))))), total)
+
+        # Content types are ordered by their natural key
+        InstanceMetadata = Coverage._meta.get_model('modelinstance')
+        for page_type in ("range-1", "range-2", "range-3"):
+            Page.objects.create(type=page_type)
+        checksums = table_checksums(InstanceMetadata, buckets=2)
+        self.assertEqual(mismatched_buckets(checksums, table_checksums(InstanceMetadata, boundaries=checksums['boundaries'])), set())
+        self.assertTrue(checksums['boundaries'])
+        self.assertEqual(sum(len(list(bucket_rows(InstanceMetadata, checksums['boundaries'], [i])))
+                                for i in range(len(checksums['buckets']))), InstanceMetadata.objects.count())
+
+    def test_bulk_metadata(self):
+        " Checks that metadata looked up in bulk is the same as when looked up one path at a time. "
+        PathMetadata = Coverage._meta.get_model('path')
+        PathMetadata.objects.create(_path="/bulk/", title="Bulk title")
+        paths = [self.model_metadata._path, "/bulk/", "/missing/"]
+        results = list(get_bulk_metadata(paths, name="Coverage"))
+        self.assertEqual([path for path, metadata in results], paths)
+        for path, metadata in results:
+            expected = seo_get_metadata(path, name="Coverage")
+            self.assertEqual(metadata.title.value, expected.title.value)
+            self.assertEqual(unicode(metadata), unicode(expected))
+
+    def test_bulk_metadata_compact(self):
+        " Checks that compact bulk metadata holds only values, and backend rows share a Metadata instance. "
+        PathMetadata = WithCache._meta.get_model('path')
+        PathMetadata.objects.create(_path="/compact/", subtitle="Compact <b>subtitle</b>")
+        PathMetadata.objects.create(_path="/compact2/", title="Compact title")
+        rows = list(PathMetadata.objects.all())
+        self.assert_(rows[0]._metadata is rows[1]._metadata is WithCache._meta.instance)
+
+        paths = ["/compact/", "/compact2/", "/missing/"]
+        results = list(get_bulk_metadata(paths, name="WithCache", compact=True))
+        for (path, metadata), (path2, expected) in zip(results, get_bulk_metadata(paths, name="WithCache")):
+            self.assertEqual(path, path2)
+            self.assertEqual(list(metadata._FormattedMetadata__instances_cache[0].values), 
+                             [expected._resolve_value(name) for name in WithCache._meta.elements])
+            self.assertEqual(unicode(metadata), unicode(expected))
+            self.assertEqual(metadata.subtitle.value, expected.subtitle.value)
+
+    def test_management_warm_cache(self):
+        " Checks that the cache is filled for known paths, the most requested first. "
+        from rollyourown.seo.management import get_known_paths, parse_access_log
+        PathMetadata = WithCache._meta.get_model('path')
+        PathMetadata.objects.create(_path="/warm/")
+        PathMetadata.objects.create(_path="/popular/")
+        self.assertEqual(sorted(get_known_paths(WithCache)), [("/popular/", None), ("/warm/", None)])
+
+        log = StringIO.StringIO('127.0.0.1 - - [19/Oct/2026:10:00:00 +0000] "GET /popular/?page=2 HTTP/1.1" 200 512\n'
+                                '127.0.0.1 - - [19/Oct/2026:10:00:01 +0000] "GET /popular/ HTTP/1.1" 200 512\n'
+                                '127.0.0.1 - - [19/Oct/2026:10:00:02 +0000] "HEAD /warm/ HTTP/1.0" 200 0\n')
+        self.assertEqual(parse_access_log(log), {"/popular/": 2, "/warm/": 1})
+
+        call_command('warm_metadata_cache', 'WithCache', workers=1, verbosity=0)
+        if 'dummy' not in settings.CACHE_BACKEND:
+            hexpath = md5_constructor(iri_to_uri("/warm/")).hexdigest()
+            self.assertEqual(cache.get('rollyourown.seo.WithCache.%s.title' % hexpath), "1234")
+
+    def test_management_fragments(self):
+        " Checks that head fragments are exported, and only rendered again when their metadata changes. "
+        import os, shutil, tempfile
+        PathMetadata = WithCache._meta.get_model('path')
+        PathMetadata.objects.create(_path="/fragment/", title="Fragment title")
+        WithCache._meta.get_model('modelinstance').objects.create(_content_type=self.content_type, _object_id=self.page.id)
+        hexpath = md5_constructor(iri_to_uri("/fragment/")).hexdigest()
+
+        directory = tempfile.mkdtemp()
+        try:
+            output = StringIO.StringIO()
+            call_command('export_head_fragments', 'WithCache', output_dir=directory, workers=1, stdout=output)
+            head = open(os.path.join(directory, '%s.html' % hexpath)).read()
+            self.assertTrue('<title>Fragment title</title>' in head)
+            total = PathMetadata.objects.count() + WithCache._meta.get_model('modelinstance').objects.count()
+            self.assertEqual(output.getvalue(), "%d paths, %d rendered\n" % (total, total))
+
+            PathMetadata.objects.filter(_path="/fragment/").update(title="Changed title")
+            output = StringIO.StringIO()
+            call_command('export_head_fragments', 'WithCache', output_dir=directory, workers=1, stdout=output)
+            head = open(os.path.join(directory, '%s.html' % hexpath)).read()
+            self.assertTrue('<title>Changed title</title>' in head)
+            self.assertEqual(output.getvalue(), "%d paths, 1 rendered\n" % total)
+
+            # Changes to the object that metadata belongs to are noticed too
+            Page.objects.filter(pk=self.page.pk).update(title="Renamed page")
+            output = StringIO.StringIO()
+            call_command('export_head_fragments', 'WithCache', output_dir=directory, workers=1, stdout=output)
+            self.assertEqual(output.getvalue(), "%d paths, 1 rendered\n" % total)
+
+            filename = os.path.join(directory, 'fragments.jsonl')
+            call_command('export_head_fragments', 'WithCache', output=filename, workers=1, verbosity=0)
+            from rollyourown.seo.transfer import read_rows
+            rows = dict((row['path'], row) for row in read_rows(open(filename), 'jsonl'))
+            self.assertTrue('<title>Changed title</title>' in rows["/fragment/"]['fragments']['head'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_management_snapshot(self):
+        " Checks that metadata is read from a snapshot, and that a new snapshot is picked up. "
+        import os, shutil, tempfile
+        from rollyourown.seo import snapshot
+        from userapp.seo import WithSEOModels
+        PathMetadata = WithSEOModels._meta.get_model('path')
+        PathMetadata.objects.create(_path="/snapshot/", title="Snapshot title")
+        expected = seo_get_metadata(self.model_metadata._path, name="WithSEOModels").title.value
+
+        directory = tempfile.mkdtemp()
+        settings.SEO_SNAPSHOT_DIR = directory
+        try:
+            call_command('snapshot_metadata', 'WithSEOModels', verbosity=0)
+            snapshot._snapshots.clear()
+            PathMetadata.objects.filter(_path="/snapshot/").update(title="Changed title")
+            self.assertEqual(seo_get_metadata("/snapshot/", name="WithSEOModels").title.value, "Snapshot title")
+            self.assertEqual(seo_get_metadata(self.model_metadata._path, name="WithSEOModels").title.value,
+                             expected)
+            # Paths missing from the snapshot are looked up in the database
+            PathMetadata.objects.create(_path="/snapshot/new/", title="New title")
+            self.assertEqual(seo_get_metadata("/snapshot/new/", name="WithSEOModels").title.value, "New title")
+
+            call_command('snapshot_metadata', 'WithSEOModels', verbosity=0)
+            snapshot._snapshots.clear()
+            self.assertEqual(seo_get_metadata("/snapshot/", name="WithSEOModels").title.value, "Changed title")
+        finally:
+            del settings.SEO_SNAPSHOT_DIR
+            snapshot._snapshots.clear()
+            shutil.rmtree(directory)
+
 
 class Admin(TestCase):
 
@@ -11,6 +11,7 @@ from django.utils.text import capfirst
 
 from rollyourown.seo.utils import get_seo_content_types
 from rollyourown.seo.systemviews import get_seo_views
+from rollyourown.seo.base import _keeps_instance_rows
 
 # TODO Use groups as fieldsets
 
@@ -19,6 +20,9 @@ from rollyourown.seo.systemviews import get_seo_views
 class PathMetadataAdmin(admin.ModelAdmin):
     list_display = ('_path',)
 
+class PrefixMetadataAdmin(admin.ModelAdmin):
+    list_display = ('_prefix',)
+
 class ModelInstanceMetadataAdmin(admin.ModelAdmin):
     list_display = ('_path', '_content_type', '_object_id')
 
@@ -35,6 +39,10 @@ class SitePathMetadataAdmin(admin.ModelAdmin):
     list_display = ('_path', '_site')
     list_filter = ('_site',)
 
+class SitePrefixMetadataAdmin(admin.ModelAdmin):
+    list_display = ('_prefix', '_site')
+    list_filter = ('_site',)
+
 class SiteModelInstanceMetadataAdmin(admin.ModelAdmin):
     list_display = ('_path', '_content_type', '_object_id', '_site')
     list_filter = ('_site', '_content_type')
@@ -51,11 +59,13 @@ class SiteViewMetadataAdmin(admin.ModelAdmin):
 def register_seo_admin(admin_site, metadata_class):
     if metadata_class._meta.use_sites:
         path_admin = SitePathMetadataAdmin
+        prefix_admin = SitePrefixMetadataAdmin
         model_instance_admin = SiteModelInstanceMetadataAdmin
         model_admin = SiteModelMetadataAdmin
         view_admin = SiteViewMetadataAdmin
     else:
         path_admin = PathMetadataAdmin
+        prefix_admin = PrefixMetadataAdmin
         model_instance_admin = ModelInstanceMetadataAdmin
         model_admin = ModelMetadataAdmin
         view_admin = ViewMetadataAdmin
@@ -69,10 +79,14 @@ def register_seo_admin(admin_site, metadata_class):
     class PathAdmin(path_admin):
         form = get_path_form(metadata_class)
 
+    class PrefixAdmin(prefix_admin):
+        form = get_prefix_form(metadata_class)
+
     class ModelInstanceAdmin(model_instance_admin):
         pass
 
     _register_admin(admin_site, metadata_class._meta.get_model('path'), PathAdmin)
+    _register_admin(admin_site, metadata_class._meta.get_model('prefix'), PrefixAdmin)
     _register_admin(admin_site, metadata_class._meta.get_model('modelinstance'), ModelInstanceAdmin)
     _register_admin(admin_site, metadata_class._meta.get_model('model'), ModelAdmin)
     _register_admin(admin_site, metadata_class._meta.get_model('view'), ViewAdmin)
@@ -83,6 +97,9 @@ def _register_admin(admin_site, model, admin_class):
         Alternatively it could be used in the future to replace a previously 
         registered model.
     """
+    if model is None:
+        # This backend isn't used by the metadata definition
+        return
     try:
         admin_site.register(model, admin_class)
     except admin.sites.AlreadyRegistered:
@@ -97,8 +114,11 @@ class MetadataFormset(generic.BaseGenericInlineFormSet):
         # It's unfortunate, but necessary because we always want an instance
         # Affect on performance shouldn't be too great, because ther is only
         # ever one metadata attached
-        form.empty_permitted = False
-        form.has_changed = lambda: True
+        # Sparse metadata is only saved when something has been entered,
+        # unless the object needs a row to find its model metadata.
+        if _keeps_instance_rows(self.model, ContentType.objects.get_for_model(self.instance)):
+            form.empty_permitted = False
+            form.has_changed = lambda: True
 
         # Set a marker on this object to prevent automatic metadata creation
         # This is seen by the post_save handler, which then skips this instance.
@@ -163,6 +183,23 @@ def get_path_form(metadata_class):
     return ModelMetadataForm
 
 
+def get_prefix_form(metadata_class):
+    model_class = metadata_class._meta.get_model('prefix')
+    if model_class is None:
+        return None
+
+    # Get a list of fields, with _prefix at the start
+    important_fields = ['_prefix'] + core_choice_fields(metadata_class)
+    _fields = important_fields + fields_for_model(model_class, exclude=important_fields).keys()
+
+    class ModelMetadataForm(forms.ModelForm):
+        class Meta:
+            model = model_class
+            fields = _fields
+
+    return ModelMetadataForm
+
+
 def get_view_form(metadata_class):
     model_class = metadata_class._meta.get_model('view')
 
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import copy
+import hashlib
+
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 from django.db import models
@@ -9,10 +12,14 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.template import Template, Context
 from django.utils.datastructures import SortedDict
+from django.utils import simplejson
+from django.utils.safestring import SafeData
+from django.utils.encoding import force_unicode
 
-from rollyourown.seo.utils import resolve_to_name, NotSet, Literal
+from rollyourown.seo.utils import resolve_to_name, NotSet, Literal, PrefixTrie
+from rollyourown.seo.db import note_write, get_generation
 
-RESERVED_FIELD_NAMES = ('_metadata', '_path', '_content_type', '_object_id',
+RESERVED_FIELD_NAMES = ('_metadata', '_path', '_prefix', '_content_type', '_object_id', '_rendered',
                         '_content_object', '_view', '_site', 'objects', 
                         '_resolve_value', '_set_context', 'id', 'pk' )
 
@@ -23,16 +30,47 @@ class MetadataBaseModel(models.Model):
     class Meta:
         abstract = True
 
+    # Backends rendering values as templates, against a context that isn't
+    # known from the path alone, name themselves here (see _resolve_template)
+    _substitutes = None
+
     def __init__(self, *args, **kwargs):
         super(MetadataBaseModel, self).__init__(*args, **kwargs)
 
-        # Provide access to a class instance
+        # Provide access to a class instance, shared by all rows
         # TODO Rename to __metadata
-        self._metadata = self.__class__._metadata()
+        self._metadata = self.__class__._metadata._meta.instance
+
+        # Remember the saved path, to redirect from it if it changes.
+        # Rows that haven't been saved yet have no old path.
+        self.__saved_path = self.pk is not None and getattr(self, '_path', None) or None
+        self.__prerendered = NotSet
+
+    def save(self, *args, **kwargs):
+        if self._metadata._meta.prerender:
+            self._rendered = simplejson.dumps(self._prerender())
+            self.__prerendered = NotSet
+        super(MetadataBaseModel, self).save(*args, **kwargs)
+        note_write(self.__class__)
+        path = getattr(self, '_path', None)
+        if self._metadata._meta.use_redirect and self.__saved_path and path and path != self.__saved_path:
+            from rollyourown.seo.redirects import add_redirect
+            add_redirect(self.__saved_path, path, getattr(self, '_site', None))
+        self.__saved_path = path
+
+    def delete(self, *args, **kwargs):
+        super(MetadataBaseModel, self).delete(*args, **kwargs)
+        note_write(self.__class__)
 
     # TODO Rename to __resolve_value?
     def _resolve_value(self, name):
         """ Returns an appropriate value for the given name. """
+        return self._substitute(self._resolve_raw_value(name))
+
+    def _resolve_raw_value(self, name):
+        """ Returns the value for the given name, before any template 
+            substitutions are made.
+        """
         name = str(name)
         if name in self._metadata._meta.elements:
             element = self._metadata._meta.elements[name]
@@ -50,7 +88,7 @@ class MetadataBaseModel(models.Model):
             elif isinstance(populate_from, Literal):
                 return populate_from.value
             elif populate_from is not NotSet:
-                return self._resolve_value(populate_from)
+                return self._resolve_raw_value(populate_from)
 
         # If this is not an element, look for an attribute on metadata
         try:
@@ -65,9 +103,94 @@ class MetadataBaseModel(models.Model):
                     return value(self._metadata, self)
             return value
 
+    def _substitute(self, value):
+        """ Makes any template substitutions in the given value. """
+        return value
+
+    def _resolve_template(self, name):
+        """ Returns the value for the given name, and the template it was 
+            rendered from if it depends on a context (otherwise None).
+            The template is given as (backend name, raw value).
+        """
+        raw_value = self._resolve_raw_value(name)
+        value = self._substitute(raw_value)
+        if self._substitutes and isinstance(raw_value, basestring) and "{" in raw_value:
+            return value, (self._substitutes, raw_value)
+        return value, None
+
     def _populate_from_kwargs(self):
         return {}
 
+    def _static_value(self, name):
+        """ The value this row gives the given field, if it is always the
+            same. Values with template substitutions or from a callable 
+            populate_from are NotSet.
+        """
+        element = self._metadata._meta.elements[name]
+        value = None
+        if element.editable:
+            value = getattr(self, name)
+        if not value:
+            populate_from = element.populate_from
+            if isinstance(populate_from, Literal):
+                value = populate_from.value
+            elif isinstance(populate_from, basestring) and populate_from in self._metadata._meta.elements:
+                return self._static_value(populate_from)
+            elif populate_from is not NotSet:
+                return NotSet
+        if isinstance(value, basestring) and "{" in value:
+            return NotSet
+        return value
+
+    def _prerender(self):
+        """ Cleans and renders the values of this row that never change, 
+            for Meta.prerender. The head is included if this row provides
+            every field in it.
+        """
+        options = self._metadata._meta
+        fields = {}
+        head = []
+        for name, element in options.elements.items():
+            value = self._static_value(name)
+            if value is NotSet or not value:
+                if element.head:
+                    head = None
+                continue
+            value = unicode(value)
+            cleaned = element.clean(value)
+            fields[name] = (value, cleaned, cleaned and element.render(cleaned) or u"", isinstance(cleaned, SafeData))
+            if element.head and head is not None:
+                head.append(fields[name][2])
+        prerendered = {'version': options.prerender_version, 'source': self._prerender_source(), 'fields': fields}
+        if head is not None:
+            prerendered['head'] = u"\n".join(head)
+        return prerendered
+
+    def _prerender_source(self):
+        """ A checksum of the values _prerender works from, to notice rows
+            changed without calling save() (eg with queryset.update()).
+        """
+        checksum = hashlib.md5()
+        for name, element in self._metadata._meta.elements.items():
+            if element.editable:
+                checksum.update(repr((name, force_unicode(getattr(self, name)))))
+        return checksum.hexdigest()
+
+    def _get_prerendered(self):
+        """ The values stored by _prerender, if they are up to date with the
+            metadata definition and the row's values, or None.
+        """
+        if self.__prerendered is not NotSet:
+            return self.__prerendered
+        prerendered = None
+        if getattr(self, '_rendered', None):
+            prerendered = simplejson.loads(self._rendered)
+            if (prerendered.get('version') != self._metadata._meta.prerender_version
+                    or prerendered.get('source') != self._prerender_source()):
+                prerendered = None
+        self.__prerendered = prerendered
+        return prerendered
+
 
 class BaseManager(models.Manager):
     def on_current_site(self, site=None):
@@ -111,6 +234,9 @@ class MetadataBackend(object):
     name = None
     verbose_name = None
     unique_together = None
+    natural_key = None
+    # Set if get_instances uses the context filled in by earlier backends
+    needs_context = False
 
     class __metaclass__(type):
         def __new__(cls, name, bases, attrs):
@@ -129,13 +255,37 @@ class MetadataBackend(object):
             ut.append(tuple(ut_set))
         return tuple(ut)
 
+    def get_natural_key(self, options):
+        """ The fields identifying a row in any database, used when moving
+            metadata between environments. Defaults to the first set of 
+            unique fields.
+        """
+        natural_key = list(self.natural_key or self.unique_together[0])
+        if options.use_sites:
+            natural_key.append('_site')
+        if options.use_i18n:
+            natural_key.append('_language')
+        return tuple(natural_key)
+
+    def get_bulk_instances(self, queryset, paths, contexts):
+        """ Finds the instances for a number of paths at once, returning a 
+            dictionary of instance lists for each path. Each path has its 
+            own context.
+            By default, get_instances is simply called for each path,
+            backends should override this to use a single query.
+        """
+        return dict((path, list(self.get_instances(queryset, path, contexts[path]) or [])) for path in paths)
+
     def get_manager(self, options):
         _get_instances = self.get_instances
+        _get_bulk_instances = self.get_bulk_instances
 
         class _Manager(BaseManager):
             def get_instances(self, path, site=None, language=None, context=None):
-                queryset = self.for_site_and_language(site, language)
-                return _get_instances(queryset, path, context)
+                return _get_instances(self.for_site_and_language(site, language), path, context)
+
+            def get_bulk_instances(self, paths, site=None, language=None, contexts=None):
+                return _get_bulk_instances(self.for_site_and_language(site, language), paths, contexts)
 
             if not options.use_sites:
                 def for_site_and_language(self, site=None, language=None):
@@ -160,6 +310,9 @@ class PathBackend(MetadataBackend):
     def get_instances(self, queryset, path, context):
         return queryset.filter(_path=path)
 
+    def get_bulk_instances(self, queryset, paths, contexts):
+        return _group_by(queryset.filter(_path__in=paths), '_path')
+
     def get_model(self, options):
         class PathMetadataBase(MetadataBaseModel):
             _path = models.CharField(_('path'), max_length=255, unique=not (options.use_sites or options.use_i18n))
@@ -193,6 +346,12 @@ class ViewBackend(MetadataBackend):
             view_name = resolve_to_name(path)
         return queryset.filter(_view=view_name or "")
 
+    def get_bulk_instances(self, queryset, paths, contexts):
+        view_names = dict((path, path is not None and resolve_to_name(path) or "") for path in paths)
+        instances = _group_by(queryset.filter(_view__in=set(view_names.values())), '_view')
+        # Instances are given a context of their own, so can't be shared between paths
+        return dict((path, [copy.copy(i) for i in instances.get(view_names[path], [])]) for path in paths)
+
     def get_model(self, options):
         class ViewMetadataBase(MetadataBaseModel):
             _view = models.CharField(_('view'), max_length=255, unique=not (options.use_sites or options.use_i18n), default="", blank=True)
@@ -210,8 +369,9 @@ class ViewBackend(MetadataBackend):
             def _populate_from_kwargs(self):
                 return {'view_name': self._view}
         
-            def _resolve_value(self, name):
-                value = super(ViewMetadataBase, self)._resolve_value(name)
+            _substitutes = 'view'
+
+            def _substitute(self, value):
                 try:
                     return _resolve(value, context=self.__context)
                 except AttributeError:
@@ -231,10 +391,14 @@ class ModelInstanceBackend(MetadataBackend):
     name = "modelinstance"
     verbose_name = "Model Instance"
     unique_together = (("_path",), ("_content_type", "_object_id"))
+    natural_key = ("_content_type", "_object_id")
 
     def get_instances(self, queryset, path, context):
         return queryset.filter(_path=path)
 
+    def get_bulk_instances(self, queryset, paths, contexts):
+        return _group_by(queryset.filter(_path__in=paths), '_path')
+
     def get_model(self, options):
         class ModelInstanceMetadataBase(MetadataBaseModel):
             _path = models.CharField(_('path'), max_length=255, editable=False, unique=not (options.use_sites or options.use_i18n))
@@ -277,11 +441,21 @@ class ModelBackend(MetadataBackend):
     name = "model"
     verbose_name = "Model"
     unique_together = (("_content_type",),)
+    needs_context = True
 
     def get_instances(self, queryset, path, context):
         if context and 'content_type' in context:
             return queryset.filter(_content_type=context['content_type'])
 
+    def get_bulk_instances(self, queryset, paths, contexts):
+        content_types = dict((path, contexts[path]['content_type']) for path in paths 
+                                    if contexts[path] and 'content_type' in contexts[path])
+        if not content_types:
+            return {}
+        instances = _group_by(queryset.filter(_content_type__in=set(content_types.values())), '_content_type_id')
+        # Instances are given a context of their own, so can't be shared between paths
+        return dict((path, [copy.copy(i) for i in instances.get(ct.id, [])]) for path, ct in content_types.items())
+
     def get_model(self, options):
         class ModelMetadataBase(MetadataBaseModel):
             _content_type = models.ForeignKey(ContentType)
@@ -304,8 +478,9 @@ class ModelBackend(MetadataBackend):
             def _populate_from_kwargs(self):
                 return {'content_type': self._content_type}
         
-            def _resolve_value(self, name):
-                value = super(ModelMetadataBase, self)._resolve_value(name)
+            _substitutes = 'model'
+
+            def _substitute(self, value):
                 try:
                     return _resolve(value, self.__instance._content_object)
                 except AttributeError:
@@ -327,6 +502,240 @@ class ModelBackend(MetadataBackend):
             raise Exception("Metadata backend 'modelinstance' must be installed in order to use 'model' backend")
 
 
+class PrefixBackend(MetadataBackend):
+    """ Metadata for every path starting with a given prefix, such as the 
+        defaults for a section of the site. All prefixes that match are used,
+        the longest (most specific) first.
+
+        Prefixes are held in memory, in a trie, which is rebuilt when prefix
+        metadata is saved or deleted. Other processes are told about changes
+        through the cache, by the generation every write to the metadata
+        definition starts (including bulk imports and deletes).
+    """
+    name = "prefix"
+    verbose_name = "Prefix"
+    unique_together = (("_prefix",),)
+
+    def get_instances(self, find, path, context):
+        return find(path)
+
+    def get_bulk_instances(self, find, paths, contexts):
+        return dict((path, find(path)) for path in paths)
+
+    def get_manager(self, options):
+        _get_instances = self.get_instances
+        _get_bulk_instances = self.get_bulk_instances
+
+        class _Manager(BaseManager):
+            # The trie and its generation, shared with copies made by db_manager()
+            _built = {}
+
+            def contribute_to_class(self, model, name):
+                super(_Manager, self).contribute_to_class(model, name)
+                if not model._meta.abstract:
+                    models.signals.post_save.connect(self._changed, sender=model, weak=False)
+                    models.signals.post_delete.connect(self._changed, sender=model, weak=False)
+
+            def _changed(self, **kwargs):
+                # Other processes see the new generation, started by note_write
+                self._built.clear()
+
+            def get_trie(self):
+                """ The trie of all prefixes, rebuilt if anything has changed. """
+                generation = get_generation(self.model._metadata)
+                if 'trie' not in self._built or generation != self._built['generation']:
+                    trie = PrefixTrie()
+                    # The database is chosen by the caller, see _read_manager
+                    for instance in self.get_query_set():
+                        trie.add(instance._prefix, instance)
+                    self._built.update(trie=trie, generation=generation)
+                return self._built['trie']
+
+            def get_instances(self, path, site=None, language=None, context=None):
+                return _get_instances(self.for_site_and_language(site, language), path, context)
+
+            def get_bulk_instances(self, paths, site=None, language=None, contexts=None):
+                return _get_bulk_instances(self.for_site_and_language(site, language), paths, contexts)
+
+            def for_site_and_language(self, site=None, language=None):
+                """ Returns a function finding the instances for a path, which
+                    apply to the given site and language. No queries are made
+                    unless the trie needs to be rebuilt.
+                """
+                trie = self.get_trie()
+                if options.use_sites:
+                    if isinstance(site, Site):
+                        site = site.id
+                    elif site is not None:
+                        site = Site.objects.get(domain=site).id
+                    else:
+                        site = settings.SITE_ID
+                def find(path):
+                    instances = trie.find(path)
+                    if options.use_sites:
+                        instances = [i for i in instances if i._site_id in (None, site)]
+                    if language and options.use_i18n:
+                        instances = [i for i in instances if i._language == language]
+                    return instances
+                return find
+        return _Manager
+
+    def get_model(self, options):
+        class PrefixMetadataBase(MetadataBaseModel):
+            _prefix = models.CharField(_('path prefix'), max_length=255, unique=not (options.use_sites or options.use_i18n),
+                                help_text=_("Applies to every path starting with this, unless a longer prefix matches."))
+            if options.use_sites:
+                _site = models.ForeignKey(Site, null=True, blank=True, verbose_name=_("site"))
+            if options.use_i18n:
+                _language = models.CharField(_("language"), max_length=5, null=True, blank=True, db_index=True, choices=settings.LANGUAGES)
+            objects = self.get_manager(options)()
+
+            def __unicode__(self):
+                return self._prefix
+
+            def _populate_from_kwargs(self):
+                return {'prefix': self._prefix}
+
+            class Meta:
+                abstract = True
+                unique_together = self.get_unique_together(options)
+
+        return PrefixMetadataBase
+
+
+class StaticBackend(MetadataBackend):
+    """ Metadata kept in a JSON or YAML file (eg under version control), 
+        instead of the database. The file is read once, when the metadata
+        definition is loaded, and is given by Meta.static_file.
+
+        The file holds a dictionary of field values for each path, or a list
+        of field values, each with a "_path". Values may be limited to a 
+        language with "_language", or a site with "_site" (the domain).
+    """
+    name = "static"
+    verbose_name = "Static"
+    unique_together = (("_path",),)
+
+    def get_instances(self, rows, path, context):
+        return rows.get(path)
+
+    def get_bulk_instances(self, rows, paths, contexts):
+        return dict((path, rows[path]) for path in paths if path in rows)
+
+    def get_manager(self, options):
+        _get_instances = self.get_instances
+        _get_bulk_instances = self.get_bulk_instances
+        # Mistakes in the file are reported now, rather than on a page
+        fields = [name for name, element in options.elements.items() if element.editable] + ['_path']
+        if options.use_sites:
+            fields.append('_site')
+        if options.use_i18n:
+            fields.append('_language')
+        static_rows = options.static_file and load_static_rows(options.static_file, fields) or []
+
+        class _Manager(models.Manager):
+            # The instances and the index for each site and language, shared
+            # with copies made by db_manager()
+            _built = {}
+
+            def get_instances(self, path, site=None, language=None, context=None):
+                return _get_instances(self.for_site_and_language(site, language), path, context)
+
+            def get_bulk_instances(self, paths, site=None, language=None, contexts=None):
+                return _get_bulk_instances(self.for_site_and_language(site, language), paths, contexts)
+
+            def for_site_and_language(self, site=None, language=None):
+                """ Lists the instances for each path, which apply to the given
+                    site and language. No queries are made, the lists are
+                    built once for each site and language.
+                """
+                if 'instances' not in self._built:
+                    self._built['instances'] = [(row.pop('_site', None), self.model(**row)) for row in map(dict, static_rows)]
+                if options.use_sites:
+                    if isinstance(site, Site):
+                        site = site.domain
+                    elif site is None:
+                        site = Site.objects.get_current().domain
+                else:
+                    site = None
+                if not options.use_i18n:
+                    language = None
+                try:
+                    return self._built[(site, language)]
+                except KeyError:
+                    pass
+                rows = {}
+                for row_site, instance in self._built['instances']:
+                    if language and instance._language != language:
+                        continue
+                    if options.use_sites and row_site not in (None, site):
+                        continue
+                    rows.setdefault(instance._path, []).append(instance)
+                self._built[(site, language)] = rows
+                return rows
+        return _Manager
+
+    def get_model(self, options):
+        class StaticMetadataBase(MetadataBaseModel):
+            _path = models.CharField(_('path'), max_length=255)
+            if options.use_i18n:
+                _language = models.CharField(_("language"), max_length=5, null=True, blank=True, choices=settings.LANGUAGES)
+            objects = self.get_manager(options)()
+
+            def __unicode__(self):
+                return self._path
+
+            def _populate_from_kwargs(self):
+                return {'path': self._path}
+
+            class Meta:
+                abstract = True
+                managed = False
+        return StaticMetadataBase
+
+    @staticmethod
+    def validate(options):
+        """ Validates the application of this backend to a given metadata 
+        """
+        if not options.static_file:
+            raise Exception("Meta.static_file must be given in order to use the 'static' backend")
+
+
+def load_static_rows(filename, fields=None):
+    """ Reads the rows of field values from a JSON or YAML file. If the names
+        of the fields are given, any others are reported.
+    """
+    stream = open(filename, 'rb')
+    try:
+        if filename.endswith(('.yaml', '.yml')):
+            import yaml
+            data = yaml.safe_load(stream)
+        else:
+            data = simplejson.load(stream)
+    except Exception, e:
+        raise Exception(u"Meta.static_file %s could not be read: %s" % (filename, e))
+    finally:
+        stream.close()
+    if isinstance(data, dict) and not [v for v in data.values() if not isinstance(v, dict)]:
+        data = [dict(values, _path=path) for path, values in data.items()]
+    if not isinstance(data, list) or [row for row in data if not isinstance(row, dict) or '_path' not in row]:
+        raise Exception(u"Meta.static_file %s must hold a dictionary of values for each path" % filename)
+    if fields is not None:
+        for row in data:
+            unknown = [name for name in row if name not in fields]
+            if unknown:
+                raise Exception(u'Meta.static_file %s gives unknown fields for "%s": %s'
+                                    % (filename, row['_path'], u", ".join(unknown)))
+    return data
+
+
+def _group_by(queryset, attname):
+    """ Returns a dictionary of instance lists, grouped by the given attribute. """
+    groups = {}
+    for instance in queryset:
+        groups.setdefault(getattr(instance, attname), []).append(instance)
+    return groups
+
 
 def _resolve(value, model_instance=None, context=None):
     """ Resolves any template references in the given value. 
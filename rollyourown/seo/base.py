@@ -4,9 +4,13 @@
 #    * Move/rename namespace polluting attributes
 #    * Documentation
 #    * Make backends optional: Meta.backends = (path, modelinstance/model, view)
+import time
 import hashlib
+import logging
+import threading
 
-from django.db import models
+from django.db import models, router, transaction, IntegrityError
+from django.db.models import loading
 from django.utils.translation import ugettext_lazy as _
 from django.utils.datastructures import SortedDict
 from django.utils.functional import curry
@@ -17,22 +21,33 @@ from django.utils.safestring import mark_safe
 from django.core.cache import cache
 from django.utils.encoding import iri_to_uri
 
-from rollyourown.seo.utils import NotSet, Literal
+from rollyourown.seo.utils import NotSet, Literal, WorkerPool, ResolvedRecord, startup_timings
 from rollyourown.seo.options import Options
 from rollyourown.seo.fields import MetadataField, Tag, MetaTag, KeywordTag, Raw
-from rollyourown.seo.backends import backend_registry, RESERVED_FIELD_NAMES
+from rollyourown.seo.backends import backend_registry, RESERVED_FIELD_NAMES, _resolve
+from rollyourown.seo.snapshot import get_snapshot_record
+from rollyourown.seo.db import upsert_instance_metadata, delete_instance_metadata, bulk_insert, db_for_read, note_write, can_query_from_threads, MAX_QUERY_PARAMS
 
 
 registry = SortedDict()
 
 
+class MetadataNotRegistered(Exception):
+    """ Raised when a metadata definition being looked up has not been registered. """
+
+
 class FormattedMetadata(object):
     """ Allows convenient access to selected metadata.
         Metadata for each field may be sourced from any one of the relevant instances passed.
     """
+    __slots__ = ('__metadata', '__cache_prefix', '__instances_original', '__instances_cache', '__read_cache',
+                 '__context', '__templates')
 
-    def __init__(self, metadata, instances, path, site=None, language=None):
+    def __init__(self, metadata, instances, path, site=None, language=None, context=None):
         self.__metadata = metadata
+        self.__context = context
+        # Templates of values that depend on the context, by name
+        self.__templates = {}
         if metadata._meta.use_cache:
             if metadata._meta.use_sites and site:
                 hexpath = hashlib.md5(iri_to_uri(site.domain+path)).hexdigest() 
@@ -46,6 +61,7 @@ class FormattedMetadata(object):
             self.__cache_prefix = None
         self.__instances_original = instances
         self.__instances_cache = []
+        self.__read_cache = True
 
     def __instances(self):
         """ Cache instances, allowing generators to be used and reused. 
@@ -63,7 +79,7 @@ class FormattedMetadata(object):
             This simply asks each of the instances for a value.
         """
         for instance in self.__instances():
-            value = instance._resolve_value(name)
+            value = self._resolve_instance_value(instance, name)
             if value:
                 return value
 
@@ -76,13 +92,81 @@ class FormattedMetadata(object):
             elif isinstance(populate_from, Literal):
                 return populate_from.value
             elif populate_from is not NotSet:
-                return self._resolve_value(populate_from)
+                value = self._resolve_value(populate_from)
+                if populate_from in self.__templates:
+                    self.__templates[name] = self.__templates[populate_from]
+                return value
+
+    def _resolve_instance_value(self, instance, name):
+        """ Returns the value the given instance has for the given name,
+            noting the template of any value that depends on the context.
+        """
+        resolve_template = getattr(instance, '_resolve_template', None)
+        if resolve_template is None:
+            return instance._resolve_value(name)
+        value, template = resolve_template(name)
+        if value and template is not None:
+            self.__templates[name] = template
+        return value
+
+    def _render_template(self, name, template):
+        """ Returns the value for a template cached in place of a value that
+            depends on the context. Only the view's context is known here, 
+            values depending on an object are looked up again.
+        """
+        self.__templates[name] = template
+        backend_name, value = template
+        if backend_name == 'view':
+            return _resolve(value, context=self.__context)
+        return self._resolve_value(name)
+
+    def _resolve_bound(self, name):
+        """ Returns a bound field for the given name, using the value cleaned
+            and rendered when it was saved if there is one (see Meta.prerender).
+        """
+        element = self.__metadata._meta.elements[name]
+        if self.__metadata._meta.prerender:
+            for instance in self.__instances():
+                prerendered = getattr(instance, '_get_prerendered', None)
+                prerendered = prerendered and prerendered()
+                if prerendered and name in prerendered['fields']:
+                    return BoundMetadataField(element, prerendered=prerendered['fields'][name])
+                value = self._resolve_instance_value(instance, name)
+                if value:
+                    return BoundMetadataField(element, value)
+        return BoundMetadataField(element, self._resolve_value(name))
+
+    def _render_field(self, name, element):
+        """ The html for the given field, without binding it first. """
+        if self.__metadata._meta.prerender:
+            return unicode(self._resolve_bound(name))
+        value = self._resolve_value(name)
+        if value:
+            value = element.clean(value)
+            if value:
+                return element.render(value)
+        return u""
+
+    def _get_prerendered_head(self):
+        """ The head rendered when the first instance was saved, if it 
+            provides every value in the head, or None.
+        """
+        if self.__metadata._meta.prerender:
+            for instance in self.__instances():
+                prerendered = getattr(instance, '_get_prerendered', None)
+                prerendered = prerendered and prerendered()
+                if prerendered and 'head' in prerendered:
+                    return mark_safe(prerendered['head'])
+                return None
 
     def __getattr__(self, name):
         # If caching is enabled, work out a key
         if self.__cache_prefix:
             cache_key = '%s.%s' % (self.__cache_prefix, name)
-            value = cache.get(cache_key)
+            if self.__read_cache:
+                value = cache.get(cache_key)
+            else:
+                value = None
         else:
             cache_key = None
             value = None
@@ -91,16 +175,23 @@ class FormattedMetadata(object):
         if name in self.__metadata._meta.groups:
             if value is not None:
                 return value or None
-            value = '\n'.join(unicode(BoundMetadataField(self.__metadata._meta.elements[f], self._resolve_value(f))) for f in self.__metadata._meta.groups[name]).strip()
+            elements = self.__metadata._meta.group_elements[name]
+            value = u'\n'.join([self._render_field(f, e) for f, e in elements]).strip()
+            # Only cache groups that don't depend on the context
+            if [f for f, e in elements if f in self.__templates]:
+                cache_key = None
 
         # Look for an element called "name"
         elif name in self.__metadata._meta.elements:
             if value is not None:
+                # Values depending on the context are cached as templates
+                if isinstance(value, tuple):
+                    value = self._render_template(name, value)
                 return BoundMetadataField(self.__metadata._meta.elements[name], value or None)
-            value = self._resolve_value(name)
+            bound = self._resolve_bound(name)
             if cache_key is not None:
-                cache.set(cache_key, value or '')
-            return BoundMetadataField(self.__metadata._meta.elements[name], value)
+                cache.set(cache_key, self.__templates.get(name, bound.raw_value or ''))
+            return bound
         else:
             raise AttributeError
 
@@ -111,30 +202,110 @@ class FormattedMetadata(object):
 
     def __unicode__(self):
         """ String version of this object is the html output of head elements. """
-        if self.__cache_prefix is not None:
+        if self.__cache_prefix is not None and self.__read_cache:
             value = cache.get(self.__cache_prefix)
         else:
             value = None
 
         if value is None:
-            value = mark_safe(u'\n'.join(unicode(getattr(self, f)) for f,e in self.__metadata._meta.elements.items() if e.head))
-            if self.__cache_prefix is not None:
-                cache.set(self.__cache_prefix, value or '')
+            value = self._get_prerendered_head()
+        if value is None:
+            if self.__cache_prefix is None:
+                value = mark_safe(u'\n'.join([self._render_field(f, e) for f, e in self.__metadata._meta.head_elements]))
+            else:
+                # Fill the cache for each field as well
+                value = mark_safe(u'\n'.join([unicode(getattr(self, f)) for f, e in self.__metadata._meta.head_elements]))
+                # Only cache a head that doesn't depend on the context
+                if not [f for f, e in self.__metadata._meta.head_elements if f in self.__templates]:
+                    cache.set(self.__cache_prefix, value or '')
 
         return value
 
+    def _refresh_cache(self):
+        """ Resolves every field and group afresh, replacing anything in the cache. """
+        if self.__cache_prefix is None:
+            return
+        self.__read_cache = False
+        try:
+            for name in self.__metadata._meta.elements:
+                getattr(self, name)
+            for name in self.__metadata._meta.groups:
+                getattr(self, name)
+            unicode(self)
+        finally:
+            self.__read_cache = True
+
+    def _compact(self):
+        """ Resolves every field straight away, returning metadata that holds
+            only the values, instead of the backend instances.
+        """
+        options = self.__metadata._meta
+        record = ResolvedRecord(options.element_index, tuple([self._resolve_value(name) for name in options.elements]))
+        compact = FormattedMetadata.__new__(FormattedMetadata)
+        compact.__metadata = self.__metadata
+        compact.__cache_prefix = self.__cache_prefix
+        compact.__instances_original = ()
+        compact.__instances_cache = [record]
+        compact.__read_cache = True
+        compact.__context = None
+        compact.__templates = {}
+        return compact
+
+    def _get_fingerprint(self):
+        """ A checksum of the stored values this metadata is resolved from,
+            including the object that model instance metadata belongs to
+            (used by substitutions and populate_from). Anything else a 
+            callable populate_from reads is not included.
+        """
+        checksum = hashlib.md5()
+        for instance in self.__instances():
+            checksum.update(instance.__class__.__name__)
+            for field in instance._meta.local_fields:
+                checksum.update(repr(field.value_to_string(instance)))
+            content_object = getattr(instance, '_content_object', None)
+            if content_object is not None:
+                checksum.update(content_object.__class__.__name__)
+                for field in content_object._meta.local_fields:
+                    checksum.update(repr(field.value_to_string(content_object)))
+        return checksum.hexdigest()
+
+    def _depends_on_context(self):
+        """ Checks if any value resolved so far was substituted from the
+            context, so that the output can't be reused for another one.
+        """
+        return bool(self.__templates)
+
+    def _uses_view_context(self):
+        """ Checks if any values may come from view metadata, which depend on
+            the context of the view.
+        """
+        for instance in self.__instances():
+            if getattr(instance, '_metadata_type', None) == 'view':
+                return True
+        return False
+
 
 class BoundMetadataField(object):
     """ An object to help provide templates with access to a "bound" metadata field. """
+    __slots__ = ('field', 'value', 'html', 'raw_value')
 
-    def __init__(self, field, value):
+    def __init__(self, field, value=None, prerendered=None):
         self.field = field
-        if value:
+        self.html = None
+        if prerendered is not None:
+            # Cleaned and rendered when the metadata was saved
+            value, self.value, self.html, safe = prerendered
+            if safe:
+                self.value = mark_safe(self.value)
+        elif value:
             self.value = field.clean(value)
         else:
             self.value = None
+        self.raw_value = value
 
     def __unicode__(self):
+        if self.html is not None:
+            return mark_safe(self.html)
         if self.value:
             return mark_safe(self.field.render(self.value))
         else:
@@ -149,6 +320,7 @@ class MetadataBase(type):
         # TODO: Think of a better test to avoid processing Metadata parent class
         if bases == (object,):
             return type.__new__(cls, name, bases, attrs)
+        start = time.time()
 
         # Save options as a dict for now (we will be editing them)
         # TODO: Is this necessary, should we bother relaying Django Meta options?
@@ -190,6 +362,8 @@ class MetadataBase(type):
 
         options.metadata = new_class
         new_class._meta = options
+        # Metadata instances hold nothing, so one is shared by everything
+        options.instance = new_class()
 
         # Some useful attributes
         options._update_from_name(name)
@@ -203,20 +377,88 @@ class MetadataBase(type):
         except KeyError:
             raise Exception('Metadata backend "%s" is not installed.' % backend_name)
 
+        if options.use_redirect and 'django.contrib.redirects' not in settings.INSTALLED_APPS:
+            raise Exception("django.contrib.redirects must be installed in order to use Meta.use_redirect")
+
         #new_class._meta._add_backend(PathBackend)
         #new_class._meta._add_backend(ModelInstanceBackend)
         #new_class._meta._add_backend(ModelBackend)
         #new_class._meta._add_backend(ViewBackend)
 
         registry[name] = new_class
+        startup_timings.add('Metadata %s' % name, time.time() - start)
 
         return new_class
 
 
     # TODO: Move this function out of the way (subclasses will want to define their own attributes)
-    def _get_formatted_data(cls, path, context=None, site=None, language=None):
-        """ Return an object to conveniently access the appropriate values. """
-        return FormattedMetadata(cls(), cls._get_instances(path, context, site, language), path, site, language)
+    def _get_formatted_data(cls, path, context=None, site=None, language=None, instances=None):
+        """ Return an object to conveniently access the appropriate values. 
+            Instances found ahead of time by _prefetch_instances can be given.
+        """
+        if instances is not None:
+            # Let the instances see the view's context
+            backend_context = {'view_context': context}
+            for instance in instances:
+                if hasattr(instance, '_process_context'):
+                    instance._process_context(backend_context)
+            return FormattedMetadata(cls._meta.instance, instances, path, site, language, context)
+        record = get_snapshot_record(cls, path, site, language)
+        if record is not None:
+            return FormattedMetadata(cls._meta.instance, [record], path, site, language, context)
+        return FormattedMetadata(cls._meta.instance, cls._get_instances(path, context, site, language), path, site, language, context)
+
+
+    def _prefetch_instances(cls, path, site=None, language=None):
+        """ Looks up every instance for the given path, before the view's 
+            context is known. The list can later be given to _get_formatted_data.
+        """
+        record = get_snapshot_record(cls, path, site, language)
+        if record is not None:
+            return [record]
+        return list(cls._get_instances(path, None, site, language))
+
+    def _get_linked_formatted_data(cls, obj, site=None, language=None):
+        """ Return an object to conveniently access the metadata linked from
+            the given object (its model instance and model metadata).
+        """
+        # XXX Check that 'modelinstance' and 'model' metadata are installed in backends
+        # I believe that get_model() would return None if not
+        InstanceMetadata = cls._meta.get_model('modelinstance')
+        ModelMetadata = cls._meta.get_model('model')
+        content_type = ContentType.objects.get_for_model(obj)
+        instances = []
+        if InstanceMetadata is not None:
+            try:
+                instance_md = _read_manager(InstanceMetadata).get(_content_type=content_type, _object_id=obj.pk)
+            except InstanceMetadata.DoesNotExist:
+                instance_md = InstanceMetadata(_content_object=obj)
+            instances.append(instance_md)
+        if ModelMetadata is not None:
+            try:
+                model_md = _read_manager(ModelMetadata).get(_content_type=content_type)
+            except ModelMetadata.DoesNotExist:
+                model_md = ModelMetadata(_content_type=content_type)
+            instances.append(model_md)
+        return FormattedMetadata(cls._meta.instance, instances, '', site, language)
+
+    # TODO: Move this function out of the way (subclasses will want to define their own attributes)
+    def _get_bulk_formatted_data(cls, paths, site=None, language=None):
+        """ Return objects to conveniently access the values for a number of
+            paths. Each backend is queried once for all of the given paths.
+        """
+        contexts = dict((path, {'view_context': None}) for path in paths)
+        instances = dict((path, []) for path in paths)
+
+        for model in cls._meta.models.values():
+            found = _read_manager(model).get_bulk_instances(paths, site, language, contexts)
+            for path in paths:
+                for instance in found.get(path, []):
+                    if hasattr(instance, '_process_context'):
+                        instance._process_context(contexts[path])
+                    instances[path].append(instance)
+
+        return [(path, FormattedMetadata(cls._meta.instance, instances[path], path, site, language)) for path in paths]
 
 
     # TODO: Move this function out of the way (subclasses will want to define their own attributes)
@@ -227,13 +469,48 @@ class MetadataBase(type):
         """
         backend_context = {'view_context': context }
 
-        for model in cls._meta.models.values():
-            for instance in model.objects.get_instances(path, site, language, backend_context) or []:
+        # Optionally start the queries that don't need each other's results
+        # straight away, in the background
+        jobs = {}
+        if cls._meta.concurrent_lookups:
+            for name, model in cls._meta.models.items():
+                if not backend_registry[name].needs_context and can_query_from_threads(model):
+                    jobs[name] = lookup_pool.submit(_list_instances, model, db_for_read(model), path, site, language, backend_context)
+
+        for name, model in cls._meta.models.items():
+            if name in jobs:
+                try:
+                    instances = jobs[name].get(LOOKUP_TIMEOUT)
+                except Exception:
+                    # The job is slow or failed, look up the instances here
+                    instances = _read_manager(model).get_instances(path, site, language, backend_context) or []
+            else:
+                instances = _read_manager(model).get_instances(path, site, language, backend_context) or []
+            for instance in instances:
                 if hasattr(instance, '_process_context'):
                     instance._process_context(backend_context)
                 yield instance
 
 
+# Threads for concurrent backend lookups (see Meta.concurrent_lookups)
+lookup_pool = WorkerPool(getattr(settings, 'SEO_LOOKUP_WORKERS', 4))
+# Seconds to wait for a background lookup, before doing it in the calling thread
+LOOKUP_TIMEOUT = getattr(settings, 'SEO_LOOKUP_TIMEOUT', 5)
+
+def _list_instances(model, using, path, site, language, context):
+    """ Looks up instances in another thread. The database to read from is
+        worked out by the calling thread, which knows what it has written.
+    """
+    return list(model.objects.db_manager(using).get_instances(path, site, language, context) or [])
+
+def _read_manager(model):
+    """ The manager to look up metadata for a page with, reading from
+        Meta.read_database where appropriate. Rows loaded through it are
+        saved to the same database, so writes shouldn't use it.
+    """
+    return model.objects.db_manager(db_for_read(model))
+
+
 class Metadata(object):
     __metaclass__ = MetadataBase
 
@@ -248,7 +525,7 @@ def _get_metadata_model(name=None):
                 valid_names = u'Try using the name "%s" or simply leaving it out altogether.'% registry.keys()[0]
             else:
                 valid_names = u"Valid names are " + u", ".join(u'"%s"' % k for k in registry.keys())
-            raise Exception(u"Metadata definition with name \"%s\" does not exist.\n%s" % (name, valid_names))
+            raise MetadataNotRegistered(u"Metadata definition with name \"%s\" does not exist.\n%s" % (name, valid_names))
     else:
         assert len(registry) == 1, "You must have exactly one Metadata class, if using get_metadata() without a 'name' parameter."
         return registry.values()[0]
@@ -259,28 +536,31 @@ def get_metadata(path, name=None, context=None, site=None, language=None):
     return metadata._get_formatted_data(path, context, site, language)
 
 
+def get_bulk_metadata(paths, name=None, site=None, language=None, compact=False):
+    """ Gets metadata for many paths at once, using a handful of queries for
+        every few hundred paths. Generates (path, metadata) pairs.
+        If compact is set, every value is resolved straight away and only the
+        values are kept, which uses much less memory when holding on to 
+        the results.
+    """
+    metadata = _get_metadata_model(name)
+    paths = list(paths)
+    for i in range(0, len(paths), MAX_QUERY_PARAMS):
+        for path, formatted_metadata in metadata._get_bulk_formatted_data(paths[i:i + MAX_QUERY_PARAMS], site, language):
+            if compact:
+                formatted_metadata = formatted_metadata._compact()
+            yield path, formatted_metadata
+
+
 def get_linked_metadata(obj, name=None, context=None, site=None, language=None):
     """ Gets metadata linked from the given object. """
-    # XXX Check that 'modelinstance' and 'model' metadata are installed in backends
-    # I believe that get_model() would return None if not
     Metadata = _get_metadata_model(name)
-    InstanceMetadata = Metadata._meta.get_model('modelinstance')
-    ModelMetadata = Metadata._meta.get_model('model')
-    content_type = ContentType.objects.get_for_model(obj)
-    instances = []
-    if InstanceMetadata is not None:
-        try:
-            instance_md = InstanceMetadata.objects.get(_content_type=content_type, _object_id=obj.pk)
-        except InstanceMetadata.DoesNotExist:
-            instance_md = InstanceMetadata(_content_object=obj)
-        instances.append(instance_md)
-    if ModelMetadata is not None:
-        try:
-            model_md = ModelMetadata.objects.get(_content_type=content_type)
-        except ModelMetadata.DoesNotExist:
-            model_md = ModelMetadata(_content_type=content_type)
-        instances.append(model_md)    
-    return FormattedMetadata(Metadata, instances, '', site, language)
+    return Metadata._get_linked_formatted_data(obj, site, language)
+
+
+# How many times syncing model instance metadata is tried, when it collides
+# with another process
+SYNC_ATTEMPTS = 3
 
 
 def create_metadata_instance(metadata_class, instance):
@@ -290,7 +570,6 @@ def create_metadata_instance(metadata_class, instance):
     if getattr(instance, '_MetadataFormset__seo_metadata_handled', False):
         return
 
-    metadata = None
     content_type = ContentType.objects.get_for_model(instance)
     
     # If this object does not define a path, don't worry about automatic update
@@ -299,10 +578,58 @@ def create_metadata_instance(metadata_class, instance):
     except AttributeError:
         return
 
-    # Look for an existing object with this path
     language = getattr(instance, '_language', None)
     site = getattr(instance, '_site', None)
-    for md in metadata_class.objects.get_instances(path, site, language):
+
+    # Sparse metadata is only created by editors, it just needs to follow the path
+    sparse = not _keeps_instance_rows(metadata_class, content_type)
+
+    # Where the database allows it, this is done in a single atomic statement
+    if not sparse and upsert_instance_metadata(metadata_class, content_type, instance.pk, path):
+        return
+
+    using = router.db_for_write(metadata_class)
+    for attempt in range(SYNC_ATTEMPTS):
+        sid = transaction.savepoint(using=using)
+        try:
+            _sync_instance_metadata(metadata_class, content_type, instance, path, site, language, sparse)
+        except IntegrityError, e:
+            # Another process synced the same object or path at the same time,
+            # try again now that its changes are visible
+            transaction.savepoint_rollback(sid, using=using)
+        else:
+            transaction.savepoint_commit(sid, using=using)
+            return
+    # Don't fail the object's save(), its metadata is synced when next saved
+    logging.warning("Unable to sync %s metadata for %s: %s" % (metadata_class.__name__, path, e))
+
+
+def _keeps_instance_rows(metadata_class, content_type):
+    """ Checks if every object of the given content type needs a row of 
+        model instance metadata. Without Meta.sparse_instances they always
+        do, otherwise only to find the model metadata from their path.
+    """
+    options = metadata_class._metadata._meta
+    if not options.sparse_instances:
+        return True
+    ModelMetadata = options.get_model('model')
+    return ModelMetadata is not None and ModelMetadata.objects.filter(_content_type=content_type).exists()
+
+
+def _sync_instance_metadata(metadata_class, content_type, instance, path, site, language, sparse):
+    """ Makes the model instance metadata for the given object follow its
+        path, the slow way: one row at a time.
+    """
+    metadata = None
+    # Never the read database, the rows found here are saved again
+    objects = metadata_class.objects.db_manager(router.db_for_write(metadata_class))
+
+    # Look for an existing object with this path
+    queryset = objects.get_instances(path, site, language)
+    # Lock the rows, if this version of django is able to
+    if hasattr(queryset, 'select_for_update'):
+        queryset = queryset.select_for_update()
+    for md in queryset:
         # If another object has the same path, remove the path.
         # It's harsh, but we need a unique path and will assume the other
         # link is outdated.
@@ -314,20 +641,70 @@ def create_metadata_instance(metadata_class, instance):
         else:
             # This is our instance!
             metadata = md
-    
+
     # If the path-based search didn't work, look for (or create) an existing
     # instance linked to this object.
-    if not metadata:
-        metadata, md_created = metadata_class.objects.get_or_create(_content_type=content_type, _object_id=instance.pk)
+    if not metadata and sparse:
+        queryset = objects.filter(_content_type=content_type, _object_id=instance.pk)
+        if metadata_class._metadata._meta.use_redirect:
+            # Saving adds a redirect from the old path
+            for metadata in queryset.exclude(_path=path):
+                metadata.save()
+        elif queryset.exclude(_path=path).update(_path=path):
+            note_write(metadata_class)
+    elif not metadata:
+        metadata, md_created = objects.get_or_create(_content_type=content_type, _object_id=instance.pk)
         metadata._path = path
         metadata.save()
 
 
-def populate_metadata(model, MetadataClass):
+def populate_metadata(model, MetadataClass, chunk_size=MAX_QUERY_PARAMS):
     """ For a given model and metadata class, ensure there is metadata for every instance. 
+        Objects without metadata are found and handled in chunks, the 
+        metadata being inserted in bulk.
     """
     content_type = ContentType.objects.get_for_model(model)
-    for instance in model.objects.all():
+    existing = MetadataClass.objects.filter(_content_type=content_type).values('_object_id')
+    queryset = model._default_manager.exclude(pk__in=existing).order_by('pk')
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+        _populate_metadata_chunk(MetadataClass, content_type, chunk)
+
+
+def _populate_metadata_chunk(MetadataClass, content_type, instances):
+    """ Creates metadata for the given instances, which currently have none. """
+    by_path = SortedDict()
+    for instance in instances:
+        # If this object does not define a path, it doesn't need metadata
+        try:
+            path = instance.get_absolute_url()
+        except AttributeError:
+            continue
+        by_path.setdefault(path, []).append(instance)
+
+    # Paths already in use need the careful treatment of create_metadata_instance
+    taken = set(MetadataClass.objects.filter(_path__in=by_path.keys()).values_list('_path', flat=True))
+    new_metadata = []
+    remaining = []
+    for path, path_instances in by_path.items():
+        if path in taken:
+            remaining.extend(path_instances)
+        else:
+            new_metadata.append(MetadataClass(_content_type=content_type, _object_id=path_instances[0].pk, _path=path))
+            remaining.extend(path_instances[1:])
+
+    if not bulk_insert(MetadataClass, new_metadata):
+        # Someone got there first, do everything the slow way
+        remaining = [i for path_instances in by_path.values() for i in path_instances]
+
+    for instance in remaining:
         create_metadata_instance(MetadataClass, instance)
 
 
@@ -344,21 +721,91 @@ def _update_callback(model_class, sender, instance, created, **kwargs):
     create_metadata_instance(model_class, instance)
 
 
+def _model_metadata_callback(model_class, sender, instance, **kwargs):
+    """ Callback to be attached to the post_save signal of model metadata,
+        for Meta.sparse_instances. Objects of the model get the rows they 
+        need to find it from their path.
+    """
+    model = instance._content_type.model_class()
+    if model in model_class._metadata._meta.seo_models:
+        populate_metadata(model, model_class)
+
+
+# Metadata waiting to be removed, once the objects it belongs to are deleted
+_pending_deletes = threading.local()
+
+
 def _delete_callback(model_class, sender, instance,  **kwargs):
+    """ Callback to be attached to a pre_delete signal, marking the relevant
+        metadata for removal.
+
+        Deleting a queryset sends every pre_delete signal before any 
+        post_delete signal, so the metadata can then be removed in bulk
+        by _flush_deletes_callback.
+    """
     content_type = ContentType.objects.get_for_model(instance)
-    model_class.objects.filter(_content_type=content_type, _object_id=instance.pk).delete()
+    pending = _pending_deletes.__dict__.setdefault(model_class, {})
+    pending.setdefault(content_type.id, set()).add(instance.pk)
+
+
+def _flush_deletes_callback(model_class, sender, instance, using=None, **kwargs):
+    """ Callback to be attached to a post_delete signal, removing all metadata
+        that has been marked for removal.
+
+        If an earlier delete failed after its pre_delete signals were sent,
+        its objects are still marked. They still exist, so keep their metadata.
+    """
+    pending = _pending_deletes.__dict__.pop(model_class, None)
+    if pending:
+        for content_type_id, object_ids in pending.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model is not None:
+                object_ids = list(object_ids)
+                existing = set()
+                for i in range(0, len(object_ids), MAX_QUERY_PARAMS):
+                    queryset = model._base_manager.using(using).filter(pk__in=object_ids[i:i + MAX_QUERY_PARAMS])
+                    existing.update(queryset.values_list('pk', flat=True))
+                object_ids = [pk for pk in object_ids if pk not in existing]
+            if object_ids:
+                delete_instance_metadata(model_class, content_type_id, object_ids)
+
+
+def _connect_seo_model(sender, **kwargs):
+    """ Connects the model instance signals for the given model, for every
+        metadata definition listing it in seo_models.
+    """
+    for metadata_class in registry.values():
+        model_instance = metadata_class._meta.get_model('modelinstance')
+        if model_instance is not None and metadata_class._meta.is_seo_model(sender):
+            uid = (metadata_class._meta.name, sender._meta.app_label, sender._meta.object_name)
+            models.signals.post_save.connect(curry(_update_callback, model_class=model_instance),
+                                                sender=sender, weak=False, dispatch_uid=uid)
+            models.signals.pre_delete.connect(curry(_delete_callback, model_class=model_instance),
+                                                sender=sender, weak=False, dispatch_uid=uid)
+            models.signals.post_delete.connect(curry(_flush_deletes_callback, model_class=model_instance),
+                                                sender=sender, weak=False, dispatch_uid=uid)
 
 
 def register_signals():
+    if [m for m in registry.values() if m._meta.use_redirect]:
+        from django.contrib.redirects.models import Redirect
+        from rollyourown.seo.redirects import invalidate_redirects
+        models.signals.post_save.connect(invalidate_redirects, sender=Redirect)
+        models.signals.post_delete.connect(invalidate_redirects, sender=Redirect)
+
+    ## Connect the models listed in seo_models to the update callbacks.
+    ## Models are matched by name as they are prepared, so that no apps
+    ## need to be imported yet.
+    for app_models in loading.cache.app_models.values():
+        for model in app_models.values():
+            _connect_seo_model(model)
+    models.signals.class_prepared.connect(_connect_seo_model, weak=False)
+
     for metadata_class in registry.values():
         model_instance = metadata_class._meta.get_model('modelinstance')
-        if model_instance is not None:
-            update_callback = curry(_update_callback, model_class=model_instance)
-            delete_callback = curry(_delete_callback, model_class=model_instance)
-
-            ## Connect the models listed in settings to the update callback.
-            for model in metadata_class._meta.seo_models:
-                models.signals.post_save.connect(update_callback, sender=model, weak=False)
-                models.signals.pre_delete.connect(delete_callback, sender=model, weak=False)
+        model_metadata = metadata_class._meta.get_model('model')
+        if metadata_class._meta.sparse_instances and model_instance is not None and model_metadata is not None:
+            models.signals.post_save.connect(curry(_model_metadata_callback, model_instance),
+                                                sender=model_metadata, weak=False)
 
 
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+from rollyourown.seo.base import _get_metadata_model
+from rollyourown.seo.middleware import get_request_metadata
+
+
+def metadata(request):
+    """ Adds the metadata for the requested path to the context, as 
+        "metadata". Nothing is looked up until it is used, and the result is
+        shared with {% get_metadata %}. The definition used is named in the
+        SEO_CONTEXT_METADATA setting, and defaults to the only definition.
+    """
+    name = getattr(settings, 'SEO_CONTEXT_METADATA', None)
+    def get_metadata():
+        return get_request_metadata(request, _get_metadata_model(name), request.path)
+    return {'metadata': SimpleLazyObject(get_metadata)}
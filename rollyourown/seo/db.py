@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Database specific helpers.
+    Everything that needs to know which database vendor is being used lives
+    here, so that the rest of the framework can stay database agnostic.
+"""
+
+import time
+import threading
+
+from django.db import connections, router, transaction, IntegrityError
+from django.core.cache import cache
+from django.db.models import AutoField
+
+
+# For this many seconds after writing metadata, a thread reads metadata from
+# the primary database instead of Meta.read_database, to see its own writes
+READ_YOUR_WRITES_WINDOW = 5
+
+# How long a generation of metadata is remembered in the cache, for
+# {% get_metadata cached %}
+GENERATION_TIMEOUT = 60 * 60 * 24 * 7
+
+_last_write = threading.local()
+
+def note_write(model=None):
+    """ Marks the current thread as having just written metadata. If the 
+        model is given, a new generation of its metadata definition starts.
+    """
+    _last_write.time = time.time()
+    if model is not None:
+        cache.set(_generation_key(model._metadata), _last_write.time, GENERATION_TIMEOUT)
+
+
+def _generation_key(metadata_class):
+    return 'rollyourown.seo.generation.%s' % metadata_class.__name__
+
+
+def get_generation(metadata_class):
+    """ A value that changes whenever metadata for the given definition is
+        written, in any process. 
+    """
+    key = _generation_key(metadata_class)
+    generation = cache.get(key)
+    if generation is None:
+        # Start a generation, unless another process has just done so
+        cache.add(key, time.time(), GENERATION_TIMEOUT)
+        generation = cache.get(key)
+    return generation
+
+
+def written_since(timestamp):
+    """ Checks if the current thread has written metadata since the given time. """
+    return getattr(_last_write, 'time', 0) >= timestamp
+
+
+def db_for_read(model):
+    """ The database to read metadata from when looking it up for a page.
+        This is Meta.read_database (eg a replica), unless the current 
+        thread has just written metadata. None means the usual routing.
+    """
+    alias = model._metadata._meta.read_database
+    if alias and time.time() - getattr(_last_write, 'time', 0) < READ_YOUR_WRITES_WINDOW:
+        return None
+    return alias
+
+
+def _supports_upsert(connection):
+    """ Checks if the given connection can perform an atomic insert-or-update. 
+        The answer is remembered on the connection, it won't change.
+    """
+    try:
+        return connection._seo_supports_upsert
+    except AttributeError:
+        pass
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        # "INSERT ... ON CONFLICT DO UPDATE" arrived in SQLite 3.24
+        supported = sqlite3.sqlite_version_info >= (3, 24, 0)
+    elif connection.vendor == 'postgresql':
+        # "INSERT ... ON CONFLICT" arrived in PostgreSQL 9.5
+        cursor = connection.cursor()
+        cursor.execute("SHOW server_version_num")
+        supported = int(cursor.fetchone()[0]) >= 90500
+    else:
+        supported = connection.vendor == 'mysql'
+    connection._seo_supports_upsert = supported
+    return supported
+
+
+def upsert_instance_metadata(model, content_type, object_id, path):
+    """ Creates or updates the model instance metadata for the given object
+        in a single, atomic statement.
+
+        Rows holding the same path for another object are left alone, the
+        statement simply doesn't do anything. In this case (and when the
+        database can't do this atomically), False is returned and the caller
+        needs to take the slower route. If the object's metadata already has
+        the path, nothing is written and no new generation is started.
+    """
+    options = model._metadata._meta
+    if options.use_sites or options.use_i18n:
+        # NULL sites and languages never conflict, so the unique constraint
+        # can't be used to find the existing row.
+        return False
+    if options.use_redirect:
+        # The old path is needed, to redirect from it
+        return False
+    if options.prerender:
+        # Values are rendered when the row is saved
+        return False
+
+    using = router.db_for_write(model)
+    connection = connections[using]
+    if not _supports_upsert(connection):
+        return False
+
+    qn = connection.ops.quote_name
+    opts = model._meta
+    path_column = qn(opts.get_field('_path').column)
+    ct_column = qn(opts.get_field('_content_type').column)
+    id_column = qn(opts.get_field('_object_id').column)
+
+    cursor = connection.cursor()
+    def has_path():
+        cursor.execute(u"SELECT %s FROM %s WHERE %s = %%s AND %s = %%s"
+                        % (path_column, qn(opts.db_table), ct_column, id_column), [content_type.pk, object_id])
+        row = cursor.fetchone()
+        return row is not None and row[0] == path
+
+    # Most saves don't change the path. MySQL counts an update that changes
+    # nothing as a row, so check first, to avoid starting a new generation.
+    if connection.vendor == 'mysql' and has_path():
+        return True
+
+    # Let django prepare the values for a new row, including field defaults
+    obj = model(_content_type=content_type, _object_id=object_id, _path=path)
+    fields = [f for f in opts.local_fields if not isinstance(f, AutoField)]
+    columns = u", ".join(qn(f.column) for f in fields)
+    values = [f.get_db_prep_save(f.pre_save(obj, True), connection=connection) for f in fields]
+
+    sql = [u"INSERT INTO %s (%s)" % (qn(opts.db_table), columns),
+           u"SELECT %s" % u", ".join(["%s"] * len(fields))]
+    if connection.vendor == 'mysql':
+        sql.append(u"FROM DUAL")
+    # Don't touch a path that belongs to another object
+    sql.append(u"WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s = %%s AND NOT (%s = %%s AND %s = %%s))"
+                    % (qn(opts.db_table), path_column, ct_column, id_column))
+    if connection.vendor == 'mysql':
+        # This also fires for the unique path, only ever update our own row
+        sql.append(u"ON DUPLICATE KEY UPDATE %s = IF(%s = VALUES(%s) AND %s = VALUES(%s), VALUES(%s), %s)"
+                    % (path_column, ct_column, ct_column, id_column, id_column, path_column, path_column))
+    else:
+        # Leave the row alone if the path hasn't changed
+        sql.append(u"ON CONFLICT (%s, %s) DO UPDATE SET %s = excluded.%s WHERE %s.%s <> excluded.%s"
+                    % (ct_column, id_column, path_column, path_column, qn(opts.db_table), path_column, path_column))
+    params = values + [path, content_type.pk, object_id]
+
+    sid = transaction.savepoint(using=using)
+    try:
+        cursor.execute(u" ".join(sql), params)
+    except IntegrityError:
+        # Another object has claimed this path in the mean time
+        transaction.savepoint_rollback(sid, using=using)
+        return False
+    transaction.savepoint_commit(sid, using=using)
+    transaction.commit_unless_managed(using=using)
+    if connection.vendor == 'mysql':
+        # The row count doesn't tell an insert from a row that was left
+        # alone, but the path was checked beforehand
+        written = has_path()
+    else:
+        written = cursor.rowcount > 0
+    if written:
+        note_write(model)
+        return True
+    # Nothing was written, either the path is unchanged or it belongs to
+    # another object
+    return connection.vendor != 'mysql' and has_path()
+
+
+def can_query_from_threads(model):
+    """ Checks if the database holding the given model can be queried from
+        other threads. Not if the current thread has uncommitted changes, 
+        which other threads can't see, and never for an in-memory SQLite
+        database: each thread would see its own, empty, database.
+    """
+    connection = connections[db_for_read(model) or router.db_for_read(model)]
+    if connection.is_dirty():
+        return False
+    return not (connection.vendor == 'sqlite' and connection.settings_dict['NAME'] in ('', ':memory:'))
+
+
+# Keep the number of parameters in a single query well under the limits of
+# all databases (SQLite allows 999)
+MAX_QUERY_PARAMS = 500
+
+
+def delete_instance_metadata(model, content_type_id, object_ids):
+    """ Deletes the model instance metadata for the given objects, using as
+        few DELETE statements as possible. Returns the number of rows deleted.
+    """
+    opts = model._meta
+    return _delete_in(model, opts.get_field('_object_id').column, object_ids,
+                    where=(opts.get_field('_content_type').column, content_type_id))
+
+
+def delete_metadata(model, pks, using=None):
+    """ Deletes the metadata with the given primary keys, using as few DELETE
+        statements as possible. Returns the number of rows deleted.
+    """
+    return _delete_in(model, model._meta.pk.column, pks, using=using)
+
+
+def _delete_in(model, column, values, where=None, using=None):
+    """ Deletes rows whose column has one of the given values, in chunks.
+        No signals are sent.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    values = list(values)
+    cursor = connection.cursor()
+    deleted = 0
+    for i in range(0, len(values), MAX_QUERY_PARAMS):
+        chunk = values[i:i + MAX_QUERY_PARAMS]
+        sql = u"DELETE FROM %s WHERE %s IN (%s)" % (qn(model._meta.db_table), qn(column), u", ".join(["%s"] * len(chunk)))
+        params = chunk
+        if where is not None:
+            sql += u" AND %s = %%s" % qn(where[0])
+            params = chunk + [where[1]]
+        cursor.execute(sql, params)
+        deleted += cursor.rowcount
+    transaction.commit_unless_managed(using=using)
+    note_write(model)
+    return deleted
+
+
+def bulk_insert(model, objs, using=None):
+    """ Inserts the given unsaved instances using a single statement, executed
+        many times. No signals are sent and save() is not called.
+        If any row violates a unique constraint, nothing is inserted and
+        False is returned.
+    """
+    objs = list(objs)
+    if not objs:
+        return True
+
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    fields = [f for f in opts.local_fields if not isinstance(f, AutoField)]
+    sql = u"INSERT INTO %s (%s) VALUES (%s)" % (qn(opts.db_table), 
+                u", ".join(qn(f.column) for f in fields), u", ".join(["%s"] * len(fields)))
+    params = [[f.get_db_prep_save(f.pre_save(obj, True), connection=connection) for f in fields] for obj in objs]
+
+    cursor = connection.cursor()
+    sid = transaction.savepoint(using=using)
+    try:
+        cursor.executemany(sql, params)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid, using=using)
+        return False
+    transaction.savepoint_commit(sid, using=using)
+    transaction.commit_unless_managed(using=using)
+    note_write(model)
+    return True
+
+
+def bulk_update(model, objs, fields, using=None):
+    """ Saves the given fields of the given (existing) instances, using a
+        single statement, executed many times. No signals are sent and save()
+        is not called.
+    """
+    objs = list(objs)
+    if not objs:
+        return
+
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    sql = u"UPDATE %s SET %s WHERE %s = %%s" % (qn(opts.db_table), 
+                u", ".join(u"%s = %%s" % qn(f.column) for f in fields), qn(opts.pk.column))
+    params = [[f.get_db_prep_save(f.pre_save(obj, False), connection=connection) for f in fields] + [obj.pk] for obj in objs]
+
+    cursor = connection.cursor()
+    cursor.executemany(sql, params)
+    transaction.commit_unless_managed(using=using)
+    note_write(model)
@@ -7,7 +7,7 @@ from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.utils.html import conditional_escape
 
-from rollyourown.seo.utils import escape_tags, NotSet, Literal
+from rollyourown.seo.utils import get_sanitizer, NotSet, Literal
 
 
 VALID_HEAD_TAGS = "head title base link meta script".split()
@@ -67,6 +67,7 @@ class MetadataField(object):
                 populate_from = getattr(cls, self.populate_from, None)
                 if callable(populate_from) and hasattr(populate_from, 'short_description'):
                     self.help_text = _('If empty, %s') % populate_from.short_description
+        self.sanitize = get_sanitizer(self.get_valid_tags())
         self.validate()
 
     def validate(self):
@@ -82,6 +83,10 @@ class MetadataField(object):
             kwargs.setdefault('verbose_name', self.help_text)
         return self.field(**kwargs)
 
+    def get_valid_tags(self):
+        """ The tags which are left unescaped in values. """
+        return self.valid_tags
+
     def clean(self, value):
         return value
 
@@ -103,8 +108,11 @@ class Tag(MetadataField):
         field_kwargs.setdefault('blank', True)
         super(Tag, self).__init__(name, head, editable, populate_from, valid_tags, choices, help_text, verbose_name, field, field_kwargs)
 
+    def get_valid_tags(self):
+        return self.valid_tags or VALID_INLINE_TAGS
+
     def clean(self, value):
-        value = escape_tags(value, self.valid_tags or VALID_INLINE_TAGS)
+        value = self.sanitize(value)
 
         return value.strip()
 
@@ -130,7 +138,7 @@ class MetaTag(MetadataField):
         super(MetaTag, self).__init__(name, head, editable, populate_from, valid_tags, choices, help_text, verbose_name, field, field_kwargs)
 
     def clean(self, value):
-        value = escape_tags(value, self.valid_tags)
+        value = self.sanitize(value)
 
         # Replace newlines with spaces
         return value.replace("\n", " ").strip()
@@ -152,12 +160,15 @@ class KeywordTag(MetaTag):
                         field_kwargs, help_text)
 
     def clean(self, value):
-        value = escape_tags(value, self.valid_tags)
+        value = self.sanitize(value)
 
         # Remove double quote, replace newlines with commas
         return value.replace('"', '&#34;').replace("\n", ", ").strip()
 
 
+# Text before the first tag and after the last one
+OUTSIDE_TAGS = re.compile(r"^[^<>]*(?=<)|(?<=>)[^<>]*$")
+
 # TODO: if max_length is given, use a CharField and pass it through
 class Raw(MetadataField):
     def __init__(self, head=True, editable=True, populate_from=NotSet, 
@@ -169,25 +180,21 @@ class Raw(MetadataField):
         field_kwargs.setdefault('blank', True)
         super(Raw, self).__init__(None, head, editable, populate_from, valid_tags, choices, help_text, verbose_name, field, field_kwargs)
 
-    def clean(self, value):
+    def get_valid_tags(self):
         # Find a suitable set of valid tags using self.head and self.valid_tags
         if self.head:
             valid_tags = set(VALID_HEAD_TAGS)
             if self.valid_tags is not None:
                 valid_tags = valid_tags & self.valid_tags
-        else:
-            valid_tags = self.valid_tags
+            return valid_tags
+        return self.valid_tags
 
-        value = escape_tags(value, valid_tags)
+    def clean(self, value):
+        value = self.sanitize(value)
 
         if self.head:
-            # Remove text before tags
-            before_tags = re.compile("^([^<>]*)<")
-            value = before_tags.sub('<', value)
-
-            # Remove text after tags
-            after_tags = re.compile(">([^<>]*)$")
-            value = after_tags.sub('>', value)
+            # Remove text before and after tags
+            value = OUTSIDE_TAGS.sub('', value)
 
         return value
 
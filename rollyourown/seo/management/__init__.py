@@ -1,10 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import re
+
+from django.conf import settings
+from django.utils.datastructures import SortedDict
+from django.utils import simplejson
 from django.db.models import signals
+from django.db import connections, router
 from django.db.utils import DatabaseError
 from django.contrib.contenttypes.models import ContentType
-from rollyourown.seo.base import registry, populate_metadata
+from django.core.management.base import CommandError
+from rollyourown.seo.base import registry, populate_metadata, _keeps_instance_rows
+from rollyourown.seo.db import delete_metadata, bulk_update, MAX_QUERY_PARAMS
+from rollyourown.seo.utils import run_in_threads
 from rollyourown.seo import models as seo_models
 
 
@@ -14,7 +23,14 @@ def _syncdb_handler(app, created_models, verbosity, **kwargs):
         if InstanceMetadata is not None and InstanceMetadata in created_models:
             for model in Metadata._meta.seo_models:
                 content_type = ContentType.objects.get_for_model(model)
-                if InstanceMetadata.objects.filter(_content_type=content_type):
+                if InstanceMetadata.objects.filter(_content_type=content_type).exists():
+                    continue
+                if not _keeps_instance_rows(InstanceMetadata, content_type):
+                    # Sparse metadata is only created when values are entered
+                    continue
+                if getattr(settings, 'SEO_DEFER_POPULATE', False):
+                    if verbosity > 0:
+                        print "Not populating %s for %s.%s, run the populate_metadata management command to do so" % (Metadata._meta.verbose_name_plural, model._meta.app_label, model._meta.object_name)
                     continue
                 if verbosity > 0:
                     print "Populating %s for %s.%s" % (Metadata._meta.verbose_name_plural, model._meta.app_label, model._meta.object_name)
@@ -28,17 +44,235 @@ def _syncdb_handler(app, created_models, verbosity, **kwargs):
 
 
 def populate_all_metadata():
-    """ Create metadata instances for all models in seo_models if empty.
-        Once you have created a single metadata instance, this will not run.
-        This is because it is a potentially slow operation that need only be
-        done once. If you want to ensure that everything is populated, run the
-        populate_metadata management command.
+    """ Create metadata instances for all objects in seo_models that are
+        missing them. Only the missing metadata is created, in bulk.
+        This is run by the populate_metadata management command, which is
+        also how population is done when SEO_DEFER_POPULATE is set.
+        Metadata definitions using sparse_instances only get rows for models
+        with model metadata, to find it from the path.
     """
     for Metadata in registry.values():
         InstanceMetadata = Metadata._meta.get_model('modelinstance')
         if InstanceMetadata is not None:
             for model in Metadata._meta.seo_models:
-                populate_metadata(model, InstanceMetadata)
+                if _keeps_instance_rows(InstanceMetadata, ContentType.objects.get_for_model(model)):
+                    populate_metadata(model, InstanceMetadata)
+
+
+def get_backend_model(name, backend_name):
+    """ Finds the model for the given metadata definition and backend names,
+        raising a CommandError with useful information if there is none.
+    """
+    try:
+        Metadata = registry[name]
+    except KeyError:
+        raise CommandError(u"Metadata definition with name \"%s\" does not exist.\nValid names are %s" 
+                                % (name, u", ".join(u'"%s"' % k for k in registry.keys())))
+    model = Metadata._meta.get_model(backend_name)
+    if model is None:
+        raise CommandError(u"Metadata definition \"%s\" does not use the backend \"%s\".\nValid backends are %s" 
+                                % (name, backend_name, u", ".join(u'"%s"' % k for k in Metadata._meta.models.keys())))
+    if not model._meta.managed:
+        raise CommandError(u"The backend \"%s\" does not store metadata in the database." % backend_name)
+    return model
+
+
+def find_orphaned_metadata(InstanceMetadata, content_type, chunk_size=MAX_QUERY_PARAMS):
+    """ Generates lists of primary keys for model instance metadata whose
+        object no longer exists. This happens when objects are removed without
+        sending signals (eg raw SQL). 
+        The metadata table is walked in chunks, each being a single anti-join.
+    """
+    queryset = InstanceMetadata.objects.filter(_content_type=content_type).order_by('pk')
+    model = content_type.model_class()
+    if model is not None:
+        if router.db_for_read(model) != router.db_for_read(InstanceMetadata):
+            # The tables can't be joined if they live in different databases
+            return
+        qn = connections[router.db_for_read(InstanceMetadata)].ops.quote_name
+        target_table = qn(model._meta.db_table)
+        where = 'NOT EXISTS (SELECT 1 FROM %s WHERE %s.%s = %s.%s)' % (
+                    target_table, target_table, qn(model._meta.pk.column),
+                    qn(InstanceMetadata._meta.db_table),
+                    qn(InstanceMetadata._meta.get_field('_object_id').column))
+        queryset = queryset.extra(where=[where])
+    # Otherwise, the model itself has been removed and all the metadata is orphaned
+
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk.values_list('pk', flat=True)[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1]
+
+
+def sweep_all_metadata(dry_run=False, chunk_size=MAX_QUERY_PARAMS):
+    """ Removes model instance metadata for objects that no longer exist. 
+        Returns a list of (Metadata, content_type, count) for everything found.
+    """
+    results = []
+    for Metadata in registry.values():
+        InstanceMetadata = Metadata._meta.get_model('modelinstance')
+        if InstanceMetadata is None:
+            continue
+        content_type_ids = InstanceMetadata.objects.order_by().values_list('_content_type', flat=True).distinct()
+        for content_type_id in list(content_type_ids):
+            content_type = ContentType.objects.get_for_id(content_type_id)
+            count = 0
+            for pks in find_orphaned_metadata(InstanceMetadata, content_type, chunk_size):
+                if not dry_run:
+                    delete_metadata(InstanceMetadata, pks)
+                count += len(pks)
+            if count:
+                results.append((Metadata, content_type, count))
+    return results
+
+
+def prerender_all_metadata(chunk_size=MAX_QUERY_PARAMS):
+    """ Cleans and renders the stored values of every definition using
+        Meta.prerender, afresh. This is needed for rows written without
+        calling save(), such as bulk imports, and after changing a definition.
+        Returns a list of (Metadata, backend name, count).
+    """
+    results = []
+    for Metadata in registry.values():
+        if not Metadata._meta.prerender:
+            continue
+        for backend_name, model in Metadata._meta.models.items():
+            if not model._meta.managed:
+                continue
+            field = model._meta.get_field('_rendered')
+            count = 0
+            last_pk = None
+            while True:
+                queryset = model.objects.order_by('pk')
+                if last_pk is not None:
+                    queryset = queryset.filter(pk__gt=last_pk)
+                chunk = list(queryset[:chunk_size])
+                if not chunk:
+                    break
+                for obj in chunk:
+                    obj._rendered = simplejson.dumps(obj._prerender())
+                bulk_update(model, chunk, [field])
+                count += len(chunk)
+                last_pk = chunk[-1].pk
+            results.append((Metadata, backend_name, count))
+    return results
+
+
+def get_known_paths(Metadata):
+    """ Lists every (path, language) pair stored in the path and model 
+        instance tables, and in any static file. Language is None if i18n
+        is not used.
+    """
+    known_paths = SortedDict()
+    for backend_name in ('path', 'modelinstance'):
+        model = Metadata._meta.get_model(backend_name)
+        if model is None:
+            continue
+        if Metadata._meta.use_i18n:
+            values = model.objects.order_by().values_list('_path', '_language').distinct()
+        else:
+            values = ((path, None) for path in model.objects.order_by().values_list('_path', flat=True).distinct())
+        for path, language in values:
+            if path:
+                known_paths[(path, language)] = True
+    StaticMetadata = Metadata._meta.get_model('static')
+    if StaticMetadata is not None:
+        for path, instances in StaticMetadata.objects.for_site_and_language().items():
+            for instance in instances:
+                known_paths[(path, getattr(instance, '_language', None))] = True
+    return known_paths.keys()
+
+
+LOG_REQUEST_RE = re.compile(r'"(?:GET|HEAD) (\S+) HTTP/[\d.]+"')
+
+def parse_access_log(stream):
+    """ Counts the requests for each path in an access log, in the common
+        or combined log format. Query strings are ignored.
+    """
+    counts = {}
+    for line in stream:
+        match = LOG_REQUEST_RE.search(line)
+        if match:
+            path = match.group(1).split('?', 1)[0]
+            counts[path] = counts.get(path, 0) + 1
+    return counts
+
+
+def _language_chunks(paths, chunk_size):
+    """ Splits (path, language) pairs into (language, paths) chunks, 
+        keeping the given order.
+    """
+    chunk, chunk_language = [], None
+    for path, language in paths:
+        if chunk and (language != chunk_language or len(chunk) >= chunk_size):
+            yield chunk_language, chunk
+            chunk = []
+        chunk_language = language
+        chunk.append(path)
+    if chunk:
+        yield chunk_language, chunk
+
+
+def warm_metadata_cache(Metadata, paths, site=None, workers=1, chunk_size=MAX_QUERY_PARAMS):
+    """ Resolves the metadata for the given (path, language) pairs and stores
+        the results in the cache, in the given order. Paths are resolved in
+        bulk, a chunk at a time, by a bounded number of threads.
+    """
+    def warm(chunk):
+        language, chunk_paths = chunk
+        for path, metadata in Metadata._get_bulk_formatted_data(chunk_paths, site, language):
+            metadata._refresh_cache()
+
+    run_in_threads(warm, _language_chunks(paths, chunk_size), workers)
+
+
+def render_head_fragments(Metadata, paths, callback, site=None, fingerprints=None, workers=1, chunk_size=MAX_QUERY_PARAMS):
+    """ Renders the head elements and each group for the given (path, language)
+        pairs, calling callback(path, language, fingerprint, fragments),
+        possibly from several threads at once.
+        Paths whose fingerprint is unchanged from the given fingerprints 
+        dictionary aren't rendered again, fragments is then None.
+    """
+    fingerprints = fingerprints or {}
+
+    def render(chunk):
+        language, chunk_paths = chunk
+        for path, metadata in Metadata._get_bulk_formatted_data(chunk_paths, site, language):
+            fingerprint = metadata._get_fingerprint()
+            if fingerprints.get((path, language)) == fingerprint:
+                callback(path, language, fingerprint, None)
+                continue
+            # Don't render anything stale from the cache
+            metadata._refresh_cache()
+            fragments = {'head': unicode(metadata)}
+            for group in Metadata._meta.groups:
+                fragments[group] = getattr(metadata, group) or u''
+            callback(path, language, fingerprint, fragments)
+
+    run_in_threads(render, _language_chunks(paths, chunk_size), workers)
+
+def resolve_snapshot_records(Metadata, paths, site=None, chunk_size=MAX_QUERY_PARAMS):
+    """ Generates (path, language, values) for the given (path, language) 
+        pairs, with the final, non-empty value of each field.
+        Paths with view metadata are left out, as their values depend on
+        the context of the view.
+    """
+    for language, chunk_paths in _language_chunks(paths, chunk_size):
+        for path, metadata in Metadata._get_bulk_formatted_data(chunk_paths, site, language):
+            if metadata._uses_view_context():
+                continue
+            values = {}
+            for name in Metadata._meta.elements:
+                value = metadata._resolve_value(name)
+                if value:
+                    values[name] = value
+            yield path, language, values
 
 
 signals.post_syncdb.connect(_syncdb_handler, sender=seo_models,
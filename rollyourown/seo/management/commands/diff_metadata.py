@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import simplejson
+from rollyourown.seo.base import registry
+from rollyourown.seo.transfer import (DEFAULT_BUCKETS, table_checksums, mismatched_buckets,
+                    bucket_rows, diff_rows, import_rows, delete_rows, write_rows, get_fields)
+
+class Command(BaseCommand):
+    args = "[metadata name ...]"
+    help = ("Compare metadata with another database, or with checksums saved "
+            "from another environment, only looking at the rows that differ.")
+    option_list = BaseCommand.option_list + (
+        make_option('--source', dest='source', default=DEFAULT_DB_ALIAS,
+            help='Database to read the local metadata from. Defaults to the "default" database.'),
+        make_option('--database', dest='database', default=None,
+            help='Database to compare against.'),
+        make_option('--apply', action='store_true', dest='apply', default=False,
+            help='Make the metadata in --database the same as in --source.'),
+        make_option('--save-checksums', dest='save_checksums', default=None,
+            help='Save the checksums of the local metadata to a file, to be compared elsewhere.'),
+        make_option('--checksums', dest='checksums', default=None,
+            help='Compare against checksums saved in another environment.'),
+        make_option('--output-dir', dest='output_dir', default=None,
+            help='With --checksums, export the rows that may differ to this directory, ready for import_metadata.'),
+        make_option('--buckets', dest='buckets', type='int', default=DEFAULT_BUCKETS,
+            help='Number of ranges of rows to checksum in each table.'),
+    )
+
+    def handle(self, *names, **options):
+        source = options.get('source') or DEFAULT_DB_ALIAS
+        buckets = options.get('buckets') or DEFAULT_BUCKETS
+        self.verbosity = int(options.get('verbosity', 1))
+
+        tables = []
+        for name in names or registry.keys():
+            if name not in registry:
+                raise CommandError(u"Metadata definition with name \"%s\" does not exist." % name)
+            for backend_name, model in registry[name]._meta.models.items():
+                if model._meta.managed:
+                    tables.append(('%s.%s' % (name, backend_name), model))
+
+        if options.get('save_checksums'):
+            checksums = {'buckets': buckets, 'tables': {}}
+            for table, model in tables:
+                checksums['tables'][table] = table_checksums(model, buckets, using=source)
+            stream = open(options['save_checksums'], 'wb')
+            try:
+                simplejson.dump(checksums, stream)
+            finally:
+                stream.close()
+
+        elif options.get('checksums'):
+            stream = open(options['checksums'], 'rb')
+            try:
+                other = simplejson.load(stream)
+            finally:
+                stream.close()
+            for table, model in tables:
+                if table not in other['tables']:
+                    self.report("%s: missing from checksums, skipping" % table)
+                    continue
+                boundaries = other['tables'][table]['boundaries']
+                selected = mismatched_buckets(table_checksums(model, using=source, boundaries=boundaries), other['tables'][table])
+                self.report("%s: %d of %d checksums differ" % (table, len(selected), len(boundaries) + 1))
+                if selected and options.get('output_dir'):
+                    filename = os.path.join(options['output_dir'], '%s.jsonl' % table)
+                    output = open(filename, 'wb')
+                    try:
+                        write_rows(bucket_rows(model, boundaries, selected, using=source), output, 'jsonl', [f.name for f in get_fields(model)])
+                    finally:
+                        output.close()
+
+        elif options.get('database'):
+            target = options['database']
+            for table, model in tables:
+                checksums = table_checksums(model, buckets, using=source)
+                selected = mismatched_buckets(checksums, table_checksums(model, using=target, boundaries=checksums['boundaries']))
+                if not selected:
+                    self.report("%s: no differences" % table)
+                    continue
+                missing, changed, extra = diff_rows(model, checksums['boundaries'], selected, source, target)
+                self.report("%s: %d missing, %d changed, %d extra" % (table, len(missing), len(changed), len(extra)))
+                if options.get('apply'):
+                    import_rows(model, missing + changed, using=target)
+                    delete_rows(model, extra, using=target)
+
+        else:
+            raise CommandError("Please give either --database, --checksums or --save-checksums.")
+
+    def report(self, message):
+        if self.verbosity > 0:
+            self.stdout.write(message + "\n")
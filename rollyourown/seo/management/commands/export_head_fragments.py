@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import threading
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.sites.models import Site
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+from django.utils.encoding import iri_to_uri
+from rollyourown.seo.base import registry
+from rollyourown.seo.management import get_known_paths, render_head_fragments
+
+MANIFEST = 'manifest.jsonl'
+
+class Command(BaseCommand):
+    args = "<metadata name>"
+    help = ("Render the head elements and groups of every known path, for "
+            "pages served without reaching Django. Only paths whose metadata "
+            "changed since the last export are rendered again.")
+    option_list = BaseCommand.option_list + (
+        make_option('--output-dir', dest='output_dir', default=None,
+            help='Write each fragment to its own file in this directory, '
+                 'named after the md5 of the path, listed in %s.' % MANIFEST),
+        make_option('--output', dest='output', default=None,
+            help='Write all fragments to a single file, one JSON object per path.'),
+        make_option('--site', dest='site', default=None,
+            help='Domain of the site to render the metadata for.'),
+        make_option('--workers', dest='workers', type='int', default=4,
+            help='Number of threads rendering metadata at the same time.'),
+        make_option('--force', action='store_true', dest='force', default=False,
+            help='Render every path again, even if its metadata is unchanged. Use this when '
+                 'values come from elsewhere, eg a callable populate_from reading other objects.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Please give the name of a metadata definition.")
+        if args[0] not in registry:
+            raise CommandError(u"Metadata definition with name \"%s\" does not exist." % args[0])
+        if bool(options.get('output_dir')) == bool(options.get('output')):
+            raise CommandError("Please give either --output-dir or --output.")
+        Metadata = registry[args[0]]
+
+        site = None
+        if options.get('site'):
+            try:
+                site = Site.objects.get(domain=options['site'])
+            except Site.DoesNotExist:
+                raise CommandError(u"Site with domain \"%s\" does not exist." % options['site'])
+
+        if options.get('output_dir'):
+            exporter = DirectoryExporter(options['output_dir'])
+        else:
+            exporter = FileExporter(options['output'])
+        fingerprints = not options.get('force') and exporter.fingerprints() or None
+
+        render_head_fragments(Metadata, get_known_paths(Metadata), exporter.write, site,
+                              fingerprints, workers=options.get('workers') or 1)
+        exporter.close()
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("%d paths, %d rendered\n" % (exporter.count, exporter.rendered))
+
+
+class DirectoryExporter(object):
+    """ Writes one file per fragment, and a manifest mapping paths to files. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.previous = _read_entries(os.path.join(directory, MANIFEST))
+        self.entries = []
+        self.count = self.rendered = 0
+        self.lock = threading.Lock()
+
+    def fingerprints(self):
+        return dict((key, entry['fingerprint']) for key, entry in self.previous.items())
+
+    def write(self, path, language, fingerprint, fragments):
+        name = md5_constructor(iri_to_uri(path)).hexdigest()
+        if language:
+            name = '%s.%s' % (name, language)
+        entry = {'path': path, 'language': language, 'fingerprint': fingerprint, 'files': {}}
+        if fragments is None:
+            entry['files'] = self.previous[(path, language)]['files']
+        else:
+            for fragment, value in fragments.items():
+                filename = fragment == 'head' and '%s.html' % name or '%s.%s.html' % (name, fragment)
+                _write_atomically(os.path.join(self.directory, filename), value.encode('utf-8'))
+                entry['files'][fragment] = filename
+        self.lock.acquire()
+        try:
+            self.entries.append(entry)
+            self.count += 1
+            self.rendered += fragments is not None
+        finally:
+            self.lock.release()
+
+    def close(self):
+        # Remove the fragments of paths that have gone
+        current = set(filename for entry in self.entries for filename in entry['files'].values())
+        for entry in self.previous.values():
+            for filename in entry['files'].values():
+                if filename not in current and os.path.exists(os.path.join(self.directory, filename)):
+                    os.remove(os.path.join(self.directory, filename))
+        _write_atomically(os.path.join(self.directory, MANIFEST), 
+                          '\n'.join(simplejson.dumps(entry) for entry in self.entries))
+
+
+class FileExporter(object):
+    """ Writes every path's fragments to a single file, one JSON object per line. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.previous = _read_entries(filename)
+        self.stream = open(filename + '.tmp', 'wb')
+        self.count = self.rendered = 0
+        self.lock = threading.Lock()
+
+    def fingerprints(self):
+        return dict((key, entry['fingerprint']) for key, entry in self.previous.items())
+
+    def write(self, path, language, fingerprint, fragments):
+        rendered = fragments is not None
+        if not rendered:
+            fragments = self.previous[(path, language)]['fragments']
+        line = simplejson.dumps({'path': path, 'language': language, 'fingerprint': fingerprint, 'fragments': fragments})
+        self.lock.acquire()
+        try:
+            self.stream.write(line + '\n')
+            self.count += 1
+            self.rendered += rendered
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.stream.close()
+        os.rename(self.filename + '.tmp', self.filename)
+
+
+def _read_entries(filename):
+    """ Reads the entries of a previous export, keyed by path and language. """
+    entries = {}
+    if os.path.exists(filename):
+        stream = open(filename, 'rb')
+        try:
+            for line in stream:
+                if line.strip():
+                    entry = simplejson.loads(line)
+                    entries[(entry['path'], entry['language'])] = entry
+        finally:
+            stream.close()
+    return entries
+
+
+def _write_atomically(filename, content):
+    stream = open(filename + '.tmp', 'wb')
+    try:
+        stream.write(content)
+    finally:
+        stream.close()
+    os.rename(filename + '.tmp', filename)
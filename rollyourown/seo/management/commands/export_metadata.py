@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from rollyourown.seo.db import MAX_QUERY_PARAMS
+from rollyourown.seo.transfer import FORMATS, export_rows, write_rows, get_fields
+from rollyourown.seo.management import get_backend_model
+
+class Command(BaseCommand):
+    args = "<metadata name> <backend name>"
+    help = "Export the metadata stored by a single backend, as JSON lines or CSV."
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='jsonl',
+            help='Output format, one of: %s' % ", ".join(FORMATS)),
+        make_option('--output', dest='output', default=None,
+            help='File to write to, instead of standard output.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=MAX_QUERY_PARAMS,
+            help='Number of rows to read from the database at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Please give the name of a metadata definition and a backend (eg path).")
+        format = options.get('format') or 'jsonl'
+        if format not in FORMATS:
+            raise CommandError("Unknown format '%s', use one of: %s" % (format, ", ".join(FORMATS)))
+        model = get_backend_model(*args)
+
+        rows = export_rows(model, options.get('chunk_size') or MAX_QUERY_PARAMS)
+        fieldnames = [f.name for f in get_fields(model)]
+        if options.get('output'):
+            stream = open(options['output'], 'wb')
+            try:
+                write_rows(rows, stream, format, fieldnames)
+            finally:
+                stream.close()
+        else:
+            write_rows(rows, self.stdout, format, fieldnames)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from rollyourown.seo.db import MAX_QUERY_PARAMS
+from rollyourown.seo.transfer import FORMATS, import_rows, read_rows
+from rollyourown.seo.management import get_backend_model
+
+class Command(BaseCommand):
+    args = "<metadata name> <backend name> <file>"
+    help = ("Import metadata for a single backend from JSON lines or CSV. "
+            "Existing metadata (with the same path, view or object) is updated.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help='Input format, one of: %s. Guessed from the file name by default.' % ", ".join(FORMATS)),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=MAX_QUERY_PARAMS,
+            help='Number of rows to save at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 3:
+            raise CommandError("Please give the name of a metadata definition, a backend (eg path) and a file.")
+        name, backend_name, filename = args
+        format = options.get('format')
+        if format is None:
+            format = filename.endswith('.csv') and 'csv' or 'jsonl'
+        if format not in FORMATS:
+            raise CommandError("Unknown format '%s', use one of: %s" % (format, ", ".join(FORMATS)))
+        model = get_backend_model(name, backend_name)
+
+        if filename == '-':
+            stream = sys.stdin
+        else:
+            stream = open(filename, 'rb')
+        try:
+            created, updated, skipped = import_rows(model, read_rows(stream, format), 
+                                            options.get('chunk_size') or MAX_QUERY_PARAMS)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Created %d, updated %d and skipped %d %s\n" % (created, updated, skipped, model._meta.verbose_name_plural))
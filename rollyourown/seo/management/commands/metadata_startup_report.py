@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+from rollyourown.seo.utils import startup_timings
+
+class Command(BaseCommand):
+    help = ("Report how long it took to find and set up the metadata definitions "
+            "when this process started, slowest step first.")
+
+    def handle(self, *args, **options):
+        if len(args) > 0:
+            raise CommandError("This command takes no arguments")
+        # Make sure definitions have been loaded
+        from rollyourown.seo import models
+        self.stdout.write(startup_timings.report().encode('utf-8') + "\n")
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from rollyourown.seo.management import prerender_all_metadata
+from rollyourown.seo.db import MAX_QUERY_PARAMS
+
+class Command(BaseCommand):
+    help = "Render the stored metadata of definitions using Meta.prerender afresh."
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=MAX_QUERY_PARAMS,
+            help='Number of metadata rows to render and save at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 0:
+            raise CommandError("This command currently takes no arguments")
+
+        verbosity = int(options.get('verbosity', 1))
+        results = prerender_all_metadata(chunk_size=options.get('chunk_size', MAX_QUERY_PARAMS))
+
+        if verbosity > 0:
+            for Metadata, backend_name, count in results:
+                self.stdout.write("Rendered %d %s (%s)\n" % (count, Metadata._meta.verbose_name_plural, backend_name))
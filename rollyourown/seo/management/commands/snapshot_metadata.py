@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.sites.models import Site
+from rollyourown.seo.base import registry
+from rollyourown.seo.snapshot import get_snapshot_filename, write_snapshot
+from rollyourown.seo.management import get_known_paths, resolve_snapshot_records
+
+class Command(BaseCommand):
+    args = "[metadata name ...]"
+    help = ("Write a snapshot of the final metadata for every known path to "
+            "SEO_SNAPSHOT_DIR, to be shared by all server processes.")
+    option_list = BaseCommand.option_list + (
+        make_option('--site', dest='site', default=None,
+            help='Domain of the site to resolve the metadata for.'),
+    )
+
+    def handle(self, *names, **options):
+        site = None
+        if options.get('site'):
+            try:
+                site = Site.objects.get(domain=options['site'])
+            except Site.DoesNotExist:
+                raise CommandError(u"Site with domain \"%s\" does not exist." % options['site'])
+
+        for name in names or registry.keys():
+            if name not in registry:
+                raise CommandError(u"Metadata definition with name \"%s\" does not exist." % name)
+            filename = get_snapshot_filename(name)
+            if filename is None:
+                raise CommandError("Please set SEO_SNAPSHOT_DIR to the directory to keep snapshots in.")
+            Metadata = registry[name]
+            count = write_snapshot(filename, resolve_snapshot_records(Metadata, get_known_paths(Metadata), site), site)
+            if int(options.get('verbosity', 1)) > 0:
+                self.stdout.write("%s: %d paths\n" % (name, count))
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from rollyourown.seo.management import sweep_all_metadata
+from rollyourown.seo.db import MAX_QUERY_PARAMS
+
+class Command(BaseCommand):
+    help = "Remove model instance metadata whose objects no longer exist."
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only report the orphaned metadata, do not remove it.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=MAX_QUERY_PARAMS,
+            help='Number of metadata rows to examine and remove at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 0:
+            raise CommandError("This command currently takes no arguments")
+
+        dry_run = options.get('dry_run', False)
+        verbosity = int(options.get('verbosity', 1))
+        results = sweep_all_metadata(dry_run=dry_run, chunk_size=options.get('chunk_size', MAX_QUERY_PARAMS))
+
+        if verbosity > 0:
+            action = dry_run and "Found" or "Removed"
+            for Metadata, content_type, count in results:
+                self.stdout.write("%s %d orphaned %s for %s.%s\n" % (action, count, 
+                        Metadata._meta.verbose_name_plural, content_type.app_label, content_type.model))
+            self.stdout.write("%s %d orphaned metadata in total\n" % (action, sum(r[2] for r in results)))
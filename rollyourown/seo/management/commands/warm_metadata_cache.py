@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.sites.models import Site
+from rollyourown.seo.base import registry
+from rollyourown.seo.management import get_known_paths, parse_access_log, warm_metadata_cache
+
+class Command(BaseCommand):
+    args = "[metadata name ...]"
+    help = ("Fill the cache with the metadata for every known path, the most "
+            "popular paths first, so that a deploy or cache flush doesn't "
+            "send every request to the database.")
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=4,
+            help='Number of threads resolving metadata at the same time.'),
+        make_option('--access-log', dest='access_log', default=None,
+            help='Access log to read, to warm the most requested paths first.'),
+        make_option('--site', dest='site', default=None,
+            help='Domain of the site to warm the cache for.'),
+        make_option('--limit', dest='limit', type='int', default=None,
+            help='Only warm this many paths for each metadata definition.'),
+    )
+
+    def handle(self, *names, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        site = None
+        if options.get('site'):
+            try:
+                site = Site.objects.get(domain=options['site'])
+            except Site.DoesNotExist:
+                raise CommandError(u"Site with domain \"%s\" does not exist." % options['site'])
+
+        hits = {}
+        if options.get('access_log'):
+            stream = open(options['access_log'], 'rb')
+            try:
+                hits = parse_access_log(stream)
+            finally:
+                stream.close()
+
+        for name in names or registry.keys():
+            if name not in registry:
+                raise CommandError(u"Metadata definition with name \"%s\" does not exist." % name)
+            Metadata = registry[name]
+            if not Metadata._meta.use_cache:
+                if verbosity > 1:
+                    self.stdout.write("%s: not cached, skipping\n" % name)
+                continue
+
+            paths = get_known_paths(Metadata)
+            # Most popular first, keeping languages together
+            paths.sort(key=lambda (path, language): (-hits.get(path, 0), language))
+            if options.get('limit') is not None:
+                paths = paths[:options['limit']]
+
+            warm_metadata_cache(Metadata, paths, site, workers=options.get('workers') or 1)
+            if verbosity > 0:
+                self.stdout.write("%s: warmed %d paths\n" % (name, len(paths)))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import time
+
+from django.conf import settings
+from rollyourown.seo.base import registry
+from rollyourown.seo.db import can_query_from_threads, written_since
+from rollyourown.seo.utils import WorkerPool
+
+# Threads looking up metadata for requests, ahead of time
+prefetch_pool = WorkerPool(getattr(settings, 'SEO_PREFETCH_WORKERS', 4))
+
+
+def _get_prefetch_definitions():
+    """ The metadata definitions to look up when a request arrives: those
+        named in SEO_PREFETCH, or the only definition if there is just one.
+    """
+    names = getattr(settings, 'SEO_PREFETCH', None)
+    if names is None:
+        return len(registry) == 1 and registry.values() or []
+    return [registry[name] for name in names]
+
+
+def prefetch_metadata(request, Metadata, path, site=None, language=None):
+    """ Starts looking up the metadata for the given path in the background.
+        The result is kept on the request, for get_request_metadata.
+        Nothing is done if the pool is busy or the database can't be shared
+        between threads.
+    """
+    for model in Metadata._meta.models.values():
+        if not can_query_from_threads(model):
+            return
+    job = prefetch_pool.try_submit(Metadata._prefetch_instances, path, site, language)
+    if job is not None:
+        job.started = time.time()
+        if not hasattr(request, '_seo_prefetched'):
+            request._seo_prefetched = {}
+        request._seo_prefetched[(Metadata, path, site, language)] = job
+
+
+def get_request_metadata(request, Metadata, path, context=None, site=None, language=None):
+    """ Returns the metadata for the given path, using the instances looked up
+        when the request arrived, if there are any. If they aren't ready within
+        SEO_PREFETCH_TIMEOUT seconds, the lookup failed, or metadata has since
+        been changed by this request, they are looked up again.
+
+        The result is remembered for the rest of the request, so that the 
+        template tag and the context processor share a single lookup. 
+        Metadata using a view's context is looked up again for a new context.
+    """
+    key = (Metadata, path, site, language)
+    if not hasattr(request, '_seo_metadata'):
+        request._seo_metadata = {}
+    remembered = request._seo_metadata.get(key)
+    if remembered is not None:
+        metadata, metadata_context, started = remembered
+        if not written_since(started) and (context is None or context is metadata_context 
+                                            or not metadata._uses_view_context()):
+            return metadata
+
+    started = time.time()
+    instances = None
+    job = getattr(request, '_seo_prefetched', {}).get(key)
+    if job is not None and not written_since(job.started):
+        try:
+            instances = job.get(getattr(settings, 'SEO_PREFETCH_TIMEOUT', 0.5))
+        except Exception:
+            # Slow or failed, look the metadata up again here
+            pass
+    metadata = Metadata._get_formatted_data(path, context, site, language, instances)
+    request._seo_metadata[key] = (metadata, context, started)
+    return metadata
+
+
+class MetadataPrefetchMiddleware(object):
+    """ Starts looking up the metadata for the requested path as soon as the
+        request arrives, so that the queries run at the same time as the view.
+        {% get_metadata %} then uses the result.
+    """
+
+    def process_request(self, request):
+        if request.method in ('GET', 'HEAD'):
+            for Metadata in _get_prefetch_definitions():
+                prefetch_metadata(request, Metadata, request.path)
@@ -1,19 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import time
 from django.conf import settings
+from rollyourown.seo.utils import startup_timings
+
+start = time.time()
 
 # Look for Metadata subclasses in appname/seo.py files
 for app in settings.INSTALLED_APPS:
     try:
         module_name = '%s.seo' % str(app)
-        __import__(module_name)
+        startup_timings.measure('import %s' % module_name, __import__, module_name)
     except ImportError:
         pass
 
 # if SEO_MODELS is defined, create a default Metadata class
 if hasattr(settings, 'SEO_MODELS'):
-    __import__('rollyourown.seo.default')
+    startup_timings.measure('import rollyourown.seo.default', __import__, 'rollyourown.seo.default')
 
 from rollyourown.seo.base import register_signals
-register_signals()
+startup_timings.measure('register_signals()', register_signals)
+startup_timings.add('total (rollyourown.seo.models)', time.time() - start)
@@ -3,7 +3,10 @@
 
 from django.db.models.options import get_verbose_name
 from django.db import models
+from django.db.models.loading import app_cache_ready
 from django.utils.datastructures import SortedDict
+from django.utils.hashcompat import md5_constructor
+from rollyourown.seo.utils import Literal
 
 class Options(object):
     def __init__(self, meta, help_text=None):
@@ -11,6 +14,12 @@ class Options(object):
         self.use_i18n = meta.pop('use_i18n', False)
         self.use_redirect = meta.pop('use_redirect', False)
         self.use_cache = meta.pop('use_cache', False)
+        self.sparse_instances = meta.pop('sparse_instances', False)
+        self.static_file = meta.pop('static_file', None)
+        self.read_database = meta.pop('read_database', None)
+        self.concurrent_lookups = meta.pop('concurrent_lookups', False)
+        self.prerender = meta.pop('prerender', False)
+        self.prerender_version = None
         self.groups = meta.pop('groups', {})
         self.seo_views = meta.pop('seo_views', [])
         self.verbose_name = meta.pop('verbose_name', None)
@@ -22,7 +31,9 @@ class Options(object):
         self.models = SortedDict()
         self.name = None
         self.elements = None
+        self.element_index = None
         self.metadata = None
+        self.instance = None
 
     def get_model(self, name):
         try:
@@ -43,6 +54,14 @@ class Options(object):
         for key, obj in elements.items():
             obj.contribute_to_class(self.metadata, key)
 
+        # Positions of the fields, for records holding values by position
+        self.element_index = dict((key, i) for i, key in enumerate(elements))
+
+        # The fields to render for the head and for each group, worked out once
+        self.head_elements = tuple((key, obj) for key, obj in elements.items() if obj.head)
+        self.group_elements = dict((group, tuple((key, elements[key]) for key in members))
+                                        for group, members in self.groups.items())
+
         # Create the common Django fields
         fields = {}
         for key, obj in elements.items():
@@ -53,6 +72,11 @@ class Options(object):
                         field.help_text = self.bulk_help_text[key]
                 fields[key] = field
 
+        # Values cleaned and rendered when saved, see Meta.prerender
+        if self.prerender:
+            fields['_rendered'] = models.TextField(default="", blank=True, editable=False)
+            self.prerender_version = self._get_prerender_version()
+
         # 0. Abstract base model with common fields
         base_meta = type('Meta', (), self.original_meta)
         class BaseMeta(base_meta):
@@ -63,6 +87,24 @@ class Options(object):
         fields['__module__'] = __name__ #attrs['__module__']
         self.MetadataBaseModel = type('%sBase' % self.name, (models.Model,), fields)
 
+    def _get_prerender_version(self):
+        """ A checksum of everything in the definition that affects how values
+            are cleaned and rendered, so that values rendered for an older
+            definition aren't used.
+        """
+        checksum = md5_constructor()
+        for key, element in self.elements.items():
+            populate_from = element.populate_from
+            if isinstance(populate_from, Literal):
+                populate_from = populate_from.value
+            elif callable(populate_from):
+                populate_from = getattr(populate_from, '__name__', 'callable')
+            valid_tags = element.get_valid_tags()
+            checksum.update(repr((key, element.__class__.__name__, element.name, element.head, element.editable,
+                                  getattr(element, 'escape_value', None), unicode(populate_from),
+                                  valid_tags is not None and sorted(valid_tags) or None)))
+        return checksum.hexdigest()
+
     def _add_backend(self, backend):
         """ Builds a subclass model for the given backend """
         md_type = backend.verbose_name
@@ -74,6 +116,7 @@ class Options(object):
         new_md_meta['verbose_name'] = '%s (%s)' % (self.verbose_name, md_type)
         new_md_meta['verbose_name_plural'] = '%s (%s)' % (self.verbose_name_plural, md_type)
         new_md_meta['unique_together'] = base._meta.unique_together
+        new_md_meta['managed'] = base._meta.managed
         new_md_attrs['Meta'] = type("Meta", (), new_md_meta)
         new_md_attrs['_metadata_type'] = backend.name
         model = type("%s%s"%(self.name,"".join(md_type.split())), (base, self.MetadataBaseModel), new_md_attrs.copy())
@@ -82,19 +125,47 @@ class Options(object):
         globals()[model.__name__] = model
 
     def _set_seo_models(self, value):
-        """ Gets the actual models to be used. """
-        seo_models = []
-        for model_name in value:
-            if "." in model_name:
-                app_label, model_name = model_name.split(".", 1)
-                model = models.get_model(app_label, model_name)
-                if model:
-                    seo_models.append(model)
-            else:
-                app = models.get_app(model_name)
-                if app:
-                    seo_models.extend(models.get_models(app))
-    
-        self.seo_models = seo_models
+        """ Remembers the models to be used, by name. They are only found when
+            first needed, importing every installed app's models at that time
+            instead of while Metadata definitions are being created.
+        """
+        self._seo_model_names = value
+        self._seo_models = None
 
+    def _get_seo_models(self):
+        """ Gets the actual models to be used. These are not kept until the
+            app cache is ready, as apps still loading would be left out.
+        """
+        if self._seo_models is None:
+            seo_models = []
+            for model_name in self._seo_model_names:
+                if "." in model_name:
+                    app_label, model_name = model_name.split(".", 1)
+                    model = models.get_model(app_label, model_name)
+                    if model:
+                        seo_models.append(model)
+                else:
+                    app = models.get_app(model_name)
+                    if app:
+                        seo_models.extend(models.get_models(app))
+            if not app_cache_ready():
+                return seo_models
+            self._seo_models = seo_models
+        return self._seo_models
+    seo_models = property(_get_seo_models)
 
+    def is_seo_model(self, model):
+        """ Checks by name if the given model is one of seo_models, without
+            loading any apps.
+        """
+        opts = model._meta
+        if opts.abstract or opts.auto_created or getattr(model, '_deferred', False):
+            return False
+        for model_name in self._seo_model_names:
+            if "." in model_name:
+                app_label, model_name = model_name.split(".", 1)
+                if (opts.app_label, opts.object_name.lower()) == (app_label, model_name.lower()):
+                    return True
+            elif opts.app_label == model_name:
+                return True
+        return False
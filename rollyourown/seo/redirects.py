@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Redirects from old paths, added when the path of some metadata changes
+    (see Meta.use_redirect). Redirects are stored using the
+    django.contrib.redirects app.
+
+    RedirectFallbackMiddleware serves them from an index held in memory, so
+    that pages which don't exist don't cost a query. The index is rebuilt
+    when redirects change, other processes are told through the cache.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django import http
+
+from rollyourown.seo.db import GENERATION_TIMEOUT
+
+GENERATION_KEY = 'rollyourown.seo.redirects.generation'
+
+
+def add_redirect(old_path, new_path, site=None):
+    """ Redirects the old path to the new one, on the given site (or the
+        current site).
+    """
+    from django.contrib.redirects.models import Redirect
+    site_id = site and site.id or settings.SITE_ID
+
+    # The new path is in use again, so it mustn't redirect
+    Redirect.objects.filter(site=site_id, old_path=new_path).delete()
+    # Rather than redirect twice, send old redirects straight to the new path
+    Redirect.objects.filter(site=site_id, new_path=old_path).update(new_path=new_path)
+
+    redirect, created = Redirect.objects.get_or_create(site_id=site_id, old_path=old_path,
+                                                       defaults={'new_path': new_path})
+    if not created and redirect.new_path != new_path:
+        redirect.new_path = new_path
+        redirect.save()
+    invalidate_redirects()
+
+
+def get_generation():
+    """ A value that changes whenever redirects are changed, in any process. """
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start a generation, unless another process has just done so
+        cache.add(GENERATION_KEY, time.time(), GENERATION_TIMEOUT)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+class RedirectIndex(object):
+    """ All redirects, by site and old path. """
+
+    def __init__(self):
+        self.redirects = None
+        self.generation = None
+
+    def get(self, site_id, path):
+        """ Returns the new path for the given site and old path, or None.
+            The index is only rebuilt when redirects have changed.
+        """
+        generation = get_generation()
+        redirects = self.redirects
+        if redirects is None or generation != self.generation:
+            from django.contrib.redirects.models import Redirect
+            redirects = dict(((site, old_path), new_path) for site, old_path, new_path
+                                in Redirect.objects.values_list('site', 'old_path', 'new_path'))
+            self.redirects, self.generation = redirects, generation
+        return redirects.get((site_id, path))
+
+redirect_index = RedirectIndex()
+
+
+def invalidate_redirects(**kwargs):
+    """ Rebuilds the index of redirects in every process, when it is next used.
+        This can be connected to signals.
+    """
+    redirect_index.redirects = None
+    cache.set(GENERATION_KEY, time.time(), GENERATION_TIMEOUT)
+
+
+class RedirectFallbackMiddleware(object):
+    """ Redirects requests for missing pages, if there is a redirect for the
+        path. This replaces the django.contrib.redirects middleware, without
+        a query for every missing page.
+
+        As with the django.contrib.redirects middleware, when APPEND_SLASH is
+        set, a redirect for the path without its trailing slash is also used.
+    """
+
+    def process_response(self, request, response):
+        if response.status_code != 404:
+            return response
+        full_path = request.get_full_path()
+        new_path = redirect_index.get(settings.SITE_ID, full_path)
+        if new_path is None and full_path != request.path:
+            new_path = redirect_index.get(settings.SITE_ID, request.path)
+        if new_path is None and settings.APPEND_SLASH:
+            # Try removing the trailing slash
+            slash = full_path.rfind('/')
+            new_path = redirect_index.get(settings.SITE_ID, full_path[:slash] + full_path[slash+1:])
+        if new_path is None:
+            return response
+        if new_path == '':
+            return http.HttpResponseGone()
+        return http.HttpResponsePermanentRedirect(new_path)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Read-only snapshots of resolved metadata, shared between processes.
+
+    A snapshot holds the final values of every field for every known path,
+    in a single file that each process opens using mmap. The operating
+    system shares the pages between processes, so many server processes on
+    one machine can read it without each keeping its own copy.
+
+    Layout of a snapshot file:
+
+        MAGIC
+        records     one JSON object per path, with the non-empty values
+        index       sorted (md5 of key, record offset, record length) entries
+        header      JSON object, describing the snapshot
+        trailer     index offset, number of entries and header length
+
+    Snapshots are replaced by renaming a new file over the old one, running
+    processes notice the change and open the new file.
+"""
+
+import os
+import mmap
+import time
+import struct
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+from django.utils.encoding import iri_to_uri
+from rollyourown.seo.utils import ResolvedRecord
+
+MAGIC = 'SEOSNAP1'
+INDEX_ENTRY = struct.Struct('>16sII')
+TRAILER = struct.Struct('>QII')
+
+# How often (in seconds) to check if a snapshot file has been replaced
+CHECK_INTERVAL = 1
+
+
+def snapshot_key(path, language=None):
+    """ The index key for the given path and language. """
+    return md5_constructor('%s\n%s' % (iri_to_uri(path), language or '')).digest()
+
+
+class Snapshot(object):
+    """ An open snapshot file. """
+
+    def __init__(self, filename):
+        stream = open(filename, 'rb')
+        try:
+            stat = os.fstat(stream.fileno())
+            self.generation = (stat.st_ino, stat.st_mtime)
+            self.data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            stream.close()
+        if self.data[:len(MAGIC)] != MAGIC or len(self.data) < len(MAGIC) + TRAILER.size:
+            raise ValueError("%s is not a metadata snapshot" % filename)
+        self.index_offset, self.count, header_length = TRAILER.unpack(self.data[-TRAILER.size:])
+        header_offset = len(self.data) - TRAILER.size - header_length
+        self.header = simplejson.loads(self.data[header_offset:header_offset + header_length])
+
+    def get(self, path, language=None):
+        """ Returns the stored values for the given path, or None if the path
+            is not in the snapshot. Uses a binary search of the index.
+        """
+        key = snapshot_key(path, language)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = self.index_offset + middle * INDEX_ENTRY.size
+            digest, offset, length = INDEX_ENTRY.unpack(self.data[start:start + INDEX_ENTRY.size])
+            if digest < key:
+                low = middle + 1
+            elif digest > key:
+                high = middle
+            else:
+                return simplejson.loads(self.data[offset:offset + length])
+        return None
+
+
+def write_snapshot(filename, records, site=None):
+    """ Writes the given (path, language, values) records to a new snapshot,
+        which replaces the given file in a single step.
+        Returns the number of records written.
+    """
+    index = []
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    stream = open(tmp_filename, 'wb')
+    try:
+        stream.write(MAGIC)
+        offset = len(MAGIC)
+        for path, language, values in records:
+            data = simplejson.dumps(values)
+            stream.write(data)
+            index.append((snapshot_key(path, language), offset, len(data)))
+            offset += len(data)
+
+        index.sort()
+        for entry in index:
+            stream.write(INDEX_ENTRY.pack(*entry))
+        header = simplejson.dumps({'site': site and site.domain or None, 'created': time.time()})
+        stream.write(header)
+        stream.write(TRAILER.pack(offset, len(index), len(header)))
+        stream.flush()
+        os.fsync(stream.fileno())
+    except:
+        stream.close()
+        os.remove(tmp_filename)
+        raise
+    stream.close()
+    os.rename(tmp_filename, filename)
+    return len(index)
+
+
+def get_snapshot_filename(name):
+    """ The snapshot file of the given metadata definition, if snapshots are
+        enabled (using the SEO_SNAPSHOT_DIR setting).
+    """
+    directory = getattr(settings, 'SEO_SNAPSHOT_DIR', None)
+    if directory:
+        return os.path.join(directory, '%s.snapshot' % name)
+
+
+# Open snapshots in this process, with the time they were last checked
+_snapshots = {}
+
+def get_snapshot(name):
+    """ The current snapshot of the given metadata definition, or None. """
+    filename = get_snapshot_filename(name)
+    if filename is None:
+        return None
+
+    snapshot, checked = _snapshots.get(name, (None, 0))
+    now = time.time()
+    if now - checked < CHECK_INTERVAL:
+        return snapshot
+
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        snapshot = None
+    else:
+        if snapshot is None or snapshot.generation != (stat.st_ino, stat.st_mtime):
+            try:
+                snapshot = Snapshot(filename)
+            except (IOError, ValueError):
+                snapshot = None
+    _snapshots[name] = (snapshot, now)
+    return snapshot
+
+
+def get_snapshot_record(Metadata, path, site=None, language=None):
+    """ Returns a record with the stored values for the given path, or None
+        if there is no snapshot or the path isn't in it.
+    """
+    snapshot = get_snapshot(Metadata.__name__)
+    if snapshot is None:
+        return None
+    if Metadata._meta.use_sites:
+        if isinstance(site, Site):
+            site = site.domain
+        if site != snapshot.header['site']:
+            return None
+    values = snapshot.get(path, language)
+    if values is not None:
+        return ResolvedRecord(Metadata._meta.element_index, 
+                              tuple([values.get(name) for name in Metadata._meta.elements]))
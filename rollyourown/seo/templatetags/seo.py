@@ -1,39 +1,53 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import hashlib
+
 from django import template
-from rollyourown.seo import get_metadata, get_linked_metadata
+from django.core.cache import cache
+from django.utils.encoding import iri_to_uri
+from rollyourown.seo.base import _get_metadata_model, MetadataNotRegistered
+from rollyourown.seo.db import get_generation
+from rollyourown.seo.middleware import get_request_metadata
 from django.template import VariableDoesNotExist
 
 register = template.Library()
 
 class MetadataNode(template.Node):
-    def __init__(self, metadata_name, variable_name, target, site, language):
+    def __init__(self, metadata_name, variable_name, target, site, language, timeout=None):
         self.metadata_name = metadata_name
         self.variable_name = variable_name
-        self.target = template.Variable(target or 'request.path')
+        self.target = target and template.Variable(target) or None
         self.site = site and template.Variable(site) or None
         self.language = language and template.Variable(language) or None
+        self.timeout = timeout and template.Variable(timeout) or None
+
+        # Find the metadata definition now, rather than on every render.
+        # If it hasn't been registered yet, try again (and report it) when rendering.
+        try:
+            self.metadata = _get_metadata_model(metadata_name)
+        except MetadataNotRegistered:
+            self.metadata = None
+        except Exception, e:
+            raise template.TemplateSyntaxError(e)
 
     def render(self, context):
+        request = context.get('request')
         try:
-            target = self.target.resolve(context)
+            if self.target is None:
+                # The default target, request.path
+                if request is None:
+                    raise VariableDoesNotExist
+                target = request.path
+            else:
+                target = self.target.resolve(context)
         except VariableDoesNotExist:
             msg = (u"{% get_metadata %} needs some path information.\n"
                         u"Please use RequestContext with the django.core.context_processors.request context processor.\n"
                         "Or provide a path or object explicitly, eg {% get_metadata for path %} or {% get_metadata for object %}")
             raise template.TemplateSyntaxError(msg)
-        else:
-            if callable(target):
-                target = target()
-            if isinstance(target, basestring):
-                path = target
-            elif hasattr(target, 'get_absolute_url'):
-                path = target.get_absolute_url()
-            elif hasattr(target, "__iter__") and 'get_absolute_url' in target:
-                path = target['get_absolute_url']()
-            else:
-                path = None
+        if callable(target):
+            target = target()
 
         kwargs = {}
 
@@ -45,25 +59,64 @@ class MetadataNode(template.Node):
         if self.language:
             kwargs['language'] = self.language.resolve(context)
 
-        metadata = None
-        # If the target is a django model object
-        if hasattr(target, 'pk'):
-            metadata = get_linked_metadata(target, self.metadata_name, context, **kwargs)
-        if not isinstance(path, basestring):
-            path = None
-        if not metadata:
-            # Fetch the metadata
-            try:
-                metadata = get_metadata(path, self.metadata_name, context, **kwargs)
-            except Exception, e:
-                raise template.TemplateSyntaxError(e)
+        try:
+            metadata_class = self.metadata or _get_metadata_model(self.metadata_name)
+
+            # Django model objects use their linked metadata, not a path
+            if hasattr(target, 'pk'):
+                path = None
+            elif isinstance(target, basestring):
+                path = target
+            elif hasattr(target, 'get_absolute_url'):
+                path = target.get_absolute_url()
+            elif hasattr(target, "__iter__") and 'get_absolute_url' in target:
+                path = target['get_absolute_url']()
+            else:
+                path = None
+            if not isinstance(path, basestring):
+                path = None
+
+            # The output may already be in the cache
+            if self.timeout is not None:
+                fragment_key = self.get_fragment_key(metadata_class, target, path, **kwargs)
+                fragment = cache.get(fragment_key)
+                if fragment is not None:
+                    return fragment
+
+            # If the target is a django model object, use its linked metadata
+            if hasattr(target, 'pk'):
+                metadata = metadata_class._get_linked_formatted_data(target, **kwargs)
+            # Use any metadata looked up when the request arrived
+            elif request is not None:
+                metadata = get_request_metadata(request, metadata_class, path, context, **kwargs)
+            else:
+                metadata = metadata_class._get_formatted_data(path, context, **kwargs)
+        except template.TemplateSyntaxError:
+            raise
+        except Exception, e:
+            raise template.TemplateSyntaxError(e)
 
         # If a variable name is given, store the result there
         if self.variable_name is not None:
             context[self.variable_name] = metadata
             return ""
+
+        output = unicode(metadata)
+        # Output substituted from the context is only right for this one
+        if self.timeout is not None and not metadata._depends_on_context():
+            cache.set(fragment_key, output, int(self.timeout.resolve(context)))
+        return output
+
+    def get_fragment_key(self, metadata_class, target, path, site=None, language=None):
+        """ The cache key for the output, which changes whenever the metadata
+            definition's metadata is written. 
+        """
+        if hasattr(target, 'pk'):
+            target = u'%s.%s:%s' % (target._meta.app_label, target._meta.object_name, target.pk)
         else:
-            return unicode(metadata)
+            target = path
+        key = u'%s|%s|%s|%s' % (get_generation(metadata_class), target, site, language)
+        return 'rollyourown.seo.fragment.%s.%s' % (metadata_class.__name__, hashlib.md5(iri_to_uri(key)).hexdigest())
 
 
 def do_get_metadata(parser, token):
@@ -76,12 +129,16 @@ def do_get_metadata(parser, token):
 
         {% get_metadata MyClass [for my_path] [in my_language] [on my_site] [as my_variable] %}
 
+        The output can be cached for a number of seconds:
+
+        {% get_metadata [MyClass] [for my_path] [in my_language] [on my_site] cached 600 %}
+
     """
     bits = list(token.split_contents())
     tag_name = bits[0]
     bits = bits[1:]
     metadata_name = None
-    args = { 'as': None, 'for': None, 'in': None, 'on': None }
+    args = { 'as': None, 'for': None, 'in': None, 'on': None, 'cached': None }
 
     # If there are an even number of bits, 
     # a metadata name has been provided.
@@ -97,11 +154,16 @@ def do_get_metadata(parser, token):
         key, value, bits = bits[0], bits[1], bits[2:]
         args[key] = value
 
+    # Only the output is cached, not the metadata itself
+    if args['as'] and args['cached']:
+        raise template.TemplateSyntaxError("%r can't use both 'as' and 'cached'" % tag_name)
+
     return MetadataNode(metadata_name, 
                 variable_name = args['as'], 
                 target = args['for'], 
                 site = args['on'], 
-                language = args['in'])
+                language = args['in'],
+                timeout = args['cached'])
 
 
 register.tag('get_metadata', do_get_metadata)
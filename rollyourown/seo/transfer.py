@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+""" Streaming export and import of metadata, for moving it between
+    environments. Rows are read and written in chunks, so that memory use
+    stays constant, and are saved in bulk without sending any signals.
+
+    Content types are exported as "app_label.model" and sites by their
+    domain, so that they can be found again in a database where they have
+    a different id.
+"""
+
+import csv
+from bisect import bisect_right
+from django.utils.hashcompat import md5_constructor
+
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.db.models import AutoField, Q
+from django.utils import simplejson
+
+from rollyourown.seo.backends import backend_registry
+from rollyourown.seo.db import bulk_insert, bulk_update, delete_metadata, MAX_QUERY_PARAMS
+
+FORMATS = ('jsonl', 'csv')
+
+# Number of ranges of rows in the checksum tree of each table
+DEFAULT_BUCKETS = 256
+
+
+def get_fields(model):
+    """ The fields that are exported for the given backend model. """
+    return [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+
+
+def get_natural_key(model):
+    """ The fields identifying a row of the given backend model in any database. """
+    backend = backend_registry[model._metadata_type]
+    return [model._meta.get_field(name) for name in backend().get_natural_key(model._metadata._meta)]
+
+
+def _export_value(field, value, using=None, sites=None):
+    if value is not None and field.rel and field.rel.to is ContentType:
+        content_type = ContentType.objects.db_manager(using).get_for_id(value)
+        return u'%s.%s' % (content_type.app_label, content_type.model)
+    if value is not None and field.rel and field.rel.to is Site:
+        # Remember the domains already found, if given somewhere to do so
+        if sites is None:
+            sites = {}
+        if value not in sites:
+            sites[value] = Site.objects.db_manager(using).get(pk=value).domain
+        return sites[value]
+    return value
+
+
+def _import_value(field, value, using=None):
+    if value in ('', None) and field.null:
+        return None
+    if field.rel and field.rel.to is ContentType:
+        app_label, model_name = value.split('.', 1)
+        return ContentType.objects.db_manager(using).get_by_natural_key(app_label, model_name).pk
+    if field.rel and field.rel.to is Site:
+        return Site.objects.db_manager(using).get(domain=value).pk
+    if field.rel:
+        return field.rel.get_related_field().to_python(value)
+    return field.to_python(value)
+
+
+def _chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def export_rows(model, chunk_size=MAX_QUERY_PARAMS, using=None):
+    """ Generates a dictionary for every row of the given backend model,
+        reading the table in primary key order, one chunk at a time.
+    """
+    fields = get_fields(model)
+    queryset = model.objects.db_manager(using).order_by('pk').values_list('pk', *[f.name for f in fields])
+    sites = {}
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        for values in chunk:
+            yield dict((f.name, _export_value(f, v, using, sites)) for f, v in zip(fields, values[1:]))
+        last_pk = chunk[-1][0]
+
+
+def import_rows(model, rows, chunk_size=MAX_QUERY_PARAMS, using=None):
+    """ Saves the given rows to the given backend model. Rows already present
+        (using the backend's natural key) are updated, the others are created.
+        Only the fields given in a row are updated, the rest of an existing
+        row is left alone.
+        Returns the number of rows created, updated and skipped (because they
+        clash with existing rows).
+    """
+    fields = get_fields(model)
+    natural_key = get_natural_key(model)
+    created = updated = skipped = 0
+
+    for chunk in _chunks(rows, chunk_size):
+        # Latest row wins, if a key appears more than once
+        objs = {}
+        for row in chunk:
+            obj = model(**dict((f.attname, _import_value(f, row[f.name], using)) for f in fields if f.name in row))
+            obj._imported_fields = tuple(f for f in fields if f.name in row and f not in natural_key)
+            objs[tuple(getattr(obj, f.attname) for f in natural_key)] = obj
+
+        # Find existing rows for this chunk, using one query
+        lookup = {}
+        for f in natural_key:
+            if not f.null:
+                lookup['%s__in' % f.name] = set(key[natural_key.index(f)] for key in objs)
+        existing = model.objects.db_manager(using).filter(**lookup).values_list('pk', *[f.name for f in natural_key])
+        existing = dict((tuple(values[1:]), values[0]) for values in existing)
+
+        new_objs = []
+        # Existing rows, by the fields to update
+        changed_objs = {}
+        for key, obj in objs.items():
+            if key in existing:
+                obj.pk = existing[key]
+                changed_objs.setdefault(obj._imported_fields, []).append(obj)
+            else:
+                new_objs.append(obj)
+
+        for update_fields, field_objs in changed_objs.items():
+            if update_fields:
+                bulk_update(model, field_objs, update_fields, using=using)
+            updated += len(field_objs)
+        if bulk_insert(model, new_objs, using=using):
+            created += len(new_objs)
+        else:
+            # Something clashes (eg a path), find out which rows are ok
+            for obj in new_objs:
+                if bulk_insert(model, [obj], using=using):
+                    created += 1
+                else:
+                    skipped += 1
+
+    return created, updated, skipped
+
+
+def row_key(natural_key, row):
+    """ The natural key of an exported row. """
+    return tuple(row[f.name] for f in natural_key)
+
+
+def _row_hash(row):
+    return int(md5_constructor(simplejson.dumps(row, sort_keys=True)).hexdigest(), 16)
+
+
+def _range_fields(model):
+    """ The columns rows are ordered by, to split a table into ranges of
+        natural keys that can be selected in any database. Content types
+        and sites are ordered by their natural keys, rather than their ids.
+        Columns which may be NULL are left out, rows differing only by 
+        those always share a range.
+    """
+    names = []
+    for f in get_natural_key(model):
+        if f.null:
+            continue
+        if f.rel and f.rel.to is ContentType:
+            names.extend(['%s__app_label' % f.name, '%s__model' % f.name])
+        elif f.rel and f.rel.to is Site:
+            names.append('%s__domain' % f.name)
+        else:
+            names.append(f.name)
+    return names
+
+
+def range_key(natural_key, row):
+    """ The values of an exported row for the columns of _range_fields. """
+    key = []
+    for f in natural_key:
+        if f.null:
+            continue
+        if f.rel and f.rel.to is ContentType:
+            key.extend(row[f.name].split('.', 1))
+        else:
+            key.append(row[f.name])
+    return tuple(key)
+
+
+def _from_key(fields, key):
+    """ A filter selecting rows from the given range key onwards. """
+    q = Q(**dict(zip(fields, key)))
+    for i in range(len(fields)):
+        lookup = dict(zip(fields[:i], key[:i]))
+        lookup['%s__gt' % fields[i]] = key[i]
+        q |= Q(**lookup)
+    return q
+
+
+def range_rows(model, lower=None, upper=None, using=None):
+    """ Generates the rows of the given backend model, in range key order,
+        from the lower range key up to (but not including) the upper one.
+        Only these rows are read from the database.
+    """
+    fields = get_fields(model)
+    range_fields = _range_fields(model)
+    queryset = model.objects.db_manager(using).order_by(*range_fields)
+    if lower is not None:
+        queryset = queryset.filter(_from_key(range_fields, lower))
+    if upper is not None:
+        queryset = queryset.exclude(_from_key(range_fields, upper))
+    sites = {}
+    for values in queryset.values_list(*[f.name for f in fields]).iterator():
+        yield dict((f.name, _export_value(f, v, using, sites)) for f, v in zip(fields, values))
+
+
+def table_checksums(model, buckets=DEFAULT_BUCKETS, using=None, boundaries=None):
+    """ Checksums the rows of the given backend model, in a (flat) Merkle tree.
+        The table is split into ranges of natural keys, so that the same row
+        lands in the same range in every database, whatever its primary key,
+        and the rows of a range can be selected by themselves. A range's 
+        checksum combines its rows in any order, the root checksum combines
+        all of the ranges.
+
+        The ranges are given by their boundaries, the range keys that start
+        every range but the first. To compare tables, checksum the second 
+        table using the boundaries found for the first, which splits it
+        into about the given number of ranges.
+    """
+    natural_key = get_natural_key(model)
+    if boundaries is None:
+        size = max(1, -(-model.objects.db_manager(using).count() // buckets))
+        found = []
+    else:
+        boundaries = [tuple(key) for key in boundaries]
+    sums = [0] * (boundaries is None and 1 or len(boundaries) + 1)
+    count = 0
+    last_key = None
+    for row in range_rows(model, using=using):
+        key = range_key(natural_key, row)
+        if boundaries is None:
+            # Start a new range, but never between rows with the same key
+            if count >= size and key != last_key:
+                found.append(key)
+                sums.append(0)
+                count = 0
+            count += 1
+            last_key = key
+            index = len(found)
+        else:
+            index = bisect_right(boundaries, key)
+        sums[index] ^= _row_hash(row)
+    if boundaries is None:
+        boundaries = found
+    sums = ['%x' % value for value in sums]
+    return {'root': md5_constructor(''.join(sums)).hexdigest(), 'buckets': sums, 'boundaries': boundaries}
+
+
+def mismatched_buckets(checksums, other_checksums):
+    """ Returns the ranges whose checksums differ. """
+    if checksums['root'] == other_checksums['root']:
+        return set()
+    return set(i for i, (a, b) in enumerate(zip(checksums['buckets'], other_checksums['buckets'])) if a != b)
+
+
+def bucket_rows(model, boundaries, selected, using=None):
+    """ Generates the rows of the given backend model in the selected ranges,
+        selecting neighbouring ranges together.
+    """
+    boundaries = [tuple(key) for key in boundaries]
+    natural_key = get_natural_key(model)
+    selected = sorted(selected)
+    while selected:
+        first = last = selected.pop(0)
+        while selected and selected[0] == last + 1:
+            last = selected.pop(0)
+        lower = upper = None
+        if first > 0:
+            lower = boundaries[first - 1]
+        if last < len(boundaries):
+            upper = boundaries[last]
+        for row in range_rows(model, lower, upper, using=using):
+            # In case the database orders text differently to python
+            if first <= bisect_right(boundaries, range_key(natural_key, row)) <= last:
+                yield row
+
+
+def diff_rows(model, boundaries, selected, source, target):
+    """ Compares the rows in the selected ranges of two databases.
+        Returns the rows missing from the target, the rows that differ
+        and the keys of rows that are only in the target.
+    """
+    natural_key = get_natural_key(model)
+    source_rows = dict((row_key(natural_key, row), row) for row in bucket_rows(model, boundaries, selected, source))
+    target_rows = dict((row_key(natural_key, row), row) for row in bucket_rows(model, boundaries, selected, target))
+    missing = [row for key, row in source_rows.items() if key not in target_rows]
+    changed = [row for key, row in source_rows.items() if key in target_rows and row != target_rows[key]]
+    extra = [key for key in target_rows if key not in source_rows]
+    return missing, changed, extra
+
+
+def delete_rows(model, keys, using=None):
+    """ Deletes the rows with the given natural keys. """
+    natural_key = get_natural_key(model)
+    pks = []
+    for key in keys:
+        lookup = dict((f.name, _import_value(f, value, using)) for f, value in zip(natural_key, key))
+        pks.extend(model.objects.db_manager(using).filter(**lookup).values_list('pk', flat=True))
+    delete_metadata(model, pks, using=using)
+
+
+def write_rows(rows, stream, format, fieldnames):
+    """ Writes the given rows to a stream, as JSON lines or CSV. """
+    if format == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(fieldnames)
+        for row in rows:
+            writer.writerow([_encode_csv(row[name]) for name in fieldnames])
+    else:
+        for row in rows:
+            stream.write(simplejson.dumps(row))
+            stream.write('\n')
+
+
+def read_rows(stream, format):
+    """ Generates rows from a stream of JSON lines or CSV. """
+    if format == 'csv':
+        reader = csv.reader(stream)
+        fieldnames = reader.next()
+        for values in reader:
+            yield dict(zip(fieldnames, [v.decode('utf-8') for v in values]))
+    else:
+        for line in stream:
+            if line.strip():
+                yield simplejson.loads(line)
+
+
+def _encode_csv(value):
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8')
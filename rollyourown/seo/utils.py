@@ -2,12 +2,14 @@
 
 import logging
 import re
+import time
 
 from django.conf import settings
 from django.db import models
 from django.utils.functional import lazy
 from django.utils.safestring import mark_safe
-from django.utils.html import conditional_escape
+from django.utils.safestring import SafeData
+from django.utils.encoding import force_unicode
 from django.contrib.contenttypes.models import ContentType
 
 class NotSet(object):
@@ -23,6 +25,56 @@ class Literal(object):
         self.value = value
 
 
+class ResolvedRecord(object):
+    """ The final values of a metadata definition's fields, in place of the 
+        backend instances they were resolved from. Values are held by 
+        position (see Options.element_index), so that many records can be
+        kept around cheaply.
+    """
+    __slots__ = ('index', 'values')
+
+    def __init__(self, index, values):
+        self.index = index
+        self.values = values
+
+    def _resolve_value(self, name):
+        position = self.index.get(name)
+        if position is not None:
+            return self.values[position]
+
+
+class PrefixTrie(object):
+    """ Maps string prefixes to values. Every prefix of a given string is
+        found in a single pass over the string.
+    """
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(NotSet, []).append(value)
+
+    def find(self, string):
+        """ Lists the values for each prefix of the given string, longest prefix first. """
+        found = []
+        node = self.root
+        for char in string:
+            if NotSet in node:
+                found.append(node[NotSet])
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            if NotSet in node:
+                found.append(node[NotSet])
+        values = []
+        for node_values in reversed(found):
+            values.extend(node_values)
+        return values
+
+
 class LazyList(list):
     """ Generic python list which is populated when items are first accessed.
     """
@@ -129,15 +181,20 @@ def resolve_to_name(path, urlconf=None):
         return None
 
 
-def _replace_quot(match):
-    unescape = lambda v: v.replace('&quot;', '"').replace('&amp;', '&')
-    return u'<%s%s>' % (unescape(match.group(1)), unescape(match.group(3)))
+def _replace_token(match):
+    """ Reenables a tag or unhides a comment, found in escaped text. """
+    if match.lastindex is None:
+        return match.group(0).replace('&lt;', '<').replace('&gt;', '>')
+    # Comments may also be hidden inside a tag
+    return (u'<%s%s>' % (match.group(1), match.group(3))).replace('&quot;', '"').replace(
+                                                '&amp;', '&').replace("&lt;!--", "<!--")
 
 
-def escape_tags(value, valid_tags):
+class TagSanitizer(object):
     """ Strips text from the given html string, leaving only tags.
-        This functionality requires BeautifulSoup, nothing will be 
-        done otherwise.
+        The regular expression for the given tags is compiled once. After 
+        escaping, tags are reenabled and comments unhidden in a single pass
+        over the string.
 
         This isn't perfect. Someone could put javascript in here:
               <a onClick="alert('hi');">test</a>
@@ -148,19 +205,41 @@ def escape_tags(value, valid_tags):
               - use BeautifulSoup to understand the elements, escape everything else and remove potentially harmful attributes (onClick).
               - Remove this feature entirely. Half-escaping things securely is very difficult, developers should not be lured into a false sense of security.
     """
-    # 1. escape everything
-    value = conditional_escape(value)
 
-    # 2. Reenable certain tags
-    if valid_tags:
-        # TODO: precompile somewhere once?
-        tag_re = re.compile(r'&lt;(\s*/?\s*(%s))(.*?\s*)&gt;' % u'|'.join(re.escape(tag) for tag in valid_tags))
-        value = tag_re.sub(_replace_quot, value)
+    def __init__(self, valid_tags):
+        # Comments overlapping like "<!-->" are unhidden too
+        comments = r'&lt;!--(?:-*&gt;)?|--&gt;'
+        if valid_tags:
+            tags = u'|'.join(re.escape(tag) for tag in sorted(valid_tags))
+            self.token_re = re.compile(r'&lt;(\s*/?\s*(%s))(.*?\s*)&gt;|%s' % (tags, comments))
+        else:
+            self.token_re = re.compile(comments)
+
+    def __call__(self, value):
+        if not isinstance(value, SafeData):
+            value = force_unicode(value).replace('&', '&amp;').replace('<', '&lt;').replace(
+                            '>', '&gt;').replace('"', '&quot;').replace("'", '&#39;')
+        return mark_safe(self.token_re.sub(_replace_token, value))
 
-    # Allow comments to be hidden
-    value = value.replace("&lt;!--", "<!--").replace("--&gt;", "-->")
-    
-    return mark_safe(value)
+
+# Sanitizers already built, by set of valid tags
+_sanitizers = {}
+
+def get_sanitizer(valid_tags):
+    """ A sanitizer for the given tags, built only once. """
+    key = valid_tags and frozenset(valid_tags) or None
+    try:
+        return _sanitizers[key]
+    except KeyError:
+        sanitizer = _sanitizers[key] = TagSanitizer(key)
+        return sanitizer
+
+
+def escape_tags(value, valid_tags):
+    """ Strips text from the given html string, leaving only tags.
+        See TagSanitizer.
+    """
+    return get_sanitizer(valid_tags)(value)
 
 
 def _get_seo_content_types(seo_models):
@@ -172,3 +251,181 @@ def _get_seo_content_types(seo_models):
         return []
 def get_seo_content_types(seo_models):
     return lazy(_get_seo_content_types, list)(seo_models)
+
+
+def run_in_threads(func, items, workers=1):
+    """ Calls the given function for each item, using a bounded number of 
+        threads. Each thread uses its own database connections, which are
+        closed once it is finished. The first exception raised is re-raised.
+    """
+    if workers <= 1:
+        for item in items:
+            func(item)
+        return
+
+    import threading
+    import Queue
+    from django.db import connections
+
+    queue = Queue.Queue(maxsize=workers * 2)
+    errors = []
+
+    def worker():
+        try:
+            while True:
+                item = queue.get()
+                if item is NotSet:
+                    break
+                if not errors:
+                    try:
+                        func(item)
+                    except Exception, e:
+                        errors.append(e)
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for item in items:
+        if errors:
+            break
+        queue.put(item)
+    for thread in threads:
+        queue.put(NotSet)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+class PoolTimeout(Exception):
+    " Raised when a job in a worker pool doesn't finish in time. "
+
+
+class Job(object):
+    """ A function call made by a worker pool, holding its result. """
+
+    def __init__(self, func, args, kwargs):
+        import threading
+        self.func, self.args, self.kwargs = func, args, kwargs
+        self.finished = threading.Event()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        import sys
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self.error = sys.exc_info()
+        self.finished.set()
+
+    def get(self, timeout=None):
+        """ Waits for the job to finish and returns its result, re-raising
+            any exception. Raises PoolTimeout if the given number of seconds
+            pass first.
+        """
+        self.finished.wait(timeout)
+        if not self.finished.isSet():
+            raise PoolTimeout
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+class WorkerPool(object):
+    """ A fixed number of long running threads, which run functions in the
+        background. Threads are started when first needed. 
+        Each thread has its own database connections, which are kept open,
+        but any transaction is ended after each job.
+        If all threads are busy and the queue is full, jobs are run straight
+        away instead, in the calling thread.
+    """
+
+    def __init__(self, workers):
+        import threading
+        self.workers = workers
+        self.queue = None
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """ Runs the given function in the background, returns a Job. """
+        job = self.try_submit(func, *args, **kwargs)
+        if job is None:
+            job = Job(func, args, kwargs)
+            job.run()
+        return job
+
+    def try_submit(self, func, *args, **kwargs):
+        """ Runs the given function in the background and returns a Job, 
+            unless the pool is too busy, when None is returned.
+        """
+        import Queue
+        job = Job(func, args, kwargs)
+        if self.queue is None:
+            self._start()
+        try:
+            self.queue.put_nowait(job)
+        except Queue.Full:
+            return None
+        return job
+
+    def _start(self):
+        import threading
+        import Queue
+        self.lock.acquire()
+        try:
+            if self.queue is None:
+                queue = Queue.Queue(maxsize=self.workers * 2)
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._work, args=(queue,))
+                    thread.setDaemon(True)
+                    thread.start()
+                self.queue = queue
+        finally:
+            self.lock.release()
+
+    def _work(self, queue):
+        from django.db import connections
+        while True:
+            job = queue.get()
+            job.run()
+            for connection in connections.all():
+                try:
+                    connection.rollback_unless_managed()
+                except Exception:
+                    # Don't let a broken connection end the thread, a new one
+                    # is opened for the next job
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+
+class Timings(object):
+    """ Records how long named steps take, to report where time is spent. """
+
+    def __init__(self):
+        self.timings = []
+
+    def add(self, name, seconds):
+        self.timings.append((name, seconds))
+
+    def measure(self, name, func, *args, **kwargs):
+        """ Calls the given function, recording how long it takes if it
+            succeeds.
+        """
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.add(name, time.time() - start)
+        return result
+
+    def report(self):
+        """ A line of text for every step, slowest first. """
+        return u"\n".join(u"%8.1fms  %s" % (seconds * 1000, name) for name, seconds
+                                in sorted(self.timings, key=lambda t: -t[1]))
+
+# Time spent setting up metadata definitions when this process started
+startup_timings = Timings()